@@ -0,0 +1,201 @@
+"""Compare the compress and direct capture modes.
+
+For every round the same page is captured both ways:
+
+    compress: 1280x720 PNG screenshot, then `process_screenshot` (decode,
+              LANCZOS resize, quantize, JPEG encode), as the spider does today.
+    direct:   the context renders with a device scale factor that maps the
+              viewport to 854x480 and the browser returns a JPEG.
+
+Reported per mode: wall time of the screenshot, CPU time spent in this Python
+process (the image pipeline), output bytes, and the visual difference of the
+direct output against the compress output (mean absolute error and PSNR).
+
+By default a deterministic, map-like canvas page is rendered so runs are
+comparable offline. Pass --url to benchmark a real page instead.
+
+Usage:
+    python -m benchmarks.capture_modes --rounds 20 --output capture_modes.json
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import math
+import statistics
+import time
+
+from PIL import Image, ImageChops, ImageStat
+from playwright.async_api import async_playwright
+
+from benchmarks.utils import summarize
+from gmaps_screenshot_engine.services import process_screenshot
+
+VIEWPORT = {"width": 1280, "height": 720}
+OUTPUT_SIZE = (854, 480)
+
+MAP_PAGE = """
+<html>
+<body style="margin:0">
+<canvas id="map" width="1280" height="720"></canvas>
+<script>
+const ctx = document.getElementById("map").getContext("2d");
+let seed = 42;
+const random = () => (seed = (seed * 16807) % 2147483647) / 2147483647;
+ctx.fillStyle = "#e8eaed";
+ctx.fillRect(0, 0, 1280, 720);
+for (let i = 0; i < 60; i++) {
+  ctx.fillStyle = ["#c8e6c9", "#bbdefb", "#f5f5f5", "#ffe0b2"][i % 4];
+  ctx.fillRect(random() * 1280, random() * 720, 40 + random() * 200, 40 + random() * 160);
+}
+for (let i = 0; i < 80; i++) {
+  ctx.strokeStyle = i % 5 ? "#ffffff" : "#fbc02d";
+  ctx.lineWidth = 2 + random() * 8;
+  ctx.beginPath();
+  ctx.moveTo(random() * 1280, random() * 720);
+  ctx.lineTo(random() * 1280, random() * 720);
+  ctx.stroke();
+}
+ctx.fillStyle = "#5f6368";
+ctx.font = "13px sans-serif";
+for (let i = 0; i < 50; i++) {
+  ctx.fillText("Av. Street " + i, random() * 1200, random() * 700);
+}
+</script>
+</body>
+</html>
+"""
+
+
+async def load(page, url):
+    if url:
+        await page.goto(url, wait_until="networkidle")
+    else:
+        await page.set_content(MAP_PAGE)
+
+
+async def capture_compress(page):
+    started_at = time.perf_counter()
+    png = await page.screenshot(type="png")
+    screenshot_seconds = time.perf_counter() - started_at
+
+    cpu_started_at = time.process_time()
+    processed_image = process_screenshot(png)
+    cpu_seconds = time.process_time() - cpu_started_at
+
+    return processed_image.body, screenshot_seconds, cpu_seconds
+
+
+async def capture_direct(page, quality):
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+    body = await page.screenshot(type="jpeg", quality=quality)
+    cpu_seconds = time.process_time() - cpu_started_at
+
+    return body, time.perf_counter() - started_at, cpu_seconds
+
+
+def visual_difference(reference: bytes, candidate: bytes):
+    reference_image = Image.open(io.BytesIO(reference)).convert("RGB")
+    candidate_image = Image.open(io.BytesIO(candidate)).convert("RGB")
+    if candidate_image.size != reference_image.size:
+        candidate_image = candidate_image.resize(
+            reference_image.size, Image.Resampling.LANCZOS
+        )
+
+    diff = ImageChops.difference(reference_image, candidate_image)
+    mean_absolute_error = statistics.fmean(ImageStat.Stat(diff).mean)
+    mean_squared_error = statistics.fmean(
+        value / (diff.width * diff.height) for value in ImageStat.Stat(diff).sum2
+    )
+    psnr = (
+        math.inf
+        if mean_squared_error == 0
+        else 10 * math.log10(255**2 / mean_squared_error)
+    )
+
+    return {
+        "size": list(candidate_image.size),
+        "mean_absolute_error": mean_absolute_error,
+        "psnr_db": psnr,
+    }
+
+
+async def run(args):
+    async with async_playwright() as playwright:
+        browser = await getattr(playwright, args.browser).launch(headless=True)
+        compress_context = await browser.new_context(viewport=VIEWPORT)
+        direct_context = await browser.new_context(
+            viewport=VIEWPORT,
+            device_scale_factor=OUTPUT_SIZE[0] / VIEWPORT["width"],
+        )
+        compress_page = await compress_context.new_page()
+        direct_page = await direct_context.new_page()
+        await load(compress_page, args.url)
+        await load(direct_page, args.url)
+
+        compress_samples, direct_samples, differences = [], [], []
+        for _ in range(args.rounds):
+            compress_body, compress_wall, compress_cpu = await capture_compress(
+                compress_page
+            )
+            direct_body, direct_wall, direct_cpu = await capture_direct(
+                direct_page, args.quality
+            )
+
+            compress_samples.append(
+                {
+                    "screenshot_seconds": compress_wall,
+                    "cpu_seconds": compress_cpu,
+                    "bytes": len(compress_body),
+                }
+            )
+            direct_samples.append(
+                {
+                    "screenshot_seconds": direct_wall,
+                    "cpu_seconds": direct_cpu,
+                    "bytes": len(direct_body),
+                }
+            )
+            differences.append(visual_difference(compress_body, direct_body))
+
+        await browser.close()
+
+    return {
+        "browser": args.browser,
+        "url": args.url or "builtin:map-canvas",
+        "rounds": args.rounds,
+        "jpeg_quality": args.quality,
+        "compress": summarize(compress_samples),
+        "direct": summarize(direct_samples),
+        "direct_vs_compress": {
+            "size": differences[-1]["size"],
+            "mean_absolute_error": statistics.fmean(
+                diff["mean_absolute_error"] for diff in differences
+            ),
+            "psnr_db": min(diff["psnr_db"] for diff in differences),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--browser", default="firefox")
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--quality", type=int, default=70)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report = json.dumps(results, indent=2)
+    print(report)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,565 @@
+"""Offline end-to-end throughput benchmark of the spider.
+
+Runs the real spider (`scrapy crawl`, Playwright, image workers, pipelines
+and extensions) once per combination of target count and concurrency,
+against local stand-ins:
+
+    maps:     an HTTP server serving deterministic map pages; each page loads
+              its 256px tiles from `/maps/vt`, like Google Maps does, so the
+              capture readiness and image pipeline see realistic work.
+    s3:       `FilesystemS3Client` under a temporary directory.
+    postgres: a throwaway cluster created with `initdb`/`pg_ctl` (binaries
+              from PATH or --pg-bin; not as root), or with --postgres-host a
+              throwaway database on an existing server. Tables are created
+              from docs/config_database.md.
+
+Reported per run: targets per second, the per-stage latency percentiles
+recorded by the crawler, CPU seconds of the crawl process tree and its peak
+resident memory (sum of the RSS of every process: Scrapy, image workers,
+Playwright driver and browser). The report carries the git revision so runs
+can be compared over time.
+
+Needs the Playwright browser of PLAYWRIGHT_BROWSER_TYPE (`playwright install
+firefox`).
+
+Usage:
+    python -m benchmarks.end_to_end --targets 20,100 --concurrency 1,4,8 \\
+        --output end_to_end.json
+"""
+
+import argparse
+import functools
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import UTC, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import psycopg2
+from PIL import Image, ImageDraw
+from psycopg2.extras import execute_values
+from scrapy.utils.project import get_project_settings
+
+from gmaps_screenshot_engine.batching import TILE_SIZE, to_world_pixels
+from gmaps_screenshot_engine.spiders.gmaps_screenshot_spider import (
+    GmapsScreenshotSpider,
+)
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+SCHEMA_DOC = REPO_ROOT / "docs" / "config_database.md"
+STAGE_PERCENTILES = ("p50", "p95", "p99", "max")
+
+MAP_PAGE = """<html>
+<body style="margin:0;overflow:hidden;background:#e5e3df">
+<script>
+const [centerX, centerY, zoom, size] = [{x}, {y}, {zoom}, {tile_size}];
+const originX = centerX - innerWidth / 2, originY = centerY - innerHeight / 2;
+for (let x = Math.floor(originX / size); x * size < originX + innerWidth; x++) {{
+  for (let y = Math.floor(originY / size); y * size < originY + innerHeight; y++) {{
+    const tile = new Image();
+    tile.src = `/maps/vt?x=${{x}}&y=${{y}}&z=${{zoom}}`;
+    tile.style = `position:absolute;left:${{x * size - originX}}px;top:${{y * size - originY}}px`;
+    document.body.appendChild(tile);
+  }}
+}}
+</script>
+</body>
+</html>
+"""
+
+
+@functools.lru_cache(maxsize=4096)
+def tile_png(x: int, y: int, zoom: int) -> bytes:
+    """Deterministic map-like tile: blocks, parks, water and roads."""
+    rng = random.Random(f"{zoom}/{x}/{y}")
+    image = Image.new("RGB", (TILE_SIZE, TILE_SIZE), (232, 234, 237))
+    draw = ImageDraw.Draw(image)
+
+    for index in range(8):
+        left, top = rng.uniform(0, TILE_SIZE), rng.uniform(0, TILE_SIZE)
+        draw.rectangle(
+            (left, top, left + rng.uniform(20, 90), top + rng.uniform(20, 90)),
+            fill=[(200, 230, 201), (187, 222, 251), (245, 245, 245)][index % 3],
+        )
+    for index in range(6):
+        draw.line(
+            [(rng.uniform(0, TILE_SIZE), rng.uniform(0, TILE_SIZE)) for _ in range(2)],
+            fill=(251, 192, 45) if index % 3 == 0 else (255, 255, 255),
+            width=rng.randint(2, 8),
+        )
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+
+    return buffer.getvalue()
+
+
+class FakeMapsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    tile_latency = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path.startswith("/maps/vt"):
+            query = parse_qs(url.query)
+            zoom = int(query["z"][0])
+            x = int(query["x"][0]) % 2**zoom
+            y = min(max(int(query["y"][0]), 0), 2**zoom - 1)
+            time.sleep(self.tile_latency)
+            return self._send(tile_png(x, y, zoom), "image/png")
+
+        if url.path.startswith("/maps/@"):
+            # /maps/@{latitude},{longitude},{zoom}z/...
+            latitude, longitude, zoom = url.path.split("/")[2][1:].split(",")
+            zoom = int(zoom.rstrip("z"))
+            x, y = to_world_pixels(float(latitude), float(longitude), zoom)
+            page = MAP_PAGE.format(x=x, y=y, zoom=zoom, tile_size=TILE_SIZE)
+            return self._send(page.encode(), "text/html")
+
+        self._send(b"", "text/plain", status=404)
+
+    def _send(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_maps(tile_latency: float) -> ThreadingHTTPServer:
+    handler = type("Handler", (FakeMapsHandler,), {"tile_latency": tile_latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def schema_sql() -> str:
+    """The `Create tables` SQL of the database manual."""
+    section = SCHEMA_DOC.read_text().split("## ✨ Create tables", 1)[1]
+
+    return section.split("```sql", 1)[1].split("```", 1)[0]
+
+
+class ThrowawayPostgres:
+    """Postgres database that only lives for the benchmark.
+
+    Without `host`, a new cluster is initialized in `directory` and listens on
+    a unix socket only. With `host`, a new database is created on that server.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        bin_dir: str | None = None,
+        host: str | None = None,
+        port: int = 5432,
+        user: str = "postgres",
+        password: str = "",
+    ):
+        self.directory = directory
+        self.bin_dir = bin_dir
+        self.host = host or os.path.join(directory, "socket")
+        self.port = port
+        self.user = user
+        self.password = password
+        self.external = host is not None
+        self.database = f"gmaps_benchmark_{uuid.uuid4().hex[:8]}"
+        self.data_dir = os.path.join(directory, "data")
+
+    def _binary(self, name: str) -> str:
+        path = os.path.join(self.bin_dir, name) if self.bin_dir else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise SystemExit(
+                f"{name} not found: pass --pg-bin, or --postgres-host to use an "
+                "existing server"
+            )
+
+        return path
+
+    def connect(self, database: str | None = None):
+        return psycopg2.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            dbname=database or self.database,
+        )
+
+    def start(self):
+        if not self.external:
+            os.makedirs(self.host, exist_ok=True)
+            subprocess.run(
+                [self._binary("initdb"), "-D", self.data_dir, "-U", self.user]
+                + ["--auth=trust", "-E", "UTF8"],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            subprocess.run(
+                [self._binary("pg_ctl"), "-D", self.data_dir, "-w", "-l"]
+                + [os.path.join(self.directory, "postgres.log"), "-o"]
+                + [f"-k {self.host} -p {self.port} -c listen_addresses=''", "start"],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+
+        connection = self.connect(database="postgres")
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE DATABASE {self.database}")
+        connection.close()
+
+        with self.connect() as connection, connection.cursor() as cursor:
+            cursor.execute(schema_sql())
+
+    def stop(self):
+        if self.external:
+            connection = self.connect(database="postgres")
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP DATABASE IF EXISTS {self.database} WITH (FORCE)")
+            connection.close()
+            return
+
+        subprocess.run(
+            [self._binary("pg_ctl"), "-D", self.data_dir, "-m", "fast", "stop"],
+            check=False,
+            stdout=subprocess.DEVNULL,
+        )
+
+    def settings(self) -> dict:
+        return {
+            "POSTGRES_HOST": self.host,
+            "POSTGRES_PORT": self.port,
+            "POSTGRES_USER": self.user,
+            "POSTGRES_PASSWORD": self.password,
+            "POSTGRES_DB": self.database,
+        }
+
+    def reset_targets(self, count: int, seed: int, zoom: int):
+        """Replace every table content with `count` deterministic targets."""
+        rng = random.Random(seed)
+        rows = [
+            (
+                f"Target {index}",
+                "benchmark",
+                "",
+                "",
+                round(rng.uniform(-60, 60), 6),
+                round(rng.uniform(-180, 180), 6),
+                zoom,
+            )
+            for index in range(count)
+        ]
+
+        with self.connect() as connection, connection.cursor() as cursor:
+            cursor.execute(
+                """
+                TRUNCATE target_locations, gmaps_screenshots, scrapy_run_stats,
+                    scrapy_run_stats_snapshots, job_checkpoints RESTART IDENTITY
+                """
+            )
+            execute_values(
+                cursor,
+                """
+                INSERT INTO target_locations
+                    (name, folder, address, link, latitude, longitude, gmaps_zoom)
+                VALUES %s
+                """,
+                rows,
+            )
+
+    def run_results(self, job_id: str) -> tuple[dict, int]:
+        """Stats of a finished run and the screenshot rows it stored."""
+        with self.connect() as connection, connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT stats FROM scrapy_run_stats WHERE job_id = %s", (job_id,)
+            )
+            row = cursor.fetchone()
+            cursor.execute(
+                "SELECT count(*) FROM gmaps_screenshots WHERE job_id = %s", (job_id,)
+            )
+            screenshots = cursor.fetchone()[0]
+
+        return (row[0] if row else {}), screenshots
+
+
+def process_tree_rss(root_pid: int) -> int:
+    """Resident bytes of a process and all of its descendants (Linux)."""
+    children, rss = defaultdict(list), {}
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                # Fields after the command name, which may contain spaces
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry))
+        rss[int(entry)] = int(fields[21])
+
+    total, pending = 0, [root_pid]
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending.extend(children.get(pid, ()))
+
+    return total * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRssSampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_bytes = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            return
+
+        while not self.stopped.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, process_tree_rss(self.pid))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def crawl_settings(args, maps_url: str, s3_root: str, concurrency: int) -> dict:
+    project_settings = get_project_settings()
+    # The fake Maps server is not one of the spider allowed_domains
+    downloader_middlewares = {
+        **project_settings.getdict("DOWNLOADER_MIDDLEWARES"),
+        "scrapy.downloadermiddlewares.offsite.OffsiteMiddleware": None,
+    }
+    settings = {
+        "GMAPS_BASE_URL": maps_url,
+        "ROBOTSTXT_OBEY": False,
+        "DOWNLOAD_DELAY": 0,
+        "CONCURRENT_REQUESTS": concurrency,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": concurrency,
+        "ADAPTIVE_CONCURRENCY_ENABLED": False,
+        "METRICS_PORT": 0,
+        "STORAGE_BACKEND": "s3",
+        "S3_FILESYSTEM_ROOT": s3_root,
+        "AWS_BUCKET_NAME": "benchmark",
+        # The feed export goes to the real bucket
+        "FEED_URI": "",
+        "DOWNLOADER_MIDDLEWARES": json.dumps(downloader_middlewares),
+        # Screenshot rows are part of the measured work
+        "ITEM_PIPELINES": json.dumps(
+            {
+                **project_settings.getdict("ITEM_PIPELINES"),
+                "gmaps_screenshot_engine.pipelines.GmapsScreenshotsPostgresExportPipeline": 300,
+            }
+        ),
+    }
+    for item in args.set:
+        key, value = item.split("=", 1)
+        settings[key] = value
+
+    return settings
+
+
+def run_crawl(args, postgres, maps_url, workdir, targets, concurrency, repeat):
+    job_id = f"benchmark-{targets}-{concurrency}-{repeat}-{uuid.uuid4().hex[:8]}"
+    s3_root = os.path.join(workdir, "s3", job_id)
+    log_path = os.path.join(workdir, f"{job_id}.log")
+    settings = {
+        **crawl_settings(args, maps_url, s3_root, concurrency),
+        **postgres.settings(),
+    }
+
+    command = [
+        sys.executable,
+        "-m",
+        "scrapy",
+        "crawl",
+        GmapsScreenshotSpider.name,
+        "-a",
+        f"job_id={job_id}",
+        "-L",
+        args.log_level,
+    ]
+    for key, value in settings.items():
+        command += ["-s", f"{key}={value}"]
+
+    postgres.reset_targets(targets, seed=args.seed, zoom=args.zoom)
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started_at = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            command, cwd=REPO_ROOT, stdout=log, stderr=subprocess.STDOUT
+        )
+        sampler = PeakRssSampler(process.pid)
+        sampler.start()
+        returncode = process.wait()
+        sampler.stop()
+    wall_seconds = time.perf_counter() - started_at
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if returncode:
+        with open(log_path) as log:
+            sys.stderr.write("".join(log.readlines()[-40:]))
+
+    stats, screenshots = postgres.run_results(job_id)
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (
+        usage_after.ru_stime - usage_before.ru_stime
+    )
+    crawl_seconds = stats.get("elapsed_time_seconds") or wall_seconds
+    items = stats.get("item_scraped_count", 0)
+
+    return {
+        "targets": targets,
+        "concurrency": concurrency,
+        "repeat": repeat,
+        "returncode": returncode,
+        "finish_reason": stats.get("finish_reason"),
+        "items": items,
+        "screenshots_stored": screenshots,
+        "errors": stats.get("log_count/ERROR", 0),
+        "wall_seconds": wall_seconds,
+        "crawl_seconds": crawl_seconds,
+        "targets_per_second": items / crawl_seconds if crawl_seconds else 0,
+        "cpu_seconds": cpu_seconds,
+        "cpu_utilization": cpu_seconds / wall_seconds,
+        "peak_rss_mb": sampler.peak_bytes / 1024 / 1024,
+        "bytes_stored": stats.get("s3_uploader/bytes", 0),
+        "stages": {
+            key.split("/")[1]: {
+                percentile: stats.get(f"latency/{key.split('/')[1]}/{percentile}")
+                for percentile in STAGE_PERCENTILES
+            }
+            for key in stats
+            if key.startswith("latency/") and key.endswith("/p50")
+        },
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    with tempfile.TemporaryDirectory(prefix="gmaps-benchmark-") as workdir:
+        server = start_fake_maps(tile_latency=args.tile_latency_ms / 1000)
+        maps_url = f"http://127.0.0.1:{server.server_address[1]}"
+        postgres = ThrowawayPostgres(
+            directory=workdir,
+            bin_dir=args.pg_bin,
+            host=args.postgres_host,
+            port=args.postgres_port,
+            user=args.postgres_user,
+            password=args.postgres_password,
+        )
+        postgres.start()
+
+        runs = []
+        try:
+            for targets in args.targets:
+                for concurrency in args.concurrency:
+                    for repeat in range(args.repeat):
+                        result = run_crawl(
+                            args,
+                            postgres,
+                            maps_url,
+                            workdir,
+                            targets,
+                            concurrency,
+                            repeat,
+                        )
+                        runs.append(result)
+                        print(
+                            f"targets={targets} concurrency={concurrency} "
+                            f"repeat={repeat}: "
+                            f"{result['targets_per_second']:.2f} targets/s",
+                            file=sys.stderr,
+                        )
+        finally:
+            postgres.stop()
+            server.shutdown()
+
+    return {
+        "started_at": datetime.now(UTC).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "tile_latency_ms": args.tile_latency_ms,
+        "settings": args.set,
+        "runs": runs,
+    }
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--targets", type=int_list, default=[20])
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--zoom", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tile-latency-ms", type=float, default=20)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Extra Scrapy setting of every crawl, e.g. CAPTURE_MODE=direct",
+    )
+    parser.add_argument("--pg-bin", default=None)
+    parser.add_argument("--postgres-host", default=None)
+    parser.add_argument("--postgres-port", type=int, default=5432)
+    parser.add_argument("--postgres-user", default="postgres")
+    parser.add_argument("--postgres-password", default="")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = run(args)
+    report = json.dumps(results, indent=2, default=str)
+    print(report)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Measure the cost of the frame validator on compressed captures.
+
+Frames are synthetic 1280x720 maps (roads, blocks, labels) run through
+`CompressImageService` exactly as the workers do, in three variants:
+
+    map:      a fully rendered map, expected to pass.
+    degraded: the same map with 40% of its 256px tiles left as the grey
+              placeholder of tiles that never loaded.
+    blank:    a uniform frame.
+
+Reported per variant: the verdict and the validation time in milliseconds
+(mean, p50, p95, p99), next to the JPEG encode time the validator saves on
+rejected frames.
+
+Usage:
+    python -m benchmarks.image_validation --rounds 500 --output image_validation.json
+"""
+
+import argparse
+import io
+import json
+import random
+import statistics
+import time
+
+from PIL import Image, ImageDraw
+
+from benchmarks.utils import percentile
+from gmaps_screenshot_engine.services import (
+    CompressImageService,
+    EncodeImageService,
+    ImageValidationService,
+)
+
+VIEWPORT = (1280, 720)
+TILE_SIZE = 256
+PLACEHOLDER = (229, 227, 223)
+
+
+def map_frame(seed: int) -> Image.Image:
+    rng = random.Random(seed)
+    image = Image.new("RGB", VIEWPORT, (232, 234, 237))
+    draw = ImageDraw.Draw(image)
+
+    for index in range(60):
+        x, y = rng.uniform(0, VIEWPORT[0]), rng.uniform(0, VIEWPORT[1])
+        draw.rectangle(
+            (x, y, x + rng.uniform(40, 240), y + rng.uniform(40, 200)),
+            fill=[(200, 230, 201), (187, 222, 251), (245, 245, 245)][index % 3],
+        )
+    for index in range(80):
+        draw.line(
+            [
+                (rng.uniform(0, VIEWPORT[0]), rng.uniform(0, VIEWPORT[1]))
+                for _ in range(2)
+            ],
+            fill=(251, 192, 45) if index % 5 == 0 else (255, 255, 255),
+            width=rng.randint(2, 10),
+        )
+    for index in range(50):
+        draw.text(
+            (rng.uniform(0, 1200), rng.uniform(0, 700)),
+            f"Av. Street {index}",
+            fill=(95, 99, 104),
+        )
+
+    return image
+
+
+def degraded_frame(seed: int) -> Image.Image:
+    rng = random.Random(seed)
+    image = map_frame(seed)
+    draw = ImageDraw.Draw(image)
+    tiles = [
+        (x, y)
+        for x in range(0, VIEWPORT[0], TILE_SIZE)
+        for y in range(0, VIEWPORT[1], TILE_SIZE)
+    ]
+
+    for x, y in rng.sample(tiles, round(len(tiles) * 0.4)):
+        draw.rectangle((x, y, x + TILE_SIZE, y + TILE_SIZE), fill=PLACEHOLDER)
+
+    return image
+
+
+def blank_frame(seed: int) -> Image.Image:
+    return Image.new("RGB", VIEWPORT, PLACEHOLDER)
+
+
+def compressed(image: Image.Image) -> Image.Image:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+
+    return CompressImageService.compress(image_bytes=buffer.getvalue())[0]
+
+
+def milliseconds(samples: list[float]) -> dict:
+    return {
+        "mean": statistics.fmean(samples) * 1000,
+        "p50": percentile(samples, 0.5) * 1000,
+        "p95": percentile(samples, 0.95) * 1000,
+        "p99": percentile(samples, 0.99) * 1000,
+    }
+
+
+def run(args):
+    validator = ImageValidationService()
+    results = {}
+
+    for variant, build in (
+        ("map", map_frame),
+        ("degraded", degraded_frame),
+        ("blank", blank_frame),
+    ):
+        frames = [compressed(build(seed)) for seed in range(args.frames)]
+        verdicts = {validator.validate(frame) or "ok" for frame in frames}
+
+        validate_seconds, encode_seconds = [], []
+        for round_index in range(args.rounds):
+            frame = frames[round_index % len(frames)]
+
+            started_at = time.perf_counter()
+            validator.validate(frame)
+            validate_seconds.append(time.perf_counter() - started_at)
+
+            if round_index < args.encode_rounds:
+                started_at = time.perf_counter()
+                EncodeImageService.encode(frame)
+                encode_seconds.append(time.perf_counter() - started_at)
+
+        results[variant] = {
+            "verdicts": sorted(verdicts),
+            "validate_ms": milliseconds(validate_seconds),
+            "encode_ms": milliseconds(encode_seconds),
+        }
+
+    return {
+        "frame_size": list(frames[0].size),
+        "frames": args.frames,
+        "rounds": args.rounds,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=500)
+    parser.add_argument("--encode-rounds", type=int, default=50)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = run(args)
+    report = json.dumps(results, indent=2)
+    print(report)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import math
+import statistics
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(samples: list[dict]) -> dict:
+    return {
+        key: {
+            "mean": statistics.fmean(sample[key] for sample in samples),
+            "p95": percentile([sample[key] for sample in samples], 0.95),
+        }
+        for key in samples[0]
+    }
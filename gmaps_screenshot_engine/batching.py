@@ -0,0 +1,114 @@
+import json
+import math
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+
+from gmaps_screenshot_engine.models import TargetBatchModel, TargetLocationModel
+
+TILE_SIZE = 256
+
+
+def to_world_pixels(
+    latitude: float, longitude: float, zoom: int
+) -> tuple[float, float]:
+    """Web Mercator pixel coordinates of a point at a zoom level."""
+    world_size = TILE_SIZE * 2**zoom
+    sin_latitude = min(max(math.sin(math.radians(latitude)), -0.9999), 0.9999)
+
+    x = (longitude + 180) / 360 * world_size
+    y = (
+        0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+    ) * world_size
+
+    return x, y
+
+
+def from_world_pixels(x: float, y: float, zoom: int) -> tuple[float, float]:
+    """Latitude and longitude of Web Mercator pixel coordinates."""
+    world_size = TILE_SIZE * 2**zoom
+    longitude = x / world_size * 360 - 180
+    latitude = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world_size))))
+
+    return latitude, longitude
+
+
+class TileBatchPlanner:
+    """Group nearby targets so one rendered viewport captures all of them.
+
+    Targets sharing zoom level and map parameters are bucketed on a grid of
+    world pixels whose cells are `batch - viewport` wide and high. Every target
+    of a cell then fits, with its whole `viewport` sized region, in a
+    `batch_width` x `batch_height` viewport centered on the cell members.
+    Each batch carries the target region inside the batch viewport; the page
+    is navigated once and every region is screenshotted from the same render.
+
+    Cells with more than `max_targets` targets are split in several batches.
+    """
+
+    def __init__(
+        self,
+        viewport_width: int,
+        viewport_height: int,
+        batch_width: int,
+        batch_height: int,
+        max_targets: int,
+    ):
+        if batch_width < viewport_width or batch_height < viewport_height:
+            raise ValueError("The batch viewport must be larger than the viewport")
+
+        self.viewport_width = viewport_width
+        self.viewport_height = viewport_height
+        self.batch_width = batch_width
+        self.batch_height = batch_height
+        self.max_targets = max_targets
+
+    def plan(
+        self, targets: Iterable[TargetLocationModel]
+    ) -> Iterator[TargetBatchModel]:
+        """Batch the targets; isolated targets become batches of one."""
+        cell_width = max(self.batch_width - self.viewport_width, 1)
+        cell_height = max(self.batch_height - self.viewport_height, 1)
+        cells = defaultdict(list)
+
+        for target in targets:
+            x, y = to_world_pixels(target.latitude, target.longitude, target.gmaps_zoom)
+            key = (
+                target.gmaps_zoom,
+                json.dumps(target.gmaps_extra_params, sort_keys=True),
+                math.floor(x / cell_width),
+                math.floor(y / cell_height),
+            )
+            cells[key].append((target, x, y))
+
+        for members in cells.values():
+            for start in range(0, len(members), self.max_targets):
+                yield self._batch(members[start : start + self.max_targets])
+
+    def _batch(self, members: list) -> TargetBatchModel:
+        first = members[0][0]
+        if len(members) == 1:
+            return TargetBatchModel(center=first, targets=[first], regions=[])
+
+        xs = [x for _, x, _ in members]
+        ys = [y for _, _, y in members]
+        center_x = (min(xs) + max(xs)) / 2
+        center_y = (min(ys) + max(ys)) / 2
+        latitude, longitude = from_world_pixels(center_x, center_y, first.gmaps_zoom)
+
+        regions = [
+            {
+                "x": self.batch_width / 2 + x - center_x - self.viewport_width / 2,
+                "y": self.batch_height / 2 + y - center_y - self.viewport_height / 2,
+                "width": self.viewport_width,
+                "height": self.viewport_height,
+            }
+            for _, x, y in members
+        ]
+
+        return TargetBatchModel(
+            center=first.model_copy(
+                update={"latitude": latitude, "longitude": longitude}
+            ),
+            targets=[target for target, _, _ in members],
+            regions=regions,
+        )
@@ -0,0 +1,627 @@
+import asyncio
+import hashlib
+import re
+import time
+from typing import Self
+from weakref import WeakKeyDictionary
+
+from playwright.async_api import Error as PlaywrightError
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from scrapy import Request
+from scrapy.crawler import Crawler
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Response
+from twisted.internet import defer, error
+
+from gmaps_screenshot_engine.models import CaptureModel
+from gmaps_screenshot_engine.services import CrawlerScopedService, MetricsService
+
+READINESS_NETWORK_IDLE = "network_idle"
+READINESS_CANVAS_STABLE = "canvas_stable"
+READINESS_MAX_WAIT = "max_wait"
+
+CAPTURE_MODE_COMPRESS = "compress"
+CAPTURE_MODE_DIRECT = "direct"
+
+FAILURE_NAVIGATION_TIMEOUT = "navigation_timeout"
+FAILURE_RATE_LIMITED = "rate_limited"
+FAILURE_CONSENT = "consent"
+FAILURE_CAPTCHA = "captcha"
+FAILURE_BLANK = "blank"
+FAILURE_DOWNLOAD_ERROR = "download_error"
+
+# Meta keys tied to the page that served a request, dropped from retries so
+# the page pool hands them a fresh page
+PAGE_META_KEYS = ("playwright_page", "playwright_context", "playwright_context_kwargs")
+
+
+class CaptureFailure(Exception):
+    """A capture that produced nothing worth storing; `reason` is its class."""
+
+    def __init__(self, reason: str, message: str | None = None):
+        super().__init__(message or reason)
+        self.reason = reason
+
+
+class PageActivityTracker:
+    """Follow the map tile requests in flight on a page.
+
+    Listeners are attached once per page and survive navigations, so a pooled
+    page is tracked across every target it captures.
+    """
+
+    def __init__(self, page, tile_url_pattern: re.Pattern):
+        self.tile_url_pattern = tile_url_pattern
+        self.in_flight = set()
+        self.last_activity_at = time.monotonic()
+
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_request_done)
+        page.on("requestfailed", self._on_request_done)
+
+    def reset(self):
+        self.in_flight.clear()
+        self.last_activity_at = time.monotonic()
+
+    def _on_request(self, request):
+        if self.tile_url_pattern.search(request.url):
+            self.in_flight.add(request)
+            self.last_activity_at = time.monotonic()
+
+    def _on_request_done(self, request):
+        if request in self.in_flight:
+            self.in_flight.discard(request)
+            self.last_activity_at = time.monotonic()
+
+    def idle_for(self) -> float:
+        if self.in_flight:
+            return 0
+
+        return time.monotonic() - self.last_activity_at
+
+
+class BrowserCacheTracker:
+    """Count the static resources of a page served by the browser cache.
+
+    A finished request with no response body transferred over the network
+    is a hit and saves its `content-length`.
+    """
+
+    RESOURCE_TYPES = ("script", "stylesheet", "image", "font")
+
+    def __init__(self, page, stats):
+        self.stats = stats
+
+        page.on("requestfinished", self._on_request_finished)
+
+    async def _on_request_finished(self, request):
+        if request.resource_type not in self.RESOURCE_TYPES:
+            return
+
+        try:
+            response = await request.response()
+            if response is None or response.status not in (200, 304):
+                return
+            sizes = await request.sizes()
+            content_length = await response.header_value("content-length")
+        except PlaywrightError:
+            return
+
+        stats = self.stats
+        stats.inc_value("browser_cache/requests")
+        if sizes["responseBodySize"] == 0:
+            stats.inc_value("browser_cache/hits")
+            stats.inc_value("browser_cache/bytes_saved", int(content_length or 0))
+        else:
+            stats.inc_value("browser_cache/bytes_downloaded", sizes["responseBodySize"])
+
+        stats.set_value(
+            "browser_cache/hit_ratio",
+            stats.get_value("browser_cache/hits", 0)
+            / stats.get_value("browser_cache/requests"),
+        )
+
+
+class PageRequestBlocker:
+    """Route handler of one page, aborting the requests the rules block.
+
+    Counters cover the current navigation and are reset with the page.
+    """
+
+    def __init__(self, service: "RequestBlockingService", page):
+        self.service = service
+        self.sampled = {}
+        self.blocked = 0
+        self.bytes_saved = 0
+
+        page.on("requestfinished", self._on_request_finished)
+        page.on("requestfailed", self._on_request_failed)
+
+    def reset(self):
+        self.blocked = 0
+        self.bytes_saved = 0
+
+    async def handle(self, route, request):
+        service = self.service
+        rule = service.match(request)
+
+        if rule is None:
+            await route.fallback()
+            return
+
+        if service.should_sample(rule):
+            # Let it through to learn how much blocking this rule saves
+            self.sampled[request] = rule
+            await route.fallback()
+            return
+
+        await route.abort()
+        self.blocked += 1
+        self.bytes_saved += service.blocked(rule)
+
+    def _on_request_failed(self, request):
+        # Nothing to measure, only forget it
+        self.sampled.pop(request, None)
+
+    async def _on_request_finished(self, request):
+        rule = self.sampled.pop(request, None)
+        if rule is None:
+            return
+
+        try:
+            sizes = await request.sizes()
+        except PlaywrightError:
+            return
+
+        self.service.sampled(
+            rule, sizes["responseHeadersSize"] + sizes["responseBodySize"]
+        )
+
+
+class RequestBlockingService(CrawlerScopedService):
+    """Abort the requests of the Maps app that do not show on the map canvas.
+
+    Requests are matched in this order:
+        allowed: URLs matching `allow_url_patterns` (map tiles, the scripts
+            rendering them) and navigations are never blocked.
+        url rules: URLs matching one of the named `block_url_patterns`
+            (analytics, logging beacons, search suggestions...).
+        resource types: requests of the `block_resource_types` (side panel
+            images...).
+
+    Blocked requests never reach the network, so what they would have cost
+    is learnt by letting one in `sample_every` of each rule through and
+    measuring its response; blocked requests then count the mean sampled
+    size of their rule as saved bytes.
+    """
+
+    def __init__(
+        self,
+        stats,
+        allow_url_patterns: list[str],
+        block_url_patterns: dict[str, str],
+        block_resource_types: list[str],
+        sample_every: int = 0,
+    ):
+        self.stats = stats
+        self.allow_url_pattern = (
+            re.compile("|".join(allow_url_patterns)) if allow_url_patterns else None
+        )
+        self.block_url_patterns = {
+            name: re.compile(pattern) for name, pattern in block_url_patterns.items()
+        }
+        self.block_resource_types = set(block_resource_types)
+        self.sample_every = sample_every
+        self.seen = {}
+        self.sample_sizes = {}
+        self.blockers = WeakKeyDictionary()
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+
+        return cls(
+            stats=crawler.stats,
+            allow_url_patterns=settings.getlist("REQUEST_BLOCKING_ALLOW_URL_PATTERNS"),
+            block_url_patterns=settings.getdict("REQUEST_BLOCKING_URL_PATTERNS"),
+            block_resource_types=settings.getlist("REQUEST_BLOCKING_RESOURCE_TYPES"),
+            sample_every=settings.getint("REQUEST_BLOCKING_SAMPLE_EVERY"),
+        )
+
+    def match(self, request) -> str | None:
+        """Name of the rule blocking the request, None to let it through."""
+        url = request.url
+        if request.is_navigation_request() or (
+            self.allow_url_pattern and self.allow_url_pattern.search(url)
+        ):
+            return None
+
+        for name, pattern in self.block_url_patterns.items():
+            if pattern.search(url):
+                return name
+
+        if request.resource_type in self.block_resource_types:
+            return request.resource_type
+
+        return None
+
+    def should_sample(self, rule: str) -> bool:
+        seen = self.seen.get(rule, 0)
+        self.seen[rule] = seen + 1
+
+        return bool(self.sample_every) and seen % self.sample_every == 0
+
+    def sampled(self, rule: str, size: int):
+        count, total = self.sample_sizes.get(rule, (0, 0))
+        self.sample_sizes[rule] = (count + 1, total + size)
+        self.stats.inc_value("request_blocking/sampled")
+        self.stats.inc_value("request_blocking/sampled_bytes", size)
+
+    def blocked(self, rule: str) -> int:
+        """Record a blocked request; returns the bytes it is estimated to save."""
+        count, total = self.sample_sizes.get(rule, (0, 0))
+        estimate = total // count if count else 0
+
+        self.stats.inc_value("request_blocking/blocked")
+        self.stats.inc_value(f"request_blocking/blocked/{rule}")
+        self.stats.inc_value("request_blocking/bytes_saved", estimate)
+
+        return estimate
+
+    async def attach(self, page):
+        """Route the requests of the next navigation of the page.
+
+        scrapy-playwright drops the "**" routes of a page before each
+        navigation and adds its own; this handler comes later, so it runs
+        first and falls back to the scrapy-playwright one.
+        """
+        blocker = self.blockers.get(page)
+        if blocker is None:
+            blocker = self.blockers[page] = PageRequestBlocker(self, page)
+
+        blocker.reset()
+        await page.route("**", blocker.handle)
+
+    def record_page(self, page):
+        """Per page stats of a rendered navigation."""
+        blocker = self.blockers.get(page)
+        if blocker is None:
+            return
+
+        self.stats.inc_value("request_blocking/pages")
+        self.stats.max_value("request_blocking/blocked_per_page/max", blocker.blocked)
+        self.stats.max_value(
+            "request_blocking/bytes_saved_per_page/max", blocker.bytes_saved
+        )
+
+
+class CaptureService(CrawlerScopedService):
+    """Decide when a map page is ready and take its screenshot.
+
+    Readiness conditions:
+        network_idle: no tile request in flight for `idle_ms`.
+        canvas_stable: two consecutive low quality probes of the clip region
+            are identical.
+        max_wait: wait `max_wait_ms` unconditionally.
+
+    Every condition gives up after `max_wait_ms`; the capture is then taken
+    anyway and flagged as not ready.
+
+    Capture modes:
+        compress: take a PNG that is resized, quantized and encoded as JPEG by
+            the image-processing pool.
+        direct: the context renders at the output resolution (through its
+            device scale factor) and the browser encodes the JPEG itself with
+            `jpeg_quality`, skipping the decode/resize round-trip.
+    """
+
+    def __init__(
+        self,
+        stats,
+        metrics: MetricsService,
+        readiness: str,
+        tile_url_patterns: list[str],
+        idle_ms: int,
+        poll_ms: int,
+        max_wait_ms: int,
+        clip: dict,
+        viewport: dict,
+        mode: str = CAPTURE_MODE_COMPRESS,
+        jpeg_quality: int = 70,
+        blank_max_bytes: dict[str, int] | None = None,
+        request_blocking: RequestBlockingService | None = None,
+        track_cache: bool = False,
+    ):
+        self.stats = stats
+        self.metrics = metrics
+        self.readiness = readiness
+        self.tile_url_pattern = re.compile("|".join(tile_url_patterns))
+        self.idle_ms = idle_ms
+        self.poll_ms = poll_ms
+        self.max_wait_ms = max_wait_ms
+        self.clip = clip
+        self.viewport = viewport
+        self.mode = mode
+        self.jpeg_quality = jpeg_quality
+        # Per screenshot format, formats without a limit are not checked
+        self.blank_max_bytes = blank_max_bytes or {}
+        self.request_blocking = request_blocking
+        self.track_cache = track_cache
+        self.trackers = WeakKeyDictionary()
+        self.cache_trackers = WeakKeyDictionary()
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+        viewport = {
+            "width": settings.getint("CAPTURE_VIEWPORT_WIDTH"),
+            "height": settings.getint("CAPTURE_VIEWPORT_HEIGHT"),
+        }
+        clip = settings.getdict("CAPTURE_CLIP") or {"x": 0, "y": 0, **viewport}
+
+        return cls(
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            readiness=settings.get("CAPTURE_READINESS"),
+            tile_url_patterns=settings.getlist("CAPTURE_TILE_URL_PATTERNS"),
+            idle_ms=settings.getint("CAPTURE_IDLE_MS"),
+            poll_ms=settings.getint("CAPTURE_POLL_MS"),
+            max_wait_ms=settings.getint("CAPTURE_MAX_WAIT_MS"),
+            clip=clip,
+            viewport=viewport,
+            mode=settings.get("CAPTURE_MODE"),
+            jpeg_quality=settings.getint("CAPTURE_JPEG_QUALITY"),
+            blank_max_bytes={
+                "png": settings.getint("CAPTURE_BLANK_MAX_BYTES"),
+                "jpeg": settings.getint("CAPTURE_BLANK_MAX_BYTES_JPEG"),
+            },
+            request_blocking=(
+                RequestBlockingService.from_crawler(crawler)
+                if settings.getbool("REQUEST_BLOCKING_ENABLED")
+                else None
+            ),
+            track_cache=settings.getbool("BROWSER_PROFILE_ENABLED"),
+        )
+
+    async def prepare_page(self, page, request):
+        """Playwright page init callback, run before every navigation.
+
+        Tile batches render in a larger viewport (`capture_viewport` meta), so
+        pooled pages are resized back and forth as needed. Requests blocked by
+        the request blocking rules are routed here as well.
+        """
+        viewport = request.meta.get("capture_viewport", self.viewport)
+        if page.viewport_size != viewport:
+            with self.metrics.time("viewport"):
+                await page.set_viewport_size(viewport)
+
+        tracker = self.trackers.get(page)
+        if tracker is None:
+            tracker = self.trackers[page] = PageActivityTracker(
+                page, self.tile_url_pattern
+            )
+
+        tracker.reset()
+
+        if self.track_cache and page not in self.cache_trackers:
+            self.cache_trackers[page] = BrowserCacheTracker(page, self.stats)
+
+        if self.request_blocking is not None:
+            await self.request_blocking.attach(page)
+
+    async def capture(
+        self, page, region: dict | None = None, wait: bool = True
+    ) -> CaptureModel:
+        """Wait for the configured readiness condition, then screenshot the clip.
+
+        Args:
+            region: Viewport sized region of a tile batch to capture instead
+                of the viewport; the clip is applied inside it.
+            wait: Skip the readiness wait for the regions of a batch after the
+                first one, the page is already rendered.
+        """
+        started_at = time.perf_counter()
+        ready = True
+        clip = self.clip
+        if region is not None:
+            clip = {
+                **clip,
+                "x": clip["x"] + region["x"],
+                "y": clip["y"] + region["y"],
+            }
+
+        if wait and self.readiness == READINESS_MAX_WAIT:
+            await asyncio.sleep(self.max_wait_ms / 1000)
+        elif wait:
+            try:
+                await asyncio.wait_for(
+                    self._wait_until_ready(page, clip),
+                    timeout=self.max_wait_ms / 1000,
+                )
+            except TimeoutError:
+                ready = False
+
+        wait_seconds = time.perf_counter() - started_at
+        if wait:
+            self.metrics.observe("readiness", wait_seconds)
+            if self.request_blocking is not None:
+                self.request_blocking.record_page(page)
+
+        with self.metrics.time("screenshot"):
+            if self.mode == CAPTURE_MODE_DIRECT:
+                image_format = "jpeg"
+                image_bytes = await page.screenshot(
+                    clip=clip,
+                    type="jpeg",
+                    quality=self.jpeg_quality,
+                )
+            else:
+                image_format = "png"
+                image_bytes = await page.screenshot(clip=clip, type="png")
+
+        self.stats.inc_value(f"capture/mode/{self.mode}")
+        self.stats.inc_value("capture/wait_seconds", wait_seconds)
+        self.stats.max_value("capture/wait_seconds/max", wait_seconds)
+        self.stats.inc_value(f"capture/readiness/{'ready' if ready else 'timeout'}")
+
+        # A uniform frame compresses to almost nothing: cheap blank check
+        # before any decoding
+        if len(image_bytes) < self.blank_max_bytes.get(image_format, 0):
+            raise CaptureFailure(
+                FAILURE_BLANK, f"Blank capture ({len(image_bytes)} bytes)"
+            )
+
+        return CaptureModel(
+            image_bytes=image_bytes,
+            image_format=image_format,
+            wait_seconds=wait_seconds,
+            ready=ready,
+        )
+
+    async def _wait_until_ready(self, page, clip: dict):
+        if self.readiness == READINESS_NETWORK_IDLE:
+            await self._wait_for_network_idle(page)
+        elif self.readiness == READINESS_CANVAS_STABLE:
+            await self._wait_for_canvas_stable(page, clip)
+        else:
+            raise ValueError(f"Unknown CAPTURE_READINESS: {self.readiness}")
+
+    async def _wait_for_network_idle(self, page):
+        tracker = self.trackers.get(page)
+        if tracker is None:
+            # Page was not prepared, nothing to follow: fall back to Playwright
+            await page.wait_for_load_state("networkidle")
+            return
+
+        while tracker.idle_for() * 1000 < self.idle_ms:
+            await asyncio.sleep(self.poll_ms / 1000)
+
+    async def _wait_for_canvas_stable(self, page, clip: dict):
+        previous = None
+
+        while True:
+            probe = await page.screenshot(clip=clip, type="jpeg", quality=10)
+            digest = hashlib.blake2b(probe, digest_size=16).digest()
+            if digest == previous:
+                return
+
+            previous = digest
+            await asyncio.sleep(self.poll_ms / 1000)
+
+
+class CaptureRetryService(CrawlerScopedService):
+    """Classify capture failures and decide which ones get another attempt.
+
+    Failure classes:
+        navigation_timeout: the page did not load in time.
+        rate_limited: HTTP 429.
+        consent: redirected to the cookie consent wall.
+        captcha: redirected to the "unusual traffic" captcha page.
+        blank: the screenshot is a blank or uniform frame.
+        download_error: any other download exception (DNS errors, connection
+            resets, browser errors...), what Scrapy's `RetryMiddleware`
+            would have retried.
+
+    Only the classes in `retry_reasons` are retried, at most `max_retries`
+    times per target, `backoff * 2**attempt` seconds later. The others fail
+    fast, since repeating them only burns browser time. Retries are further
+    capped by a budget of `budget_ratio` of the requests sent (plus
+    `budget_min`), so a site-wide problem does not turn into a retry storm.
+    """
+
+    def __init__(
+        self,
+        stats,
+        retry_reasons: list[str],
+        max_retries: int,
+        backoff: float,
+        budget_ratio: float,
+        budget_min: int,
+        consent_url_patterns: list[str],
+        captcha_url_patterns: list[str],
+    ):
+        self.stats = stats
+        self.retry_reasons = set(retry_reasons)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.budget_ratio = budget_ratio
+        self.budget_min = budget_min
+        self.consent_url_pattern = re.compile("|".join(consent_url_patterns))
+        self.captcha_url_pattern = re.compile("|".join(captcha_url_patterns))
+        self.retries = 0
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+
+        return cls(
+            stats=crawler.stats,
+            retry_reasons=settings.getlist("CAPTURE_RETRY_REASONS"),
+            max_retries=settings.getint("CAPTURE_RETRY_MAX_TIMES"),
+            backoff=settings.getfloat("CAPTURE_RETRY_BACKOFF"),
+            budget_ratio=settings.getfloat("CAPTURE_RETRY_BUDGET_RATIO"),
+            budget_min=settings.getint("CAPTURE_RETRY_BUDGET_MIN"),
+            consent_url_patterns=settings.getlist("CAPTURE_CONSENT_URL_PATTERNS"),
+            captcha_url_patterns=settings.getlist("CAPTURE_CAPTCHA_URL_PATTERNS"),
+        )
+
+    def classify_response(self, response: Response) -> str | None:
+        if response.status == 429:
+            return FAILURE_RATE_LIMITED
+
+        if self.captcha_url_pattern.search(response.url):
+            return FAILURE_CAPTCHA
+
+        if self.consent_url_pattern.search(response.url):
+            return FAILURE_CONSENT
+
+        return None
+
+    def classify_exception(self, exception: BaseException) -> str | None:
+        if isinstance(exception, CaptureFailure):
+            return exception.reason
+
+        if isinstance(
+            exception,
+            (PlaywrightTimeoutError, defer.TimeoutError, error.TimeoutError),
+        ):
+            return FAILURE_NAVIGATION_TIMEOUT
+
+        if isinstance(exception, IgnoreRequest):
+            return None
+
+        return FAILURE_DOWNLOAD_ERROR
+
+    def retryable(self, reason: str | None) -> bool:
+        """Whether a failure is worth another attempt; unknown ones are."""
+        return reason is None or reason in self.retry_reasons
+
+    def retry(self, request: Request, reason: str) -> Request | None:
+        """Record the failure; returns the retry request, or None to give up."""
+        self.stats.inc_value(f"capture_failures/{reason}")
+        attempt = request.meta.get("capture_retry_times", 0)
+        budget = self.budget_min + self.budget_ratio * self.stats.get_value(
+            "downloader/request_count", 0
+        )
+
+        if reason not in self.retry_reasons or attempt >= self.max_retries:
+            self.stats.inc_value(f"capture_failures/{reason}/given_up")
+            return None
+
+        if self.retries >= budget:
+            self.stats.inc_value("capture_failures/budget_exhausted")
+            self.stats.inc_value(f"capture_failures/{reason}/given_up")
+            return None
+
+        self.retries += 1
+        self.stats.inc_value(f"capture_failures/{reason}/retried")
+
+        meta = {
+            key: value
+            for key, value in request.meta.items()
+            if key not in PAGE_META_KEYS
+        }
+        meta["capture_retry_times"] = attempt + 1
+        meta["capture_retry_not_before"] = time.time() + self.backoff * 2**attempt
+
+        return request.replace(meta=meta, dont_filter=True)
@@ -0,0 +1,439 @@
+"""Delta storage: consecutive captures of a target stored as changed blocks.
+
+Frames are split in fixed `block_size` blocks. A keyframe stores the whole
+JPEG; the next captures of the same target only store the blocks that
+changed since the previous one, packed in a JPEG atlas, next to a manifest
+(`{file}.manifest.json`) listing where the latest version of every block
+lives. A keyframe is stored again every `keyframe_interval` captures, or
+when most blocks changed, so any capture is rebuilt from its manifest, its
+keyframe and at most the atlases of the deltas since.
+
+Blocks are compared on a signature of the frame (its luminance averaged
+over 8x8 cells, kept in the manifest), so finding the changed blocks only needs
+the previous manifest, never the previous pixels.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import time
+import zlib
+from typing import Self
+
+from botocore.exceptions import BotoCoreError, ClientError
+from PIL import Image, ImageChops
+from scrapy.crawler import Crawler
+from scrapy.utils.project import get_project_settings
+
+from gmaps_screenshot_engine.models import (
+    DeltaModel,
+    ProcessedImageModel,
+    TargetLocationModel,
+)
+from gmaps_screenshot_engine.services import (
+    CrawlerScopedService,
+    EncodeImageService,
+    build_s3_client,
+    download_object,
+)
+from gmaps_screenshot_engine.storage import (
+    STORAGE_CONTENT_ADDRESSED,
+    STORAGE_LOCAL,
+    ContentAddressedStore,
+    StorageBackend,
+    get_storage_backend,
+)
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".manifest.json"
+ATLAS_SUFFIX = ".blocks.jpg"
+# Cell size of the block signatures: averaging absorbs the JPEG noise
+# between captures of an unchanged map
+SIGNATURE_FACTOR = 8
+# Luminance only: a third of the manifest size, and map changes (labels,
+# roads, traffic colors) all move the luminance too
+SIGNATURE_MODE = "L"
+
+
+def block_boxes(size: tuple[int, int], block_size: int) -> list[tuple]:
+    """Boxes of the blocks of a frame, row by row; edge blocks are cropped."""
+    width, height = size
+
+    return [
+        (x, y, min(x + block_size, width), min(y + block_size, height))
+        for y in range(0, height, block_size)
+        for x in range(0, width, block_size)
+    ]
+
+
+def signature_box(box: tuple) -> tuple:
+    x0, y0, x1, y1 = box
+
+    return (
+        x0 // SIGNATURE_FACTOR,
+        y0 // SIGNATURE_FACTOR,
+        -(-x1 // SIGNATURE_FACTOR),
+        -(-y1 // SIGNATURE_FACTOR),
+    )
+
+
+def atlas_position(slot: int, width: int, block_size: int) -> tuple[int, int]:
+    """Top left corner of an atlas slot; atlases are as wide as the frame."""
+    columns = -(-width // block_size)
+
+    return (slot % columns) * block_size, (slot // columns) * block_size
+
+
+def encode_atlas(image: Image.Image, boxes: list[tuple], block_size: int) -> bytes:
+    columns = -(-image.width // block_size)
+    rows = -(-len(boxes) // columns)
+    atlas = Image.new("RGB", (columns * block_size, rows * block_size))
+
+    for slot, box in enumerate(boxes):
+        atlas.paste(image.crop(box), atlas_position(slot, image.width, block_size))
+
+    body = EncodeImageService.encode(atlas)
+    atlas.close()
+
+    return body
+
+
+def pack_signature(signature: Image.Image) -> str:
+    return base64.b64encode(zlib.compress(signature.tobytes())).decode()
+
+
+def unpack_signature(text: str, size: tuple[int, int]) -> Image.Image:
+    signature_size = (-(-size[0] // SIGNATURE_FACTOR), -(-size[1] // SIGNATURE_FACTOR))
+
+    return Image.frombytes(
+        SIGNATURE_MODE, signature_size, zlib.decompress(base64.b64decode(text))
+    )
+
+
+class DeltaEncoder:
+    """Find the blocks of a frame that changed since the previous capture.
+
+    A block changed when any cell of its signature moved by more than
+    `threshold` levels. Without a previous signature (or a frame of another
+    size), when `keyframe` is forced or when more than `max_changed_ratio` of
+    the blocks changed, the frame is a keyframe.
+
+    Runs inside the image-processing worker processes, so it must stay
+    picklable.
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        threshold: int,
+        max_changed_ratio: float,
+        previous_signature: str | None = None,
+        previous_size: tuple[int, int] | None = None,
+        keyframe: bool = False,
+    ):
+        self.block_size = block_size
+        self.threshold = threshold
+        self.max_changed_ratio = max_changed_ratio
+        self.previous_signature = previous_signature
+        self.previous_size = previous_size
+        self.keyframe = keyframe
+
+    def __call__(self, image: Image.Image) -> DeltaModel:
+        started_at = time.perf_counter()
+        signature = image.convert(SIGNATURE_MODE).reduce(SIGNATURE_FACTOR)
+        boxes = block_boxes(image.size, self.block_size)
+        keyframe = (
+            self.keyframe
+            or self.previous_signature is None
+            or tuple(self.previous_size) != image.size
+        )
+
+        if not keyframe:
+            previous = unpack_signature(self.previous_signature, image.size)
+            difference = ImageChops.difference(signature, previous)
+            blocks = [
+                index
+                for index, box in enumerate(boxes)
+                if difference.crop(signature_box(box)).getextrema()[1] > self.threshold
+            ]
+            keyframe = len(blocks) > self.max_changed_ratio * len(boxes)
+
+        if keyframe:
+            return DeltaModel(
+                keyframe=True,
+                signature=pack_signature(signature),
+                seconds=time.perf_counter() - started_at,
+            )
+
+        # Unchanged blocks keep the signature of the version readers see, so
+        # slow drifts are caught once they add up to the threshold
+        for index in blocks:
+            box = signature_box(boxes[index])
+            previous.paste(signature.crop(box), box)
+
+        return DeltaModel(
+            keyframe=False,
+            signature=pack_signature(previous),
+            blocks=blocks,
+            atlas=encode_atlas(
+                image, [boxes[index] for index in blocks], self.block_size
+            )
+            if blocks
+            else b"",
+            seconds=time.perf_counter() - started_at,
+        )
+
+
+class DeltaStorageService(CrawlerScopedService):
+    """Store captures as keyframes or changed blocks on the storage backend.
+
+    The manifest of the previous capture of a target (its `last_file_path`)
+    is read before processing, to build the `DeltaEncoder` of the frame. A
+    manifest is written after the objects it points at.
+    """
+
+    def __init__(
+        self,
+        stats,
+        storage: StorageBackend,
+        block_size: int,
+        threshold: int,
+        max_changed_ratio: float,
+        keyframe_interval: int,
+    ):
+        if block_size % 16:
+            raise ValueError("DELTA_BLOCK_SIZE must be a multiple of 16")
+
+        self.stats = stats
+        self.storage = storage
+        self.block_size = block_size
+        self.threshold = threshold
+        self.max_changed_ratio = max_changed_ratio
+        self.keyframe_interval = keyframe_interval
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+
+        return cls(
+            stats=crawler.stats,
+            storage=get_storage_backend(crawler),
+            block_size=settings.getint("DELTA_BLOCK_SIZE"),
+            threshold=settings.getint("DELTA_BLOCK_THRESHOLD"),
+            max_changed_ratio=settings.getfloat("DELTA_MAX_CHANGED_RATIO"),
+            keyframe_interval=settings.getint("DELTA_KEYFRAME_INTERVAL"),
+        )
+
+    async def previous(self, target_location: TargetLocationModel) -> dict | None:
+        """Manifest of the previous capture of a target, if it has one."""
+        file_path = target_location.last_file_path
+        if not file_path or not file_path.endswith(MANIFEST_SUFFIX):
+            return None
+
+        try:
+            body = await self.storage.fetch(file_path)
+        except (BotoCoreError, ClientError, OSError) as e:
+            self.stats.inc_value("delta/manifest_errors")
+            logger.warning(f"⚠️ Previous manifest {file_path} not read: {e}")
+            return None
+
+        if body is None:
+            self.stats.inc_value("delta/manifest_missing")
+            return None
+
+        try:
+            manifest = json.loads(body)
+            if (
+                manifest.get("version") != MANIFEST_VERSION
+                or manifest["block_size"] != self.block_size
+            ):
+                return None
+
+            # Everything the encoder and `store` read, so a corrupt manifest
+            # fails here (and the capture becomes a keyframe) rather than
+            # during the capture
+            unpack_signature(
+                manifest["signature"], (manifest["width"], manifest["height"])
+            )
+            manifest["keyframe"] = str(manifest["keyframe"])
+            manifest["depth"] = int(manifest["depth"])
+            manifest["blocks"] = [
+                [int(index), str(atlas), int(slot)]
+                for index, atlas, slot in manifest["blocks"]
+            ]
+        except (ValueError, KeyError, TypeError, AttributeError, zlib.error) as e:
+            self.stats.inc_value("delta/manifest_errors")
+            logger.warning(f"⚠️ Previous manifest {file_path} is corrupt: {e}")
+            return None
+
+        return manifest
+
+    def encoder(self, previous: dict | None) -> DeltaEncoder:
+        return DeltaEncoder(
+            block_size=self.block_size,
+            threshold=self.threshold,
+            max_changed_ratio=self.max_changed_ratio,
+            previous_signature=previous["signature"] if previous else None,
+            previous_size=(previous["width"], previous["height"]) if previous else None,
+            keyframe=previous is None
+            or previous["depth"] + 1 >= self.keyframe_interval,
+        )
+
+    async def store(
+        self,
+        file_path: str,
+        processed_image: ProcessedImageModel,
+        previous: dict | None,
+    ) -> tuple[str, int]:
+        """Store a processed capture.
+
+        Returns:
+            tuple: Path of its manifest and the bytes stored.
+        """
+        delta = processed_image.delta
+        base = os.path.splitext(file_path)[0]
+        objects = {}
+
+        if delta.keyframe:
+            objects[file_path] = processed_image.body
+            keyframe, depth, blocks = file_path, 0, {}
+        else:
+            keyframe, depth = previous["keyframe"], previous["depth"] + 1
+            blocks = {index: (atlas, slot) for index, atlas, slot in previous["blocks"]}
+            if delta.blocks:
+                objects[base + ATLAS_SUFFIX] = delta.atlas
+                for slot, index in enumerate(delta.blocks):
+                    blocks[index] = (base + ATLAS_SUFFIX, slot)
+
+        manifest = json.dumps(
+            {
+                "version": MANIFEST_VERSION,
+                "width": processed_image.width,
+                "height": processed_image.height,
+                "block_size": self.block_size,
+                "keyframe": keyframe,
+                "depth": depth,
+                "blocks": [[index, *blocks[index]] for index in sorted(blocks)],
+                "signature": delta.signature,
+                "content_hash": processed_image.content_hash,
+            }
+        ).encode()
+
+        await asyncio.gather(
+            *(self.storage.store(path, body) for path, body in objects.items())
+        )
+        await self.storage.store(base + MANIFEST_SUFFIX, manifest)
+
+        stored = len(manifest) + sum(len(body) for body in objects.values())
+        self.stats.inc_value("delta/keyframes" if delta.keyframe else "delta/deltas")
+        self.stats.inc_value("delta/blocks_changed", len(delta.blocks))
+        self.stats.inc_value(
+            "delta/blocks_total",
+            len(
+                block_boxes(
+                    (processed_image.width, processed_image.height), self.block_size
+                )
+            ),
+        )
+        self.stats.inc_value("delta/bytes_stored", stored)
+        self.stats.inc_value(
+            "delta/bytes_saved", max(len(processed_image.body) - stored, 0)
+        )
+
+        return base + MANIFEST_SUFFIX, stored
+
+
+class DeltaReader:
+    """Rebuild the captures stored by delta storage.
+
+    `fetch` returns the bytes stored under a path, or None; see
+    `fetcher_from_settings` for one reading the configured storage.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+
+    def read(self, file_path: str) -> bytes:
+        body = self.fetch(file_path)
+        if body is None:
+            raise FileNotFoundError(file_path)
+
+        return body
+
+    def manifest(self, manifest_path: str) -> dict:
+        return json.loads(self.read(manifest_path))
+
+    def rebuild(self, manifest_path: str) -> Image.Image:
+        """The capture of a manifest: its keyframe with the blocks replaced."""
+        manifest = self.manifest(manifest_path)
+        image = Image.open(io.BytesIO(self.read(manifest["keyframe"])))
+        image.load()
+        boxes = block_boxes(image.size, manifest["block_size"])
+        atlases = {}
+
+        for index, atlas_path, slot in manifest["blocks"]:
+            atlas = atlases.get(atlas_path)
+            if atlas is None:
+                atlas = atlases[atlas_path] = Image.open(
+                    io.BytesIO(self.read(atlas_path))
+                )
+            box = boxes[index]
+            x, y = atlas_position(slot, image.width, manifest["block_size"])
+            image.paste(
+                atlas.crop((x, y, x + box[2] - box[0], y + box[3] - box[1])), box[:2]
+            )
+
+        for atlas in atlases.values():
+            atlas.close()
+
+        return image
+
+
+def fetcher_from_settings(settings):
+    """Read objects from the storage selected by `STORAGE_BACKEND`."""
+    backend = settings.get("STORAGE_BACKEND")
+    root = settings.get("STORAGE_LOCAL_ROOT")
+
+    if backend == STORAGE_CONTENT_ADDRESSED:
+        return ContentAddressedStore(root).get
+
+    if backend == STORAGE_LOCAL:
+
+        def fetch(file_path: str) -> bytes | None:
+            try:
+                with open(os.path.join(root, file_path), "rb") as file:
+                    return file.read()
+            except FileNotFoundError:
+                return None
+
+        return fetch
+
+    client = build_s3_client(settings, max_pool_connections=1)
+    bucket = settings.get("AWS_BUCKET_NAME")
+
+    return lambda file_path: download_object(client, bucket, file_path)
+
+
+def main():
+    """Rebuild a capture stored by delta storage from its manifest."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("manifest_path")
+    parser.add_argument("output", help="Image file to write, e.g. capture.jpg")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    reader = DeltaReader(fetcher_from_settings(get_project_settings()))
+    image = reader.rebuild(args.manifest_path)
+    image.save(args.output)
+    logger.info(f"🧱 Rebuilt {args.manifest_path} into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,24 @@
 import json
-from datetime import datetime
+import os
+import re
+from datetime import UTC, datetime
+from typing import Self
 
 import psycopg2
 from scrapy import Spider, signals
 from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
 from scrapy.statscollectors import StatsCollector
-from typing_extensions import Self
+from twisted.internet import error, task, threads
+from twisted.web import resource, server
 
-from gmaps_screenshot_engine.services import PostgresService
+from gmaps_screenshot_engine.metrics import render_prometheus
+from gmaps_screenshot_engine.services import (
+    ImageProcessingService,
+    MetricsService,
+    PostgresBatchWriter,
+    PostgresService,
+)
 
 
 def map_json(obj):
@@ -17,27 +28,109 @@ def map_json(obj):
     return obj
 
 
+def insert_run_summary(postgres_service: PostgresService, stats: dict):
+    """Insert the summary row of a run in `scrapy_run_stats`."""
+    insert_query = """
+    INSERT INTO scrapy_run_stats
+    (
+        job_id,
+        started_at,
+        finished_at,
+        elapsed_time_seconds,
+        item_scraped_count,
+        finish_reason,
+        responses_per_minute,
+        items_per_minute,
+        stats
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    with postgres_service.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                insert_query,
+                (
+                    stats.get("job_id"),
+                    stats.get("start_time"),
+                    stats.get("finish_time"),
+                    stats.get("elapsed_time_seconds"),
+                    stats.get("item_scraped_count", 0),
+                    stats.get("finish_reason"),
+                    stats.get("responses_per_minute"),
+                    stats.get("items_per_minute"),
+                    json.dumps(stats, default=map_json),
+                ),
+            )
+
+        conn.commit()
+
+
 class PostgresStatsExtension:
-    def __init__(self, stats: StatsCollector, postgres_service):
+    """Store the crawler stats of a run in Postgres.
+
+    Every `snapshot_interval` seconds a snapshot (interval throughput, error
+    count, queue depths and the full stats) is buffered and written in
+    batches of `snapshot_batch_size` rows to `scrapy_run_stats_snapshots`, so
+    a killed run still leaves its history behind. When the spider closes, the
+    remaining snapshots and the summary row in `scrapy_run_stats` are written.
+    Connections are only borrowed from the pool for each write.
+
+    With a `shard_output` path the process is one shard of a job started by
+    the launcher: its stats and latency histograms are written there as JSON
+    instead of the summary row, which the launcher inserts once for the job.
+    """
+
+    snapshot_query = """
+    INSERT INTO scrapy_run_stats_snapshots
+    (
+        job_id,
+        captured_at,
+        elapsed_time_seconds,
+        item_scraped_count,
+        response_received_count,
+        items_per_minute,
+        responses_per_minute,
+        error_count,
+        scheduler_queue_depth,
+        image_queue_depth,
+        upload_queue_depth,
+        stats
+    )
+    VALUES %s
+    """
+
+    def __init__(
+        self,
+        stats: StatsCollector,
+        postgres_service: PostgresService,
+        metrics: MetricsService,
+        snapshot_interval: float = 60,
+        snapshot_batch_size: int = 5,
+        shard_output: str | None = None,
+    ):
         self.postgres_service = postgres_service
-        self.conn = None
-        self.cursor = None
         self.stats: StatsCollector = stats
+        self.metrics = metrics
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_batch_size = snapshot_batch_size
+        self.shard_output = shard_output
+        self.snapshot_loop = task.LoopingCall(self.snapshot)
+        self.snapshot_writer = None
+        self.last_snapshot = None
 
     @classmethod
     def from_crawler(cls, crawler: Crawler) -> Self:
         assert crawler.stats
-
         settings = crawler.settings
-        postgres_service = PostgresService(
-            host=settings.get("POSTGRES_HOST"),
-            port=settings.get("POSTGRES_PORT"),
-            user=settings.get("POSTGRES_USER"),
-            password=settings.get("POSTGRES_PASSWORD"),
-            database=settings.get("POSTGRES_DB"),
-        )
 
-        o = cls(crawler.stats, postgres_service)
+        o = cls(
+            crawler.stats,
+            PostgresService.from_crawler(crawler),
+            MetricsService.from_crawler(crawler),
+            snapshot_interval=settings.getfloat("STATS_SNAPSHOT_INTERVAL"),
+            snapshot_batch_size=settings.getint("STATS_SNAPSHOT_BATCH_SIZE"),
+            shard_output=settings.get("STATS_SHARD_OUTPUT") or None,
+        )
         crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
         crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
 
@@ -45,49 +138,83 @@ class PostgresStatsExtension:
 
     def spider_opened(self, spider: Spider) -> None:
         try:
-            self.conn = self.postgres_service.connect()
-            self.cursor = self.conn.cursor()
+            with self.postgres_service.connection():
+                pass
             spider.logger.info("🟢 [PostgresStatsExtension] connection established")
         except psycopg2.Error as e:
             spider.logger.error(f"🔴 [PostgresStatsExtension] Error on connection: {e}")
             raise
 
-    def spider_closed(self, spider, reason):
-        spider.logger.info("👋 spider closed")
+        if self.snapshot_interval > 0:
+            self.snapshot_writer = PostgresBatchWriter(
+                postgres_service=self.postgres_service,
+                query=self.snapshot_query,
+                stats=self.stats,
+                stats_prefix="stats_snapshots",
+                logger=spider.logger,
+                batch_size=self.snapshot_batch_size,
+                # Batches are flushed by size; the interval bounds how long
+                # a snapshot may wait in memory
+                flush_interval=self.snapshot_interval * self.snapshot_batch_size,
+                metrics=self.metrics,
+            )
+            self.snapshot_writer.start()
+            self.snapshot_loop.start(self.snapshot_interval, now=False)
+
+    def snapshot(self) -> None:
         stats = self.stats.get_stats()
+        now = datetime.now(tz=UTC)
+        items = stats.get("item_scraped_count", 0)
+        responses = stats.get("response_received_count", 0)
 
-        try:
-            insert_query = """
-            INSERT INTO scrapy_run_stats
+        # Throughput since the previous snapshot (since the start for the first)
+        since, items_before, responses_before = self.last_snapshot or (
+            stats.get("start_time", now),
+            0,
+            0,
+        )
+        minutes = max((now - since).total_seconds(), 1) / 60
+        self.last_snapshot = (now, items, responses)
+
+        self.snapshot_writer.add(
             (
-                job_id,
-                started_at,
-                finished_at,
-                elapsed_time_seconds,
-                item_scraped_count,
-                finish_reason,
-                responses_per_minute,
-                items_per_minute,
-                stats
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-            self.cursor.execute(
-                insert_query,
-                (
-                    stats.get("job_id"),
-                    stats.get("start_time"),
-                    stats.get("finish_time"),
-                    stats.get("elapsed_time_seconds"),
-                    stats.get("item_scraped_count"),
-                    stats.get("finish_reason"),
-                    stats.get("responses_per_minute"),
-                    stats.get("items_per_minute"),
-                    json.dumps(stats, default=map_json),
-                ),
+                stats.get("job_id"),
+                now,
+                (now - stats.get("start_time", now)).total_seconds(),
+                items,
+                responses,
+                (items - items_before) / minutes,
+                (responses - responses_before) / minutes,
+                stats.get("log_count/ERROR", 0),
+                stats.get("scheduler/enqueued", 0) - stats.get("scheduler/dequeued", 0),
+                stats.get("image_processing/pending", 0),
+                stats.get("s3_uploader/queue_depth", 0),
+                json.dumps(stats, default=map_json),
             )
+        )
+
+    def spider_closed(self, spider, reason):
+        spider.logger.info("👋 spider closed")
+
+        finish = self.write_shard_output if self.shard_output else self.insert_summary
+
+        if self.snapshot_writer is None:
+            return threads.deferToThread(finish, spider)
+
+        if self.snapshot_loop.running:
+            self.snapshot_loop.stop()
+        self.snapshot()
 
-            self.conn.commit()
+        d = self.snapshot_writer.close()
+        d.addCallback(lambda _: threads.deferToThread(finish, spider))
+
+        return d
+
+    def insert_summary(self, spider):
+        stats = self.stats.get_stats()
+
+        try:
+            insert_run_summary(self.postgres_service, stats)
             spider.logger.info(
                 f"✅ [PostgresStatsExtension] Stats inserted/updated: {stats.get('job_id')}"
             )
@@ -95,10 +222,288 @@ class PostgresStatsExtension:
             spider.logger.error(
                 f"❌ [PostgresStatsExtension] Error on insert stats: {e}"
             )
-            self.conn.rollback()
-        finally:
-            if self.cursor:
-                self.cursor.close()
-            if self.conn:
-                self.conn.close()
-                spider.logger.info("🔴 [PostgresStatsExtension] connection closed")
+
+    def write_shard_output(self, spider):
+        """Leave the stats and histograms of this shard for the launcher."""
+        output = {
+            "stats": self.stats.get_stats(),
+            "histograms": {
+                stage: histogram.state()
+                for stage, histogram in self.metrics.histograms.items()
+            },
+        }
+        directory = os.path.dirname(self.shard_output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.shard_output, "w") as file:
+            json.dump(output, file, default=map_json)
+
+        spider.logger.info(
+            f"✅ [PostgresStatsExtension] Shard stats written to {self.shard_output}"
+        )
+
+
+def host_load() -> float:
+    """1 minute load average per CPU of the host running the browser."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return 0
+
+
+def host_memory_available() -> float:
+    """Fraction of the host memory still available, 1 when unknown."""
+    try:
+        with open("/proc/meminfo") as file:
+            meminfo = {
+                line.split(":")[0]: int(line.split()[1]) for line in file if ":" in line
+            }
+    except (OSError, ValueError, IndexError):
+        return 1
+
+    if not meminfo.get("MemTotal") or "MemAvailable" not in meminfo:
+        return 1
+
+    return meminfo["MemAvailable"] / meminfo["MemTotal"]
+
+
+class AdaptiveConcurrencyExtension:
+    """Tune the downloader slots to what the browser host can sustain.
+
+    Every `interval` seconds the concurrency and delay of every downloader
+    slot are adjusted from the signals seen since the previous tick
+    (additive increase, multiplicative decrease):
+
+        blocked: a 429 response or a response landing on a consent/captcha
+            page. Concurrency drops to `min_concurrency` and the delay doubles.
+        latency: mean render latency above `target_latency`.
+        load: host load average per CPU above `max_load`.
+        memory: available host memory below `min_memory_available`.
+        image_queue: the image-processing pool has `max_pending` screenshots.
+
+    Any of the last four halves the concurrency and doubles the delay. A tick
+    without pressure and with at least one response adds one to the
+    concurrency, up to `max_concurrency`, and halves the delay down to
+    `min_delay`.
+    """
+
+    def __init__(
+        self,
+        crawler: Crawler,
+        image_processing_service: ImageProcessingService,
+        interval: float,
+        min_concurrency: int,
+        max_concurrency: int,
+        min_delay: float,
+        max_delay: float,
+        target_latency: float,
+        max_load: float,
+        min_memory_available: float,
+        block_url_patterns: list[str],
+    ):
+        self.crawler = crawler
+        self.stats: StatsCollector = crawler.stats
+        self.image_processing_service = image_processing_service
+        self.interval = interval
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.max_load = max_load
+        self.min_memory_available = min_memory_available
+        self.block_url_pattern = re.compile("|".join(block_url_patterns))
+
+        self.concurrency = crawler.settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN")
+        self.delay = crawler.settings.getfloat("DOWNLOAD_DELAY")
+        self.latencies = []
+        self.blocked = 0
+        self.loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_CONCURRENCY_ENABLED"):
+            raise NotConfigured
+
+        o = cls(
+            crawler=crawler,
+            image_processing_service=ImageProcessingService.from_crawler(crawler),
+            interval=settings.getfloat("ADAPTIVE_CONCURRENCY_INTERVAL"),
+            min_concurrency=settings.getint("ADAPTIVE_CONCURRENCY_MIN"),
+            max_concurrency=settings.getint("ADAPTIVE_CONCURRENCY_MAX"),
+            min_delay=settings.getfloat("ADAPTIVE_CONCURRENCY_MIN_DELAY"),
+            max_delay=settings.getfloat("ADAPTIVE_CONCURRENCY_MAX_DELAY"),
+            target_latency=settings.getfloat("ADAPTIVE_CONCURRENCY_TARGET_LATENCY"),
+            max_load=settings.getfloat("ADAPTIVE_CONCURRENCY_MAX_LOAD"),
+            min_memory_available=settings.getfloat(
+                "ADAPTIVE_CONCURRENCY_MIN_MEMORY_AVAILABLE"
+            ),
+            block_url_patterns=settings.getlist(
+                "ADAPTIVE_CONCURRENCY_BLOCK_URL_PATTERNS"
+            ),
+        )
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.response_received, signal=signals.response_received)
+
+        return o
+
+    def spider_opened(self, spider: Spider) -> None:
+        self.loop = task.LoopingCall(self.adjust)
+        self.loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider: Spider, reason) -> None:
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def response_received(self, response, request, spider: Spider) -> None:
+        if "download_latency" in request.meta:
+            self.latencies.append(request.meta["download_latency"])
+
+        if response.status == 429 or self.block_url_pattern.search(response.url):
+            self.blocked += 1
+            self.stats.inc_value("adaptive_concurrency/blocked")
+
+    def pressure(self) -> str | None:
+        """Name of the first signal asking to back off, None when healthy."""
+        if self.blocked:
+            return "blocked"
+
+        if (
+            self.latencies
+            and sum(self.latencies) / len(self.latencies) > self.target_latency
+        ):
+            return "latency"
+
+        if host_load() > self.max_load:
+            return "load"
+
+        if host_memory_available() < self.min_memory_available:
+            return "memory"
+
+        service = self.image_processing_service
+        if service.pending >= service.max_pending:
+            return "image_queue"
+
+        return None
+
+    def adjust(self) -> None:
+        reason = self.pressure()
+
+        if reason == "blocked":
+            self.concurrency = self.min_concurrency
+            self.delay = min(self.max_delay, max(self.delay * 2, 1))
+        elif reason is not None:
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.delay = min(self.max_delay, max(self.delay * 2, 0.5))
+        elif self.latencies:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            # Snap tiny delays to the minimum instead of halving forever
+            delay = self.delay / 2 if self.delay > 0.1 else 0
+            self.delay = max(self.min_delay, delay)
+
+        if reason is not None:
+            self.stats.inc_value(f"adaptive_concurrency/backoff/{reason}")
+
+        self.latencies.clear()
+        self.blocked = 0
+
+        for slot in self.crawler.engine.downloader.slots.values():
+            slot.concurrency = self.concurrency
+            slot.delay = self.delay
+
+        self.stats.set_value("adaptive_concurrency/concurrency", self.concurrency)
+        self.stats.set_value("adaptive_concurrency/delay", self.delay)
+        self.stats.max_value("adaptive_concurrency/concurrency/max", self.concurrency)
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics: MetricsService, stats: StatsCollector):
+        super().__init__()
+        self.metrics = metrics
+        self.stats = stats
+
+    def render_GET(self, request):
+        self.metrics.publish()
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+
+        return render_prometheus(
+            self.metrics.histograms, self.stats.get_stats()
+        ).encode()
+
+
+class MetricsExtension:
+    """Publish the stage latency percentiles and serve them live.
+
+    Percentiles are written to the crawler stats every `publish_interval`
+    seconds and when the spider closes (before the stats are stored). With a
+    `port`, histograms and numeric stats are served in the Prometheus text
+    format on http://{host}:{port}/metrics while the crawl runs.
+    """
+
+    def __init__(
+        self,
+        stats: StatsCollector,
+        metrics: MetricsService,
+        publish_interval: float,
+        host: str,
+        port: int,
+    ):
+        self.stats = stats
+        self.metrics = metrics
+        self.publish_interval = publish_interval
+        self.host = host
+        self.port = port
+        self.loop = task.LoopingCall(metrics.publish)
+        self.listening_port = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+
+        o = cls(
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            publish_interval=settings.getfloat("METRICS_PUBLISH_INTERVAL"),
+            host=settings.get("METRICS_HOST"),
+            port=settings.getint("METRICS_PORT"),
+        )
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+
+        return o
+
+    def spider_opened(self, spider: Spider) -> None:
+        from twisted.internet import reactor
+
+        self.loop.start(self.publish_interval, now=False)
+
+        if not self.port:
+            return
+
+        root = resource.Resource()
+        root.putChild(b"metrics", MetricsResource(self.metrics, self.stats))
+        try:
+            self.listening_port = reactor.listenTCP(
+                self.port, server.Site(root), interface=self.host
+            )
+        except error.CannotListenError as e:
+            spider.logger.warning(f"🟠 [MetricsExtension] Metrics not served: {e}")
+            return
+
+        spider.logger.info(
+            f"📈 [MetricsExtension] Serving http://{self.host}:{self.port}/metrics"
+        )
+
+    def spider_closed(self, spider: Spider, reason) -> None:
+        if self.loop.running:
+            self.loop.stop()
+
+        self.metrics.publish()
+
+        if self.listening_port is not None:
+            return self.listening_port.stopListening()
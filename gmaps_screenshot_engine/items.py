@@ -9,4 +9,7 @@ class ScreenshotItem(scrapy.Item):
     file_path = scrapy.Field()
     size = scrapy.Field()
     job_id = scrapy.Field()
+    content_hash = scrapy.Field()
+    reference_file_path = scrapy.Field()
+    capture_wait_seconds = scrapy.Field()
     captured_at = scrapy.Field(default=datetime.now())
@@ -0,0 +1,315 @@
+"""Run one capture job as several crawler processes.
+
+Each worker is a `scrapy crawl` of the same spider and `job_id` with
+`-a shard=i/N`, so it only captures the targets whose `id % N == i`: the
+targets are split without a shared queue and the workers never overlap.
+Rendering, image processing and uploads then use every core instead of the
+single one a Twisted reactor runs on.
+
+Workers write their stats and latency histograms to a JSON file instead of
+the `scrapy_run_stats` row; once all of them exit, the launcher merges the
+files and inserts a single row for the job.
+
+Usage:
+    python -m gmaps_screenshot_engine.launcher --workers 4 [--job-id ID]
+        [-a NAME=VALUE] [-s KEY=VALUE]
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import uuid
+from datetime import datetime
+
+import psycopg2
+from scrapy.utils.project import get_project_settings
+
+from gmaps_screenshot_engine.extensions import insert_run_summary
+from gmaps_screenshot_engine.metrics import LatencyHistogram
+from gmaps_screenshot_engine.services import MetricsService, PostgresService
+
+logger = logging.getLogger(__name__)
+
+SPIDER_NAME = "gmaps-screenshot-spider"
+# Stats that describe one shard and make no sense for the whole job
+SHARD_ONLY_STATS = ("shard",)
+# Gauges, the value of one worker when it stopped: the job keeps the highest
+MAX_STATS = (
+    "memory_budget/in_use",
+    "image_processing/pending",
+    "s3_uploader/queue_depth",
+    "memusage/startup",
+)
+MAX_STATS_SUFFIXES = ("/max", "/batch_size")
+# Gauges every worker tunes on its own: the job keeps their mean
+MEAN_STATS = (
+    "adaptive_concurrency/concurrency",
+    "adaptive_concurrency/delay",
+)
+# Ratios, computed again from the added up counters (numerator, denominator)
+RATIO_STATS = {
+    "browser_cache/hit_ratio": ("browser_cache/hits", "browser_cache/requests"),
+}
+# Rates over the wall time of the job, computed again from the added up
+# counters
+WALL_TIME_RATE_STATS = {
+    "s3_uploader/bytes_per_second": "s3_uploader/bytes",
+}
+
+
+def parse_pairs(pairs: list[str], option: str) -> dict[str, str]:
+    parsed = {}
+    for pair in pairs:
+        key, separator, value = pair.partition("=")
+        if not separator:
+            raise SystemExit(f"{option} expects NAME=VALUE, got {pair!r}")
+        parsed[key] = value
+
+    return parsed
+
+
+def worker_settings(settings, workers: int, index: int, overrides: dict) -> dict:
+    """Settings of one worker: the per-host budgets are split between them."""
+    values = {}
+
+    cpu_workers = settings.getint("IMAGE_PROCESSING_MAX_WORKERS") or os.cpu_count()
+    values["IMAGE_PROCESSING_MAX_WORKERS"] = max(cpu_workers // workers, 1)
+
+    memory_budget = settings.getint("IMAGE_MEMORY_BUDGET")
+    if memory_budget:
+        values["IMAGE_MEMORY_BUDGET"] = max(memory_budget // workers, 1)
+
+    # One metrics endpoint per worker, on consecutive ports
+    metrics_port = settings.getint("METRICS_PORT")
+    if metrics_port:
+        values["METRICS_PORT"] = metrics_port + index
+
+    values.update(overrides)
+
+    return values
+
+
+def crawl_command(
+    job_id: str,
+    workers: int,
+    index: int,
+    arguments: dict,
+    settings: dict,
+    shard_output: str,
+) -> list[str]:
+    command = [sys.executable, "-m", "scrapy", "crawl", SPIDER_NAME]
+    arguments = {**arguments, "job_id": job_id, "shard": f"{index}/{workers}"}
+    settings = {**settings, "STATS_SHARD_OUTPUT": shard_output}
+
+    for name, value in arguments.items():
+        command += ["-a", f"{name}={value}"]
+    for key, value in settings.items():
+        command += ["-s", f"{key}={value}"]
+
+    return command
+
+
+def parse_time(value) -> datetime | None:
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+
+    return value
+
+
+def merge_shard_stats(shards: list[dict]) -> dict:
+    """Merge the outputs of the workers into the stats of the whole job.
+
+    - Counters (any number not listed below) are added up.
+    - `*/max` and `*/batch_size` stats and the gauges of `MAX_STATS` keep
+      the highest value, the gauges of `MEAN_STATS` the mean of the workers.
+    - `RATIO_STATS` are computed again from their added up counters.
+    - The run lasts from the earliest start to the latest finish;
+      `elapsed_time_seconds`, the per minute throughput and the
+      `WALL_TIME_RATE_STATS` are computed again from it (they are left out
+      when the workers did not record their start and finish).
+    - `latency/*/count` and `latency/*/seconds` are added up; the
+      percentiles and the max are computed again from the merged
+      histograms (the highest value is kept for a stage without histogram).
+    - A text stat is kept when every worker agrees on it, otherwise its
+      distinct values are joined.
+    """
+    stats = {}
+    texts = {}
+    means = {}
+
+    for shard in shards:
+        for key, value in shard["stats"].items():
+            if key in SHARD_ONLY_STATS:
+                continue
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                if isinstance(value, str) and parse_time(value) is None:
+                    texts.setdefault(key, [])
+                    if value not in texts[key]:
+                        texts[key].append(value)
+                else:
+                    stats.setdefault(key, value)
+            elif (
+                key in MAX_STATS
+                or key.endswith(MAX_STATS_SUFFIXES)
+                or (
+                    key.startswith("latency/")
+                    and key.rsplit("/", 1)[-1] in MetricsService.PERCENTILES
+                )
+                or key == "elapsed_time_seconds"
+            ):
+                stats[key] = max(stats.get(key, value), value)
+            elif key in MEAN_STATS:
+                means.setdefault(key, []).append(value)
+            else:
+                stats[key] = stats.get(key, 0) + value
+
+    for key, values in texts.items():
+        stats[key] = ",".join(values)
+
+    for key, values in means.items():
+        stats[key] = sum(values) / len(values)
+
+    for key, (numerator, denominator) in RATIO_STATS.items():
+        if key in stats:
+            stats[key] = (
+                stats.get(numerator, 0) / stats[denominator]
+                if stats.get(denominator)
+                else 0
+            )
+
+    start_times = [parse_time(shard["stats"].get("start_time")) for shard in shards]
+    finish_times = [parse_time(shard["stats"].get("finish_time")) for shard in shards]
+    start_times = [value for value in start_times if value]
+    finish_times = [value for value in finish_times if value]
+
+    if start_times and finish_times:
+        stats["start_time"] = min(start_times)
+        stats["finish_time"] = max(finish_times)
+        elapsed = (stats["finish_time"] - stats["start_time"]).total_seconds()
+        stats["elapsed_time_seconds"] = elapsed
+        minutes = elapsed / 60 or 1
+        stats["items_per_minute"] = stats.get("item_scraped_count", 0) / minutes
+        stats["responses_per_minute"] = (
+            stats.get("response_received_count", 0) / minutes
+        )
+        for key, counter in WALL_TIME_RATE_STATS.items():
+            if key in stats:
+                stats[key] = stats.get(counter, 0) / (elapsed or 1)
+    else:
+        for key in WALL_TIME_RATE_STATS:
+            stats.pop(key, None)
+
+    histograms = {}
+    for shard in shards:
+        for stage, state in shard.get("histograms", {}).items():
+            histogram = LatencyHistogram.from_state(state)
+            if stage in histograms:
+                histograms[stage].merge(histogram)
+            else:
+                histograms[stage] = histogram
+
+    for stage, histogram in histograms.items():
+        for name, fraction in MetricsService.PERCENTILES.items():
+            stats[f"latency/{stage}/{name}"] = histogram.percentile(fraction)
+        stats[f"latency/{stage}/max"] = histogram.max
+
+    stats["shards"] = len(shards)
+
+    return stats
+
+
+def run(args) -> int:
+    settings = get_project_settings()
+    job_id = args.job_id or str(uuid.uuid4())
+    arguments = parse_pairs(args.argument, "-a")
+    overrides = parse_pairs(args.set, "-s")
+    output_dir = tempfile.mkdtemp(prefix=f"shards-{job_id}-", dir=args.output_dir)
+
+    processes = []
+    for index in range(args.workers):
+        shard_output = os.path.join(output_dir, f"shard-{index}.json")
+        command = crawl_command(
+            job_id,
+            args.workers,
+            index,
+            arguments,
+            worker_settings(settings, args.workers, index, overrides),
+            shard_output,
+        )
+        # In their own session, so a Ctrl+C reaches every worker only once
+        processes.append(
+            (shard_output, subprocess.Popen(command, start_new_session=True))
+        )
+
+    logger.info(f"🧩 Started {args.workers} workers for job {job_id}")
+
+    def forward(signum, frame):
+        logger.info(f"🛑 Forwarding {signal.Signals(signum).name} to the workers")
+        for _, process in processes:
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    return_codes = [process.wait() for _, process in processes]
+
+    shards = []
+    for shard_output, _ in processes:
+        try:
+            with open(shard_output) as file:
+                shards.append(json.load(file))
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Missing stats of a worker: {e}")
+
+    if not shards:
+        logger.error(f"❌ No worker of job {job_id} left its stats")
+        return max(return_codes) or 1
+
+    stats = merge_shard_stats(shards)
+    stats["shards_failed"] = args.workers - len(shards)
+
+    try:
+        insert_run_summary(PostgresService.from_settings(settings), stats)
+        logger.info(f"✅ Stats inserted: {job_id}")
+    except psycopg2.Error as e:
+        logger.error(f"❌ Error on insert stats: {e}")
+        return max(return_codes) or 1
+
+    for shard_output, _ in processes:
+        os.unlink(shard_output)
+    os.rmdir(output_dir)
+
+    return max(return_codes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--job-id", default=None)
+    parser.add_argument(
+        "-a", dest="argument", action="append", default=[], help="Spider argument"
+    )
+    parser.add_argument(
+        "-s", dest="set", action="append", default=[], help="Setting of every worker"
+    )
+    parser.add_argument(
+        "--output-dir", default=None, help="Where the workers leave their stats"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,97 +3,146 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import asyncio
+import time
 
-# useful for handling different item types with a single interface
+from scrapy.exceptions import IgnoreRequest
+from twisted.internet import threads
 
+from gmaps_screenshot_engine.capture import CaptureFailure, CaptureRetryService
+from gmaps_screenshot_engine.services import (
+    MemoryBudgetService,
+    PlaywrightPagePoolService,
+)
 
-class GmapsScreenshotEngineSpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
+
+class CaptureFailureDownloaderMiddleware:
+    """Classify failed navigations, then retry them or fail fast.
+
+    Timeouts, 429s, consent walls, captchas and other download errors are
+    handed to `CaptureRetryService`. The page of the failed attempt is always
+    given back to the pool (and closed) first, so nothing leaks whatever the
+    outcome.
+    Retries wait for their backoff here, before a page is assigned to them.
+    """
+
+    def __init__(
+        self, retry_service: CaptureRetryService, page_pool: PlaywrightPagePoolService
+    ):
+        self.retry_service = retry_service
+        self.page_pool = page_pool
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
+        return cls(
+            CaptureRetryService.from_crawler(crawler),
+            PlaywrightPagePoolService.from_crawler(crawler),
+        )
+
+    async def process_request(self, request, spider):
+        delay = request.meta.get("capture_retry_not_before", 0) - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def process_response(self, request, response, spider):
+        reason = self.retry_service.classify_response(response)
+        if reason is None:
+            return response
+
+        return await self._retry_or_ignore(request, reason, spider)
 
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
+    async def process_exception(self, request, exception, spider):
+        reason = self.retry_service.classify_exception(exception)
+        if reason is None:
+            return None
 
-        # Should return None or raise an exception.
-        return None
+        return await self._retry_or_ignore(request, reason, spider)
 
-    def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
+    async def _retry_or_ignore(self, request, reason, spider):
+        # Popped so the spider errback does not release the page again
+        page = request.meta.pop("playwright_page", None)
+        if page is not None:
+            await self.page_pool.release(
+                page, failed=True, context_name=request.meta.get("playwright_context")
+            )
 
-        # Must return an iterable of Request, or item objects.
-        for i in result:
-            yield i
+        retry = self.retry_service.retry(request, reason)
+        if retry is None:
+            # Read by the spider errback, to requeue or drop a leased target
+            request.meta["capture_failure_reason"] = reason
+            raise IgnoreRequest(f"Capture failed ({reason}): {request.url}")
+
+        spider.logger.info(f"🔁 Retrying ({reason}) {request.url}")
+        return retry
+
+
+class CaptureFailureSpiderMiddleware:
+    """Retry or drop targets whose capture failed inside the callback.
+
+    `CaptureFailure` raised by `parse` (e.g. a blank frame) goes through the
+    same retry policy as navigation failures. When giving up, a target
+    leased from the distributed queue is handed back to it, or dropped from
+    it when the failure is not worth retrying.
+    """
+
+    def __init__(self, retry_service: CaptureRetryService):
+        self.retry_service = retry_service
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(CaptureRetryService.from_crawler(crawler))
 
     def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
+        if not isinstance(exception, CaptureFailure):
+            return None
+
+        retry = self.retry_service.retry(response.request, exception.reason)
+        if retry is not None:
+            spider.logger.info(f"🔁 Retrying ({exception.reason}) {response.url}")
+            return [retry]
+
+        payload = response.meta.get("target_queue_payload")
+        if payload and getattr(spider, "target_queue", None) is not None:
+            threads.deferToThread(
+                spider.target_queue.nack
+                if self.retry_service.retryable(exception.reason)
+                else spider.target_queue.drop,
+                payload,
+            )
+
+        spider.logger.error(f"❌ Giving up on {response.url}: {exception}")
+        return []
+
 
-        # Should return either None or an iterable of Request or item objects.
-        pass
+class MemoryBudgetDownloaderMiddleware:
+    """Hold new captures while screenshots in flight exceed the memory budget.
+
+    Waiting requests stay active in the downloader, so the engine stops
+    scheduling more until image processing frees memory.
+    """
+
+    def __init__(self, memory_budget: MemoryBudgetService):
+        self.memory_budget = memory_budget
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(MemoryBudgetService.from_crawler(crawler))
 
-    async def process_start(self, start):
-        # Called with an async iterator over the spider start() method or the
-        # maching method of an earlier spider middleware.
-        async for item_or_request in start:
-            yield item_or_request
+    async def process_request(self, request, spider):
+        if request.meta.get("playwright"):
+            await self.memory_budget.wait()
 
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
 
+class PlaywrightPagePoolMiddleware:
+    """Hand warm pages from the crawler page pool to Playwright requests."""
 
-class GmapsScreenshotEngineDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    def __init__(self, page_pool: PlaywrightPagePoolService):
+        self.page_pool = page_pool
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
+        return cls(PlaywrightPagePoolService.from_crawler(crawler))
 
     def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
-        return None
-
-    def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
-
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
-        return response
-
-    def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
-
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
-
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
+        if request.meta.get("playwright") and "playwright_page" not in request.meta:
+            self.page_pool.assign(request)
@@ -1,5 +1,5 @@
-from typing import Optional, Dict, Any
 from datetime import datetime
+from typing import Any
 
 from pydantic import BaseModel
 
@@ -7,16 +7,65 @@ from pydantic import BaseModel
 class TargetLocationModel(BaseModel):
     id: int
     name: str
-    description: Optional[str] = None
+    description: str | None = None
     folder: str
-    address: Optional[str] = None
-    link: Optional[str] = None
+    address: str | None = None
+    link: str | None = None
     latitude: float
     longitude: float
 
     gmaps_zoom: int
-    gmaps_extra_params: Optional[Dict[str, Any]] = None
+    gmaps_extra_params: dict[str, Any] | None = None
+    refresh_interval_minutes: int | None = None
 
     active: bool
-    created_at: Optional[datetime] = None
-    updated_at: Optional[datetime] = None
+    created_at: datetime | None = None
+    updated_at: datetime | None = None
+
+    last_content_hash: str | None = None
+    last_file_path: str | None = None
+
+
+class TargetBatchModel(BaseModel):
+    # Location the batch viewport is centered on
+    center: TargetLocationModel
+    targets: list[TargetLocationModel]
+    # Viewport sized region of every target inside the batch viewport (empty
+    # for a batch of one, captured as a plain target)
+    regions: list[dict[str, float]]
+
+
+class DeltaModel(BaseModel):
+    # Full frame to store, instead of the changed blocks
+    keyframe: bool
+    # Block signatures the reader will see once this capture is stored
+    signature: str
+    # Indexes of the changed blocks, packed in `atlas` (a JPEG) in order
+    blocks: list[int] = []
+    atlas: bytes = b""
+    seconds: float = 0
+
+
+class ProcessedImageModel(BaseModel):
+    body: bytes
+    width: int
+    height: int
+    content_hash: str
+    # Why the frame was rejected by the validator, None when it is usable
+    rejection: str | None = None
+    # Most memory held by the screenshot and its decoded images, in bytes
+    peak_bytes: int = 0
+    # Changed blocks against the previous capture (delta storage)
+    delta: DeltaModel | None = None
+
+    compress_seconds: float
+    validation_seconds: float = 0
+    encode_seconds: float
+    hash_seconds: float
+
+
+class CaptureModel(BaseModel):
+    image_bytes: bytes
+    image_format: str
+    wait_seconds: float
+    ready: bool
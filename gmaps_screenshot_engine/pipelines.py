@@ -1,34 +1,53 @@
 import psycopg2
 from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
 
-from gmaps_screenshot_engine.services import PostgresService
+from gmaps_screenshot_engine.services import (
+    MetricsService,
+    PostgresBatchWriter,
+    PostgresService,
+)
 
 
 class GmapsScreenshotsPostgresExportPipeline:
-    def __init__(self, postgres_service):
+    insert_query = """
+    INSERT INTO gmaps_screenshots (
+        target_location_id,
+        parent_folder,
+        file_path,
+        size,
+        job_id,
+        content_hash,
+        reference_file_path
+    )
+    VALUES %s
+    ON CONFLICT (file_path) DO NOTHING;
+    """
+
+    def __init__(self, postgres_service, stats, metrics, batch_size, flush_interval):
         self.postgres_service = postgres_service
-        self.conn = None
-        self.cursor = None
+        self.stats = stats
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writer = None
 
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
-        postgres_service = PostgresService(
-            host=settings.get("POSTGRES_HOST"),
-            port=settings.get("POSTGRES_PORT"),
-            user=settings.get("POSTGRES_USER"),
-            password=settings.get("POSTGRES_PASSWORD"),
-            database=settings.get("POSTGRES_DB"),
-        )
 
         return cls(
-            postgres_service=postgres_service,
+            postgres_service=PostgresService.from_crawler(crawler),
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            batch_size=settings.getint("POSTGRES_BATCH_SIZE"),
+            flush_interval=settings.getfloat("POSTGRES_BATCH_FLUSH_INTERVAL"),
         )
 
     def open_spider(self, spider):
         try:
-            self.conn = self.postgres_service.connect()
-            self.cursor = self.conn.cursor()
+            with self.postgres_service.connection():
+                pass
             spider.logger.info(
                 "🟢 [GmapsScreenshotsPostgresExportPipeline] connection established"
             )
@@ -38,51 +57,99 @@ class GmapsScreenshotsPostgresExportPipeline:
             )
             raise
 
+        self.writer = PostgresBatchWriter(
+            postgres_service=self.postgres_service,
+            query=self.insert_query,
+            stats=self.stats,
+            stats_prefix="postgres_export",
+            logger=spider.logger,
+            batch_size=self.batch_size,
+            flush_interval=self.flush_interval,
+            metrics=self.metrics,
+        )
+        self.writer.start()
+
     def process_item(self, item, spider):
-        try:
-            adapter = ItemAdapter(item)
-
-            insert_query = """
-            INSERT INTO gmaps_screenshots (
-                target_location_id,
-                parent_folder,
-                file_path,
-                size,
-                job_id
-            )
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (file_path) DO NOTHING;
-            """
-
-            self.cursor.execute(
-                insert_query,
-                (
-                    adapter.get("target_location_id"),
-                    adapter.get("parent_folder"),
-                    adapter.get("file_path"),
-                    adapter.get("size"),
-                    adapter.get("job_id"),
-                ),
-            )
+        adapter = ItemAdapter(item)
 
-            self.conn.commit()
-            spider.logger.info(
-                f"✅ [GmapsScreenshotsPostgresExportPipeline] Item inserted/updated: {adapter.get('file_path')}"
+        flushed = self.writer.add(
+            (
+                adapter.get("target_location_id"),
+                adapter.get("parent_folder"),
+                adapter.get("file_path"),
+                adapter.get("size"),
+                adapter.get("job_id"),
+                adapter.get("content_hash"),
+                adapter.get("reference_file_path"),
             )
+        )
 
-        except psycopg2.Error as e:
-            spider.logger.error(
-                f"❌ [GmapsScreenshotsPostgresExportPipeline] Error on insert item: {e}"
-            )
-            self.conn.rollback()
+        # A full batch holds the item until it is written, so a slow database
+        # applies backpressure instead of growing the buffer without bound.
+        if flushed is not None:
+            return flushed.addCallback(lambda _: item)
 
         return item
 
     def close_spider(self, spider):
-        if self.cursor:
-            self.cursor.close()
-        if self.conn:
-            self.conn.close()
-            spider.logger.info(
-                "🔴 [GmapsScreenshotsPostgresExportPipeline] connection closed"
-            )
+        return self.writer.close()
+
+
+class JobCheckpointPipeline:
+    """Record the targets a job has completed, so a resumed run skips them.
+
+    Rows are written in batches; a crash loses at most the last unflushed
+    batch, whose targets are captured again on resume.
+    """
+
+    insert_query = """
+    INSERT INTO job_checkpoints (job_id, target_location_id)
+    VALUES %s
+    ON CONFLICT (job_id, target_location_id) DO NOTHING;
+    """
+
+    def __init__(self, postgres_service, stats, metrics, batch_size, flush_interval):
+        self.postgres_service = postgres_service
+        self.stats = stats
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writer = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("JOB_CHECKPOINT_ENABLED"):
+            raise NotConfigured
+
+        return cls(
+            postgres_service=PostgresService.from_crawler(crawler),
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            batch_size=settings.getint("JOB_CHECKPOINT_BATCH_SIZE"),
+            flush_interval=settings.getfloat("JOB_CHECKPOINT_FLUSH_INTERVAL"),
+        )
+
+    def open_spider(self, spider):
+        self.writer = PostgresBatchWriter(
+            postgres_service=self.postgres_service,
+            query=self.insert_query,
+            stats=self.stats,
+            stats_prefix="job_checkpoints",
+            logger=spider.logger,
+            batch_size=self.batch_size,
+            flush_interval=self.flush_interval,
+            metrics=self.metrics,
+        )
+        self.writer.start()
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+
+        # The item is not held back: losing a checkpoint only costs a capture
+        self.writer.add((adapter.get("job_id"), adapter.get("target_location_id")))
+
+        return item
+
+    def close_spider(self, spider):
+        return self.writer.close()
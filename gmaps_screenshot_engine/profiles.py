@@ -0,0 +1,129 @@
+import fcntl
+import os
+import shutil
+import time
+from contextlib import suppress
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            with suppress(OSError):
+                total += os.lstat(os.path.join(directory, name)).st_size
+
+    return total
+
+
+class BrowserProfileStore:
+    """Browser profiles (and their disk cache) kept on a shared volume.
+
+    The store holds `slots` profile directories. A browser profile can only
+    be used by one browser at a time, so each crawler claims free slots with
+    an exclusive `flock` on `slot-{i}.lock`; the locks are held until the
+    process exits, after its browsers are gone. Crawlers finding no free slot
+    run with a throwaway profile.
+
+    The mtime of a lock file is the last use of its slot. When slots are
+    claimed, every slot that is not in use is evicted (its profile deleted)
+    once older than `max_age` seconds, then least recently used first while
+    the store holds more than `max_bytes`.
+    """
+
+    def __init__(self, root: str, slots: int, max_bytes: int, max_age: float):
+        self.root = root
+        self.slots = slots
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.claimed = {}
+
+    def profile_path(self, slot: int) -> str:
+        return os.path.join(self.root, f"slot-{slot}")
+
+    def _lock(self, slot: int) -> int | None:
+        """Exclusive lock on a slot, None when another process holds it."""
+        fd = os.open(
+            os.path.join(self.root, f"slot-{slot}.lock"), os.O_CREAT | os.O_RDWR
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        return fd
+
+    def claim(self, count: int) -> list[str]:
+        """Claim up to `count` free slots; returns their profile directories."""
+        os.makedirs(self.root, exist_ok=True)
+
+        for slot in range(self.slots):
+            if len(self.claimed) >= count:
+                break
+            if slot in self.claimed:
+                continue
+
+            fd = self._lock(slot)
+            if fd is not None:
+                self.claimed[slot] = fd
+
+        return [self.profile_path(slot) for slot in self.claimed]
+
+    def touch(self):
+        """Mark the claimed slots as used now."""
+        for fd in self.claimed.values():
+            os.utime(fd)
+
+    def evict(self) -> dict[str, int]:
+        """Evict stale slots, then the least recently used ones over budget.
+
+        Only the slots claimed by this store or free ones are evicted. Returns
+        the number of slots evicted by age and by size, and the bytes freed.
+        """
+        result = {"age": 0, "size": 0, "bytes": 0}
+        now = time.time()
+        # Slots in use by other crawlers count against the budget too
+        in_use_bytes = 0
+        slots = []
+        locked = []
+
+        try:
+            for slot in range(self.slots):
+                path = self.profile_path(slot)
+                fd = self.claimed.get(slot)
+                if fd is None:
+                    fd = self._lock(slot)
+                    if fd is None:
+                        in_use_bytes += directory_size(path)
+                        continue
+                    locked.append(fd)
+
+                if not os.path.isdir(path):
+                    continue
+
+                size = directory_size(path)
+                last_used = os.fstat(fd).st_mtime
+                if self.max_age and now - last_used > self.max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+                    result["age"] += 1
+                    result["bytes"] += size
+                    continue
+
+                slots.append((last_used, size, path))
+
+            total = in_use_bytes + sum(size for _, size, _ in slots)
+            for _, size, path in sorted(slots):
+                if not self.max_bytes or total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                result["size"] += 1
+                result["bytes"] += size
+        finally:
+            for fd in locked:
+                os.close(fd)
+
+        return result
+
+    def size(self) -> int:
+        return sum(directory_size(self.profile_path(slot)) for slot in self.claimed)
@@ -0,0 +1,210 @@
+import json
+import time
+import uuid
+from collections.abc import Iterable
+from typing import Self
+
+import redis
+from scrapy.settings import Settings
+
+from gmaps_screenshot_engine.models import TargetLocationModel
+
+# Push a target unless it was already queued for this job.
+# KEYS: seen, pending | ARGV: target id, payload
+ENQUEUE_SCRIPT = """
+if redis.call("SADD", KEYS[1], ARGV[1]) == 1 then
+    redis.call("RPUSH", KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Requeue expired leases, each one counting as an attempt (targets out of
+# attempts go to failed), then lease the next pending target. Requeued
+# payloads keep the layout of `RedisTargetQueue._dump`.
+# KEYS: pending, leases, failed | ARGV: now, lease deadline, max attempts, ttl
+LEASE_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1], "LIMIT", 0, 100)
+local failed = 0
+for _, payload in ipairs(expired) do
+    redis.call("ZREM", KEYS[2], payload)
+    local data = cjson.decode(payload)
+    local attempts = data["attempts"] + 1
+    if attempts >= tonumber(ARGV[3]) then
+        redis.call("SADD", KEYS[3], tostring(data["target"]["id"]))
+        redis.call("EXPIRE", KEYS[3], ARGV[4])
+        failed = failed + 1
+    else
+        local start = string.find(payload, '"target": ', 1, true)
+        local target = string.sub(payload, start)
+        redis.call("RPUSH", KEYS[1], '{"attempts": ' .. attempts .. ', ' .. target)
+    end
+end
+local payload = redis.call("LPOP", KEYS[1])
+if payload then
+    redis.call("ZADD", KEYS[2], ARGV[2], payload)
+end
+return {payload or false, #expired, failed}
+"""
+
+
+class RedisTargetQueue:
+    """Work queue of target locations shared by every process of one job.
+
+    One process wins the seeder election and pushes the active targets; every
+    process (the seeder included) leases targets from the queue. A lease is
+    only a visibility timeout: targets leased by a worker that crashed are put
+    back in the queue once `lease_seconds` have passed without an ack, which
+    counts as a failed attempt. The
+    seeder lock expires after `seeder_lock_seconds` without progress, so
+    another process takes over if the seeder dies; re-seeding is harmless
+    because targets are deduplicated per job.
+
+    Keys, all under `gmaps_screenshot:{job_id}`:
+        seeder: id of the process seeding the queue, `done` once finished.
+        seen: ids of the targets already queued, for per-job deduplication.
+        pending: payloads waiting to be leased.
+        leases: leased payloads, scored by the lease deadline.
+        failed: ids of targets dropped after `max_attempts` attempts, or
+            after a failure that is not worth retrying.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        job_id: str,
+        lease_seconds: int,
+        max_attempts: int,
+        ttl_seconds: int,
+        seeder_lock_seconds: int = 60,
+    ):
+        self.client = client
+        self.job_id = job_id
+        self.lease_seconds = lease_seconds
+        self.seeder_lock_seconds = seeder_lock_seconds
+        self.max_attempts = max_attempts
+        self.ttl_seconds = ttl_seconds
+        self.worker_id = uuid.uuid4().hex
+
+        prefix = f"gmaps_screenshot:{job_id}"
+        self.seeder_key = f"{prefix}:seeder"
+        self.seen_key = f"{prefix}:seen"
+        self.pending_key = f"{prefix}:pending"
+        self.leases_key = f"{prefix}:leases"
+        self.failed_key = f"{prefix}:failed"
+
+        self.enqueue_script = client.register_script(ENQUEUE_SCRIPT)
+        self.lease_script = client.register_script(LEASE_SCRIPT)
+
+    @classmethod
+    def from_settings(cls, settings: Settings, job_id: str) -> Self:
+        return cls(
+            client=redis.Redis(
+                host=settings.get("REDIS_HOST"),
+                port=settings.getint("REDIS_PORT"),
+                password=settings.get("REDIS_PASSWORD") or None,
+            ),
+            job_id=job_id,
+            lease_seconds=settings.getint("TARGET_QUEUE_LEASE_SECONDS"),
+            max_attempts=settings.getint("TARGET_QUEUE_MAX_ATTEMPTS"),
+            ttl_seconds=settings.getint("TARGET_QUEUE_TTL_SECONDS"),
+            seeder_lock_seconds=settings.getint("TARGET_QUEUE_SEEDER_LOCK_SECONDS"),
+        )
+
+    def try_become_seeder(self) -> bool:
+        return bool(
+            self.client.set(
+                self.seeder_key, self.worker_id, nx=True, ex=self.seeder_lock_seconds
+            )
+        )
+
+    def seed(self, targets: Iterable[TargetLocationModel], batch_size: int = 500):
+        """Queue every target that was not queued yet for this job.
+
+        Returns:
+            int: Number of targets added to the queue.
+        """
+        added = 0
+        pipeline = self.client.pipeline(transaction=False)
+
+        for index, target in enumerate(targets, start=1):
+            self.enqueue_script(
+                keys=[self.seen_key, self.pending_key],
+                args=[target.id, self._dump(target, attempts=0)],
+                client=pipeline,
+            )
+            if index % batch_size == 0:
+                added += sum(pipeline.execute())
+                self.client.expire(self.seeder_key, self.seeder_lock_seconds)
+
+        added += sum(pipeline.execute())
+
+        for key in (self.seen_key, self.pending_key, self.leases_key):
+            self.client.expire(key, self.ttl_seconds)
+        self.client.set(self.seeder_key, "done", ex=self.ttl_seconds)
+
+        return added
+
+    def lease(self) -> tuple[TargetLocationModel, str] | tuple[None, None]:
+        """Lease the next target; returns (target, payload) or (None, None)."""
+        now = time.time()
+        payload, _, _ = self.lease_script(
+            keys=[self.pending_key, self.leases_key, self.failed_key],
+            args=[now, now + self.lease_seconds, self.max_attempts, self.ttl_seconds],
+        )
+        if not payload:
+            return None, None
+
+        data = json.loads(payload)
+        return TargetLocationModel(**data["target"]), payload
+
+    def ack(self, payload: str):
+        self.client.zrem(self.leases_key, payload)
+
+    def nack(self, payload: str) -> bool:
+        """Give a leased target back after a failure.
+
+        Returns:
+            bool: True if it was requeued, False if it ran out of attempts.
+        """
+        if not self.client.zrem(self.leases_key, payload):
+            # Lease already expired and the target was requeued by the reaper
+            return True
+
+        data = json.loads(payload)
+        attempts = data["attempts"] + 1
+        target = TargetLocationModel(**data["target"])
+
+        if attempts >= self.max_attempts:
+            self._fail(target)
+            return False
+
+        self.client.rpush(self.pending_key, self._dump(target, attempts=attempts))
+        return True
+
+    def drop(self, payload: str):
+        """Give up on a leased target without another attempt."""
+        if self.client.zrem(self.leases_key, payload):
+            self._fail(TargetLocationModel(**json.loads(payload)["target"]))
+
+    def _fail(self, target: TargetLocationModel):
+        pipeline = self.client.pipeline()
+        pipeline.sadd(self.failed_key, target.id)
+        pipeline.expire(self.failed_key, self.ttl_seconds)
+        pipeline.execute()
+
+    def is_finished(self) -> bool:
+        """Seeding is done and no target is pending or leased."""
+        pipeline = self.client.pipeline()
+        pipeline.get(self.seeder_key)
+        pipeline.llen(self.pending_key)
+        pipeline.zcard(self.leases_key)
+        seeder, pending, leased = pipeline.execute()
+
+        return seeder == b"done" and pending == 0 and leased == 0
+
+    def _dump(self, target: TargetLocationModel, attempts: int) -> str:
+        return json.dumps(
+            {"target": target.model_dump(mode="json"), "attempts": attempts},
+            sort_keys=True,
+        )
@@ -1,23 +1,173 @@
+import asyncio
+import hashlib
 import io
+import logging
+import multiprocessing
+import operator
 import os
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from typing import ClassVar, Self
 from urllib.parse import urlencode
+from weakref import WeakKeyDictionary
 
 import boto3
 import psycopg2
-from PIL import Image
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from PIL import Image, ImageChops
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from scrapy import signals
+from scrapy.crawler import Crawler
+from twisted.internet import defer, task, threads
 
-from gmaps_screenshot_engine.models import TargetLocationModel
+from gmaps_screenshot_engine.metrics import LatencyHistogram
+from gmaps_screenshot_engine.models import ProcessedImageModel, TargetLocationModel
+from gmaps_screenshot_engine.profiles import BrowserProfileStore
 
+logger = logging.getLogger(__name__)
 
-class PostgresService:
-    def __init__(self, host, port, user, password, database):
+# Parts sent in parallel by a single multipart upload
+S3_MULTIPART_CONCURRENCY = 4
+
+# Grey levels and their squares, to take histogram moments
+LEVELS = tuple(range(256))
+SQUARED_LEVELS = tuple(level * level for level in LEVELS)
+
+
+class CrawlerScopedService:
+    """Base class for services shared by every component of a crawler.
+
+    The first call to `from_crawler` builds the service, later calls return the
+    same instance. The service is closed when the engine stops.
+    """
+
+    _instances: WeakKeyDictionary
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instances = WeakKeyDictionary()
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> Self:
+        instance = cls._instances.get(crawler)
+        if instance is None:
+            instance = cls._instances[crawler] = cls.create(crawler)
+            crawler.signals.connect(instance.close, signal=signals.engine_stopped)
+
+        return instance
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MetricsService(CrawlerScopedService):
+    """Latency histograms of the capture stages, shared by the crawler.
+
+    Each observation adds to the `latency/{stage}/count` and
+    `latency/{stage}/seconds` stats right away; the `p50`, `p95`, `p99` and
+    `max` stats of every stage are refreshed by `publish`.
+    """
+
+    PERCENTILES: ClassVar[dict[str, float]] = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.histograms: dict[str, LatencyHistogram] = {}
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        return cls(stats=crawler.stats)
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, LatencyHistogram())
+
+        histogram.observe(seconds)
+        self.stats.inc_value(f"latency/{stage}/count")
+        self.stats.inc_value(f"latency/{stage}/seconds", seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        """Observe the duration of the block (awaits included) if it succeeds."""
+        started_at = time.perf_counter()
+        yield
+        self.observe(stage, time.perf_counter() - started_at)
+
+    def publish(self):
+        for stage, histogram in list(self.histograms.items()):
+            for name, fraction in self.PERCENTILES.items():
+                self.stats.set_value(
+                    f"latency/{stage}/{name}", histogram.percentile(fraction)
+                )
+            self.stats.set_value(f"latency/{stage}/max", histogram.max)
+
+
+class PostgresService(CrawlerScopedService):
+    """Pooled Postgres connections shared by every component of a crawler.
+
+    Connections are opened lazily, up to `max_size`; callers beyond that wait
+    for a connection to be returned. A connection that has been idle longer
+    than `health_check_interval` seconds is pinged before being handed out,
+    and broken connections are discarded and replaced.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        user,
+        password,
+        database,
+        min_size: int = 1,
+        max_size: int = 4,
+        health_check_interval: float = 30,
+    ):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.database = database
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.last_used_at = {}
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        return cls.from_settings(crawler.settings)
+
+    @classmethod
+    def from_settings(cls, settings) -> Self:
+        return cls(
+            host=settings.get("POSTGRES_HOST"),
+            port=settings.get("POSTGRES_PORT"),
+            user=settings.get("POSTGRES_USER"),
+            password=settings.get("POSTGRES_PASSWORD"),
+            database=settings.get("POSTGRES_DB"),
+            min_size=settings.getint("POSTGRES_POOL_MIN_SIZE"),
+            max_size=settings.getint("POSTGRES_POOL_MAX_SIZE"),
+            health_check_interval=settings.getfloat(
+                "POSTGRES_POOL_HEALTH_CHECK_INTERVAL"
+            ),
+        )
 
     def connect(self):
+        """Open a dedicated connection that is not managed by the pool."""
         return psycopg2.connect(
             host=self.host,
             port=self.port,
@@ -26,10 +176,220 @@ class PostgresService:
             database=self.database,
         )
 
+    @contextmanager
+    def connection(self):
+        """Borrow a healthy connection from the pool.
+
+        The transaction is rolled back if the block raises; committing is up
+        to the caller.
+        """
+        self.slots.acquire()
+        conn = None
+
+        try:
+            conn = self._get_healthy_connection()
+            yield conn
+        except Exception:
+            if conn is not None and not conn.closed:
+                with suppress(psycopg2.Error):
+                    conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                self._put_connection(conn)
+            self.slots.release()
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadedConnectionPool(
+                    minconn=self.min_size,
+                    maxconn=self.max_size,
+                    host=self.host,
+                    port=self.port,
+                    user=self.user,
+                    password=self.password,
+                    database=self.database,
+                )
+
+            return self.pool
+
+    def _get_healthy_connection(self):
+        pool = self._get_pool()
+
+        for _ in range(self.max_size + 1):
+            conn = pool.getconn()
+            last_used_at = self.last_used_at.get(id(conn))
+            fresh = (
+                last_used_at is None
+                or time.monotonic() - last_used_at < self.health_check_interval
+            )
+
+            if not conn.closed and fresh:
+                return conn
+
+            try:
+                if not conn.closed:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    conn.rollback()
+                    return conn
+            except psycopg2.Error:
+                pass
+
+            # Broken connection: drop it so the pool opens a fresh one
+            self.last_used_at.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+
+        raise psycopg2.OperationalError("Could not get a healthy connection")
+
+    def _put_connection(self, conn):
+        broken = (
+            conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN
+        )
+
+        if broken:
+            self.last_used_at.pop(id(conn), None)
+        else:
+            self.last_used_at[id(conn)] = time.monotonic()
+
+        self.pool.putconn(conn, close=broken)
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None and not self.pool.closed:
+                self.pool.closeall()
+
+
+class PostgresBatchWriter:
+    """Buffer rows and write them with multi-row inserts, off the reactor.
+
+    Rows are flushed when `batch_size` of them are buffered or every
+    `flush_interval` seconds. Each flush runs `execute_values` with `query`
+    (which must contain a single `VALUES %s` placeholder) in a thread, on a
+    connection borrowed from the pool for the duration of the flush.
+
+    A batch rejected by the database is counted and dropped. Any other
+    failure of a flush (no connection, pool exhausted, a bug...) puts the
+    batch back for the next one, so the flush loop keeps running.
+    """
+
+    def __init__(
+        self,
+        postgres_service: PostgresService,
+        query: str,
+        stats,
+        stats_prefix: str,
+        logger,
+        batch_size: int,
+        flush_interval: float,
+        metrics: MetricsService,
+    ):
+        self.postgres_service = postgres_service
+        self.query = query
+        self.stats = stats
+        self.metrics = metrics
+        self.stats_prefix = stats_prefix
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.lock = defer.DeferredLock()
+        self.flush_loop = task.LoopingCall(self.flush)
+
+    def start(self):
+        if self.flush_interval > 0:
+            self.flush_loop.start(self.flush_interval, now=False)
+
+    def add(self, row: tuple) -> defer.Deferred | None:
+        """Buffer a row. Returns the flush Deferred when the batch is full."""
+        self.rows.append(row)
+
+        if len(self.rows) >= self.batch_size:
+            return self.flush()
+
+        return None
+
+    def flush(self) -> defer.Deferred:
+        rows, self.rows = self.rows, []
+        if not rows:
+            return defer.succeed(None)
+
+        deferred = self.lock.run(threads.deferToThread, self._write, rows)
+        deferred.addErrback(self._keep_rows, rows)
+
+        return deferred
+
+    def _keep_rows(self, failure, rows: list[tuple]):
+        self.logger.error(
+            f"❌ [{self.stats_prefix}] Error on flush of {len(rows)} rows, "
+            f"kept for the next one: {failure.getErrorMessage()}",
+            exc_info=failure.value,
+        )
+        self.stats.inc_value(f"{self.stats_prefix}/flush_errors")
+        self.rows[:0] = rows
+
+    def close(self) -> defer.Deferred:
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+
+        return self.flush()
+
+    def _write(self, rows: list[tuple]):
+        started_at = time.perf_counter()
+
+        try:
+            with (
+                self.metrics.time("db_insert"),
+                self.postgres_service.connection() as conn,
+            ):
+                with conn.cursor() as cursor:
+                    execute_values(cursor, self.query, rows, page_size=len(rows))
+                conn.commit()
+        except (PoolError, psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Not about the rows: kept by the errback of the flush
+            raise
+        except psycopg2.Error as e:
+            self.logger.error(
+                f"❌ [{self.stats_prefix}] Error on insert batch of {len(rows)}: {e}"
+            )
+            self.stats.inc_value(f"{self.stats_prefix}/failed_rows", len(rows))
+            return
+
+        self.stats.inc_value(f"{self.stats_prefix}/flushes")
+        self.stats.inc_value(f"{self.stats_prefix}/rows", len(rows))
+        self.stats.set_value(f"{self.stats_prefix}/batch_size", len(rows))
+        self.stats.max_value(f"{self.stats_prefix}/batch_size/max", len(rows))
+        self.stats.inc_value(
+            f"{self.stats_prefix}/flush_seconds", time.perf_counter() - started_at
+        )
+        self.logger.info(f"✅ [{self.stats_prefix}] Batch inserted: {len(rows)} rows")
+
 
 class TargetLocationService:
-    def __init__(self, postgres_service: PostgresService):
+    def __init__(
+        self,
+        postgres_service: PostgresService,
+        fetch_size: int = 500,
+        include_last_capture: bool = False,
+        due_only: bool = False,
+        default_refresh_minutes: int = 15,
+        due_tolerance_seconds: int = 60,
+        max_targets: int = 0,
+        skip_completed_job_id: str | None = None,
+        shard_index: int = 0,
+        shard_count: int = 1,
+    ):
         self.postgres_service = postgres_service
+        self.fetch_size = fetch_size
+        self.include_last_capture = include_last_capture
+        self.due_only = due_only
+        self.default_refresh_minutes = default_refresh_minutes
+        self.due_tolerance_seconds = due_tolerance_seconds
+        self.max_targets = max_targets
+        self.skip_completed_job_id = skip_completed_job_id
+        self.shard_index = shard_index
+        self.shard_count = shard_count
 
     def get_targets(self) -> list[TargetLocationModel]:
         """Get all target locations from the database.
@@ -38,55 +398,208 @@ class TargetLocationService:
             list[TargetLocationModel]: List of target locations.
         """
 
+        return list(self.iter_targets())
+
+    def iter_targets(self) -> Iterator[TargetLocationModel]:
+        """Stream the active target locations from the database.
+
+        Rows are read through a named (server-side) cursor, `fetch_size` rows
+        per round-trip, so only one batch is held in memory at a time. The
+        pooled connection is held until the generator is exhausted or closed.
+
+        With `include_last_capture`, each target also carries the content hash
+        and stored file of its latest screenshot.
+
+        With `due_only`, only targets whose latest screenshot is older than
+        their `refresh_interval_minutes` (or `default_refresh_minutes`) are
+        returned, never captured ones first and then by due time. At most
+        `max_targets` are returned when it is set.
+
+        With `skip_completed_job_id`, targets checkpointed as completed by
+        that job are left out, so a resumed job only captures the remainder.
+
+        With `shard_count` above 1, only targets whose `id % shard_count`
+        equals `shard_index` are returned, so processes sharing a job split
+        the targets without overlap.
+
+        Yields:
+            TargetLocationModel: The next active target location.
+        """
+
+        query, params = self._build_query()
+
+        try:
+            with self.postgres_service.connection() as conn:
+                with conn.cursor(name="target_locations_cursor") as cursor:
+                    cursor.itersize = self.fetch_size
+                    cursor.execute(query, params)
+
+                    for row in cursor:
+                        yield self._to_model(row)
+                conn.rollback()
+        except Exception:
+            logger.exception("❌ Error getting targets")
+            raise
+
+    def get_target_ids(self) -> list[int]:
+        """Ids of the targets `iter_targets` would return, in the same order.
+
+        Only the ids are read up front (a few bytes per target), in a short
+        transaction; `get_targets_by_id` then reads the targets page by page.
+        """
+        query, params = self._build_query(columns=["t.id"])
+
+        try:
+            with self.postgres_service.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, params)
+                    ids = [row[0] for row in cursor]
+                conn.rollback()
+        except Exception:
+            logger.exception("❌ Error getting target ids")
+            raise
+
+        return ids
+
+    def get_targets_by_id(self, ids: list[int]) -> list[TargetLocationModel]:
+        """Read one page of targets, in the order of `ids`.
+
+        Targets deleted since their id was read are left out.
+        """
+        columns, joins = self._select()
+        query = f"""
+            SELECT {", ".join(columns)}
+            FROM target_locations t
+            {" ".join(joins)}
+            WHERE t.id = ANY(%s)
+        """
+
         try:
-            conn = self.postgres_service.connect()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT
-                    id,
-                    name,
-                    description,
-                    folder,
-                    address,
-                    link,
-                    latitude,
-                    longitude,
-                    gmaps_zoom,
-                    gmaps_extra_params,
-                    active,
-                    created_at,
-                    updated_at
-                FROM target_locations
-                WHERE active = true
+            with self.postgres_service.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, [list(ids)])
+                    targets = {row[0]: self._to_model(row) for row in cursor}
+                conn.rollback()
+        except Exception:
+            logger.exception("❌ Error getting targets")
+            raise
+
+        return [targets[target_id] for target_id in ids if target_id in targets]
+
+    @staticmethod
+    def _to_model(row: tuple) -> TargetLocationModel:
+        return TargetLocationModel(
+            id=row[0],
+            name=row[1],
+            description=row[2],
+            folder=row[3],
+            address=row[4],
+            link=row[5],
+            latitude=row[6],
+            longitude=row[7],
+            gmaps_zoom=row[8],
+            gmaps_extra_params=row[9],
+            active=row[10],
+            created_at=row[11],
+            updated_at=row[12],
+            refresh_interval_minutes=row[13],
+            last_content_hash=row[14],
+            last_file_path=row[15],
+        )
+
+    def _select(self) -> tuple[list[str], list[str]]:
+        """Columns of a target row and the joins they need."""
+        columns = [
+            "t.id",
+            "t.name",
+            "t.description",
+            "t.folder",
+            "t.address",
+            "t.link",
+            "t.latitude",
+            "t.longitude",
+            "t.gmaps_zoom",
+            "t.gmaps_extra_params",
+            "t.active",
+            "t.created_at",
+            "t.updated_at",
+            "t.refresh_interval_minutes",
+        ]
+        joins = []
+
+        if self.include_last_capture or self.due_only:
+            joins.append("""
+                LEFT JOIN LATERAL (
+                    SELECT
+                        s.content_hash,
+                        COALESCE(s.reference_file_path, s.file_path) AS file_path,
+                        s.captured_at
+                    FROM gmaps_screenshots s
+                    WHERE s.target_location_id = t.id
+                    ORDER BY s.captured_at DESC
+                    LIMIT 1
+                ) last_capture ON true
             """)
 
-            targets = cursor.fetchall()
-            conn.close()
-
-            return [
-                TargetLocationModel(
-                    id=target[0],
-                    name=target[1],
-                    description=target[2],
-                    folder=target[3],
-                    address=target[4],
-                    link=target[5],
-                    latitude=target[6],
-                    longitude=target[7],
-                    gmaps_zoom=target[8],
-                    gmaps_extra_params=target[9],
-                    active=target[10],
-                    created_at=target[11],
-                    updated_at=target[12],
-                )
-                for target in targets
+        if self.include_last_capture:
+            columns += ["last_capture.content_hash", "last_capture.file_path"]
+        else:
+            columns += ["NULL", "NULL"]
+
+        return columns, joins
+
+    def _build_query(self, columns: list[str] | None = None) -> tuple[str, list]:
+        target_columns, joins = self._select()
+        columns = columns or target_columns
+        conditions = ["t.active = true"]
+        order_by = ["t.id"]
+        params = []
+        order_by_params = []
+
+        if self.due_only:
+            due_at = """
+                last_capture.captured_at
+                + make_interval(mins => COALESCE(t.refresh_interval_minutes, %s))
+                - make_interval(secs => %s)
+            """
+            conditions.append(
+                f"(last_capture.captured_at IS NULL OR {due_at} <= now())"
+            )
+            params += [self.default_refresh_minutes, self.due_tolerance_seconds]
+            order_by = [f"{due_at} ASC NULLS FIRST", "t.id"]
+            order_by_params = [
+                self.default_refresh_minutes,
+                self.due_tolerance_seconds,
             ]
-        except Exception as e:
-            print("❌ Error getting targets", e)
-            raise RuntimeError("Error getting targets") from e
-        finally:
-            if conn:
-                conn.close()
+
+        if self.skip_completed_job_id:
+            conditions.append("""
+                NOT EXISTS (
+                    SELECT 1
+                    FROM job_checkpoints c
+                    WHERE c.job_id = %s AND c.target_location_id = t.id
+                )
+            """)
+            params.append(self.skip_completed_job_id)
+
+        if self.shard_count > 1:
+            conditions.append("t.id %% %s = %s")
+            params += [self.shard_count, self.shard_index]
+
+        query = f"""
+            SELECT {", ".join(columns)}
+            FROM target_locations t
+            {" ".join(joins)}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {", ".join(order_by)}
+        """
+        params += order_by_params
+
+        if self.max_targets:
+            query += " LIMIT %s"
+            params.append(self.max_targets)
+
+        return query, params
 
 
 class GMapsUrlService:
@@ -115,25 +628,83 @@ class GMapsUrlService:
         return f"{base_url}/maps/@{target_location.latitude},{target_location.longitude},{target_location.gmaps_zoom}z/data=!5m1!1e1?{urlencode(params)}"
 
 
-class LocalSaverImageService:
+def image_nbytes(image: Image.Image) -> int:
+    """Bytes of the pixel buffer of a decoded image.
+
+    Pillow stores multi-band pixels on 4 bytes, single band ones on 1.
+    """
+    return image.width * image.height * (4 if len(image.getbands()) > 1 else 1)
+
+
+class ImageMemoryTracker:
+    """Follow the peak memory held while processing one screenshot.
+
+    Pillow allocates pixel buffers outside of the Python allocator, so the
+    peak is accounted from the images alive at each step, on top of the
+    `baseline` bytes (the encoded screenshot).
+    """
+
+    def __init__(self, baseline: int = 0):
+        self.baseline = baseline
+        self.peak_bytes = baseline
+
+    def track(self, *images: Image.Image):
+        self.peak_bytes = max(
+            self.peak_bytes,
+            self.baseline + sum(image_nbytes(image) for image in images),
+        )
+
+
+class CompressImageService:
+    size = (854, 480)
+
     @classmethod
-    def save(cls, file_path: str, image: Image.Image):
-        """Save an image to a local file path, creating directories if they don't exist."""
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        image.save(
-            file_path,
-            format="JPEG",
-            quality=70,
-            optimize=True,
-            progressive=True,
-            subsampling=0,
+    def compress(cls, image_bytes: bytes, memory: ImageMemoryTracker | None = None):
+        """Resize and quantize a screenshot, dropping each intermediate as soon
+        as the next one exists.
+
+        JPEG input is decoded straight at the smallest DCT scale still larger
+        than the output (`draft`); large frames are shrunk with a cheap integer
+        `reduce` before the LANCZOS pass (`reducing_gap`).
+        """
+        memory = memory or ImageMemoryTracker()
+        source = Image.open(io.BytesIO(image_bytes))
+        source.draft("RGB", cls.size)
+        source.load()
+        memory.track(source)
+
+        # Resized before any mode conversion, which then runs on the small image
+        resized = source.resize(cls.size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        memory.track(source, resized)
+        source.close()
+
+        if resized.mode != "RGB":
+            converted = resized.convert("RGB")
+            memory.track(resized, converted)
+            resized.close()
+            resized = converted
+
+        quantized = resized.quantize(
+            colors=128,
+            method=Image.Quantize.FASTOCTREE,
+            dither=Image.Dither.NONE,
         )
+        memory.track(resized, quantized)
+        resized.close()
+
+        image = quantized.convert("RGB")
+        memory.track(quantized, image)
+        quantized.close()
+
+        new_disk_size = image.size
+
+        return image, new_disk_size
 
 
-class S3SaverImageService:
+class EncodeImageService:
     @classmethod
-    def save(cls, file_path: str, image: Image.Image):
-        """Save an image to a S3 bucket."""
+    def encode(cls, image: Image.Image) -> bytes:
+        """Encode an image as an optimized progressive JPEG."""
         buffer = io.BytesIO()
         image.save(
             buffer,
@@ -144,36 +715,856 @@ class S3SaverImageService:
             subsampling=0,
         )
 
-        buffer.seek(0)
+        return buffer.getvalue()
+
+
+class ContentHashService:
+    # Downsampling factor and bits kept per channel before hashing: enough to
+    # absorb encoder noise while still seeing traffic colour changes on roads.
+    reduce_factor = 4
+    channel_bits = 5
+
+    @classmethod
+    def hash(cls, image: Image.Image, scale: int = 1) -> str:
+        """Hash the visible content of an image.
+
+        Args:
+            scale: Factor the image was already reduced by when decoded.
+
+        Returns:
+            str: 32 hex characters, equal for captures that look the same.
+        """
+        reduced = image.reduce(max(cls.reduce_factor // scale, 1))
+        if reduced.mode != "RGB":
+            reduced = reduced.convert("RGB")
+        mask = 0xFF ^ ((1 << (8 - cls.channel_bits)) - 1)
+        quantized = reduced.point(lambda value: value & mask)
+
+        return hashlib.blake2b(quantized.tobytes(), digest_size=16).hexdigest()
+
+
+class ImageValidationService:
+    """Reject blank and degraded frames from statistics of a small thumbnail.
 
-        s3_client = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_REGION"),
+    Every check runs on a `thumbnail_size` nearest-neighbour sample of the
+    frame, mostly with Pillow's C operations, so validating costs a fraction
+    of a millisecond:
+        blank: the luminance standard deviation is below `min_stddev` and the
+            mean colour is a placeholder colour or one of `blank_colors`
+            (white or black pages), within `placeholder_tolerance` per band.
+            A flat but real map (water, parks, large polygons) is kept.
+        degraded: at least `max_placeholder_fraction` of the cells of a
+            `grid` are filled with a placeholder colour (the grey of map tiles
+            that never loaded), within `placeholder_tolerance` per band.
+        template: the colour histogram is within `template_max_distance`
+            (L1, 0 to 2) of a known bad frame such as a consent dialog or an
+            error page.
+
+    Instances are pickled to the image-processing workers with every call, so
+    they only hold plain values.
+    """
+
+    thumbnail_size = (128, 72)
+    grid = (16, 9)
+    histogram_bins = 16
+    # Share of the pixels of a cell that must match a placeholder colour
+    placeholder_cell_coverage = 0.95
+
+    def __init__(
+        self,
+        min_stddev: float = 4.0,
+        placeholder_colors: list[tuple[int, int, int]] = ((229, 227, 223),),
+        blank_colors: list[tuple[int, int, int]] = ((255, 255, 255), (0, 0, 0)),
+        placeholder_tolerance: int = 2,
+        max_placeholder_fraction: float = 0.25,
+        templates: dict[str, list[float]] | None = None,
+        template_max_distance: float = 0.15,
+    ):
+        self.min_stddev = min_stddev
+        self.placeholder_colors = [tuple(color) for color in placeholder_colors]
+        self.blank_colors = [tuple(color) for color in blank_colors]
+        self.placeholder_tolerance = placeholder_tolerance
+        self.max_placeholder_fraction = max_placeholder_fraction
+        self.templates = templates or {}
+        self.template_max_distance = template_max_distance
+
+    @classmethod
+    def from_settings(cls, settings) -> Self:
+        templates = {}
+        templates_dir = settings.get("IMAGE_VALIDATION_TEMPLATES_DIR")
+        if templates_dir:
+            for file_name in sorted(os.listdir(templates_dir)):
+                with Image.open(os.path.join(templates_dir, file_name)) as template:
+                    templates[os.path.splitext(file_name)[0]] = cls.signature(
+                        cls.thumbnail(template)
+                    )
+
+        return cls(
+            min_stddev=settings.getfloat("IMAGE_VALIDATION_MIN_STDDEV"),
+            placeholder_colors=settings.getlist("IMAGE_VALIDATION_PLACEHOLDER_COLORS"),
+            blank_colors=settings.getlist("IMAGE_VALIDATION_BLANK_COLORS"),
+            placeholder_tolerance=settings.getint(
+                "IMAGE_VALIDATION_PLACEHOLDER_TOLERANCE"
+            ),
+            max_placeholder_fraction=settings.getfloat(
+                "IMAGE_VALIDATION_MAX_PLACEHOLDER_FRACTION"
+            ),
+            templates=templates,
+            template_max_distance=settings.getfloat(
+                "IMAGE_VALIDATION_TEMPLATE_MAX_DISTANCE"
+            ),
+        )
+
+    @classmethod
+    def thumbnail(cls, image: Image.Image) -> Image.Image:
+        thumbnail = image.resize(cls.thumbnail_size, Image.Resampling.NEAREST)
+        if thumbnail.mode != "RGB":
+            thumbnail = thumbnail.convert("RGB")
+
+        return thumbnail
+
+    @classmethod
+    def signature(cls, thumbnail: Image.Image) -> list[float]:
+        """Colour histogram with `histogram_bins` bins per band, normalized."""
+        histogram = thumbnail.histogram()
+        step = 256 // cls.histogram_bins
+        pixels = thumbnail.width * thumbnail.height
+
+        return [
+            sum(histogram[start : start + step]) / pixels
+            for start in range(0, len(histogram), step)
+        ]
+
+    def validate(self, image: Image.Image) -> str | None:
+        """Returns the rejection reason, or None for a usable frame."""
+        thumbnail = self.thumbnail(image)
+
+        if self._luminance_stddev(thumbnail) < self.min_stddev and self._blank_color(
+            thumbnail
+        ):
+            return "blank"
+
+        if self.placeholder_colors and self._placeholder_fraction(thumbnail) >= (
+            self.max_placeholder_fraction
+        ):
+            return "degraded"
+
+        if self.templates:
+            signature = self.signature(thumbnail)
+            for values in self.templates.values():
+                distance = sum(abs(a - b) for a, b in zip(signature, values))
+                if distance <= self.template_max_distance:
+                    return "template"
+
+        return None
+
+    @staticmethod
+    def _luminance_stddev(thumbnail: Image.Image) -> float:
+        histogram = thumbnail.convert("L").histogram()
+        pixels = sum(histogram)
+        mean = sum(map(operator.mul, LEVELS, histogram)) / pixels
+        variance = sum(map(operator.mul, SQUARED_LEVELS, histogram)) / pixels
+
+        return max(variance - mean * mean, 0) ** 0.5
+
+    def _blank_color(self, thumbnail: Image.Image) -> bool:
+        """Whether the mean colour of the frame is a placeholder or blank one."""
+        mean = thumbnail.reduce(thumbnail.size).getpixel((0, 0))
+
+        return any(
+            all(
+                abs(band - expected) <= self.placeholder_tolerance
+                for band, expected in zip(mean, color)
+            )
+            for color in self.placeholder_colors + self.blank_colors
+        )
+
+    def _placeholder_fraction(self, thumbnail: Image.Image) -> float:
+        tolerance = Image.new("RGB", thumbnail.size, (self.placeholder_tolerance,) * 3)
+        # 0 where a pixel matches a placeholder colour, 255 elsewhere
+        mismatch = None
+
+        for color in self.placeholder_colors:
+            difference = ImageChops.difference(
+                thumbnail, Image.new("RGB", thumbnail.size, color)
+            )
+            # Saturates to 255 every band further than the tolerance
+            red, green, blue = ImageChops.subtract(
+                difference, tolerance, scale=1 / 255
+            ).split()
+            color_mismatch = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+            mismatch = (
+                color_mismatch
+                if mismatch is None
+                else ImageChops.darker(mismatch, color_mismatch)
+            )
+
+        columns, rows = self.grid
+        cells = mismatch.reduce((thumbnail.width // columns, thumbnail.height // rows))
+        threshold = round(255 * (1 - self.placeholder_cell_coverage))
+
+        return sum(cells.histogram()[: threshold + 1]) / (cells.width * cells.height)
+
+
+def process_screenshot(
+    image_bytes: bytes,
+    image_format: str = "png",
+    validator: ImageValidationService | None = None,
+    delta=None,
+) -> ProcessedImageModel:
+    """Turn a screenshot into the final JPEG and hash its content.
+
+    PNG captures are compressed and encoded; JPEG captures (direct mode) are
+    already final and are only decoded, at half scale, for validation and
+    hashing. With a `validator`, the frame is checked before encoding and a
+    rejected frame is returned with its `rejection` reason and no body.
+    `peak_bytes` is the most memory held by the screenshot and its decoded
+    images at any step. With a `delta` encoder (delta storage), the changed
+    blocks of the frame are computed as well; JPEG captures are then decoded
+    at full scale.
+
+    Runs inside the image-processing worker processes, so it must stay a
+    module-level function that can be pickled.
+    """
+    started_at = time.perf_counter()
+    memory = ImageMemoryTracker(baseline=len(image_bytes))
+    scale = 1
+
+    if image_format == "jpeg":
+        image = Image.open(io.BytesIO(image_bytes))
+        size = image.size
+        if delta is None:
+            # Enough pixels for the validator and the content hash
+            image.draft("RGB", (size[0] // 2, size[1] // 2))
+        image.load()
+        scale = round(size[0] / image.width)
+        memory.track(image)
+    else:
+        image, size = CompressImageService.compress(
+            image_bytes=image_bytes, memory=memory
+        )
+    compressed_at = time.perf_counter()
+
+    rejection = validator.validate(image) if validator else None
+    validated_at = time.perf_counter()
+
+    if rejection:
+        return ProcessedImageModel(
+            body=b"",
+            width=size[0],
+            height=size[1],
+            content_hash="",
+            rejection=rejection,
+            peak_bytes=memory.peak_bytes,
+            compress_seconds=compressed_at - started_at,
+            validation_seconds=validated_at - compressed_at,
+            encode_seconds=0,
+            hash_seconds=0,
+        )
+
+    body = image_bytes if image_format == "jpeg" else EncodeImageService.encode(image)
+    encoded_at = time.perf_counter()
+    if body is not image_bytes:
+        # The encoded JPEG is alive next to the decoded image
+        memory.baseline += len(body)
+        memory.track(image)
+
+    content_hash = ContentHashService.hash(image, scale=scale)
+    hashed_at = time.perf_counter()
+    delta_model = delta(image) if delta is not None else None
+    image.close()
+
+    return ProcessedImageModel(
+        body=body,
+        width=size[0],
+        height=size[1],
+        content_hash=content_hash,
+        peak_bytes=memory.peak_bytes,
+        compress_seconds=compressed_at - started_at,
+        validation_seconds=validated_at - compressed_at,
+        encode_seconds=encoded_at - validated_at,
+        hash_seconds=hashed_at - encoded_at,
+        delta=delta_model,
+    )
+
+
+class MemoryBudgetService(CrawlerScopedService):
+    """Bound the memory held by screenshots in flight across the crawler.
+
+    Image processing accounts the expected peak memory of every screenshot it
+    holds. While the total is above `budget` bytes, new captures wait before
+    navigating (see `MemoryBudgetDownloaderMiddleware`) until processing
+    catches up. A budget of 0 only reports the usage.
+    """
+
+    def __init__(self, stats, budget: int):
+        self.stats = stats
+        self.budget = budget
+        self.in_use = 0
+        self.available = asyncio.Event()
+        self.available.set()
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        return cls(
+            stats=crawler.stats,
+            budget=crawler.settings.getint("IMAGE_MEMORY_BUDGET"),
+        )
+
+    def over_budget(self) -> bool:
+        return bool(self.budget) and self.in_use > self.budget
+
+    def acquire(self, nbytes: int):
+        self.in_use += nbytes
+        self.stats.set_value("memory_budget/in_use", self.in_use)
+        self.stats.max_value("memory_budget/in_use/max", self.in_use)
+        if self.over_budget():
+            self.available.clear()
+
+    def release(self, nbytes: int):
+        self.in_use -= nbytes
+        self.stats.set_value("memory_budget/in_use", self.in_use)
+        if not self.over_budget():
+            self.available.set()
+
+    async def wait(self):
+        """Wait until the memory in use is back under the budget."""
+        if not self.over_budget():
+            return
+
+        started_at = time.perf_counter()
+        self.stats.inc_value("memory_budget/throttled")
+        while self.over_budget():
+            await self.available.wait()
+
+        self.stats.inc_value(
+            "memory_budget/throttled_seconds", time.perf_counter() - started_at
+        )
+
+
+class ImageProcessingService(CrawlerScopedService):
+    """Run the CPU bound image work in a process pool, off the reactor.
+
+    At most `max_pending` screenshots are handed to the pool at once. Callbacks
+    beyond that wait for a free slot, which keeps their responses in the
+    scraper slot and makes the engine back off from scheduling new requests.
+
+    Every screenshot holds its size plus the largest peak seen so far in the
+    memory budget until it is processed.
+    """
+
+    def __init__(
+        self,
+        stats,
+        metrics: MetricsService,
+        memory_budget: MemoryBudgetService,
+        max_workers: int,
+        max_pending: int,
+        validator: ImageValidationService | None = None,
+        peak_estimate: int = 0,
+    ):
+        self.stats = stats
+        self.metrics = metrics
+        self.memory_budget = memory_budget
+        self.peak_estimate = peak_estimate
+        self.validator = validator
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.semaphore = asyncio.Semaphore(max_pending)
+        self.pending = 0
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+        max_workers = settings.getint("IMAGE_PROCESSING_MAX_WORKERS") or (
+            os.cpu_count() or 1
+        )
+
+        return cls(
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            memory_budget=MemoryBudgetService.from_crawler(crawler),
+            max_workers=max_workers,
+            max_pending=settings.getint("IMAGE_PROCESSING_MAX_PENDING")
+            or max_workers * 2,
+            validator=ImageValidationService.from_settings(settings)
+            if settings.getbool("IMAGE_VALIDATION_ENABLED")
+            else None,
+            # One decoded viewport until a real peak is measured
+            peak_estimate=settings.getint("CAPTURE_VIEWPORT_WIDTH")
+            * settings.getint("CAPTURE_VIEWPORT_HEIGHT")
+            * 4,
+        )
+
+    async def process(
+        self, image_bytes: bytes, image_format: str = "png", delta=None
+    ) -> ProcessedImageModel:
+        """Compress, validate, encode and hash a screenshot in the process pool.
+
+        `delta` is a picklable encoder of the changed blocks, see
+        `process_screenshot`.
+        """
+        queued_at = time.perf_counter()
+        reserved_bytes = len(image_bytes) + self.peak_estimate
+        self.memory_budget.acquire(reserved_bytes)
+        self.pending += 1
+        self.stats.set_value("image_processing/pending", self.pending)
+        self.stats.max_value("image_processing/pending/max", self.pending)
+
+        try:
+            async with self.semaphore:
+                started_at = time.perf_counter()
+                processed_image = await asyncio.wrap_future(
+                    self.executor.submit(
+                        process_screenshot,
+                        image_bytes,
+                        image_format,
+                        self.validator,
+                        delta,
+                    )
+                )
+        finally:
+            self.pending -= 1
+            self.stats.set_value("image_processing/pending", self.pending)
+            self.memory_budget.release(reserved_bytes)
+
+        finished_at = time.perf_counter()
+        self.peak_estimate = max(
+            self.peak_estimate, processed_image.peak_bytes - len(image_bytes)
+        )
+
+        self.stats.inc_value("image_processing/count")
+        self.stats.inc_value(
+            "image_processing/queue_wait_seconds", started_at - queued_at
+        )
+        self.stats.inc_value(
+            "image_processing/compress_seconds", processed_image.compress_seconds
+        )
+        self.stats.inc_value(
+            "image_processing/encode_seconds", processed_image.encode_seconds
+        )
+        self.stats.inc_value("image_processing/total_seconds", finished_at - queued_at)
+        self.stats.inc_value("image_processing/peak_bytes", processed_image.peak_bytes)
+        self.stats.max_value(
+            "image_processing/peak_bytes/max", processed_image.peak_bytes
+        )
+
+        self.metrics.observe("image_queue", started_at - queued_at)
+        if image_format != "jpeg":
+            # Direct captures arrive encoded, nothing was compressed
+            self.metrics.observe("compress", processed_image.compress_seconds)
+        if self.validator is not None:
+            self.metrics.observe("validate", processed_image.validation_seconds)
+
+        if processed_image.rejection:
+            self.stats.inc_value(
+                f"image_processing/rejected/{processed_image.rejection}"
+            )
+            return processed_image
+
+        if image_format != "jpeg":
+            self.metrics.observe("encode", processed_image.encode_seconds)
+        self.metrics.observe("hash", processed_image.hash_seconds)
+        if processed_image.delta is not None:
+            self.metrics.observe("delta", processed_image.delta.seconds)
+
+        return processed_image
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FilesystemS3Client:
+    """Minimal S3 stand-in that stores objects under a local directory.
+
+    Implements the subset of the boto3 client used by `S3UploaderService`, so
+    uploads and downloads can be exercised offline.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None):
+        file_path = os.path.join(self.root, Bucket, Key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        try:
+            source = Fileobj.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            source = None
+
+        with open(file_path, "wb") as file:
+            if source is None:
+                while chunk := Fileobj.read(1024 * 1024):
+                    file.write(chunk)
+                return
+
+            # Real files are copied by the kernel, without going through Python
+            offset, size = Fileobj.tell(), os.fstat(source).st_size
+            while offset < size:
+                offset += os.sendfile(file.fileno(), source, offset, size - offset)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, Config=None):
+        try:
+            with open(os.path.join(self.root, Bucket, Key), "rb") as file:
+                while chunk := file.read(1024 * 1024):
+                    Fileobj.write(chunk)
+        except FileNotFoundError:
+            # What boto3 raises for a missing key
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject") from None
+
+
+def build_s3_client(settings, max_pool_connections: int):
+    """S3 client from the AWS settings, or a `FilesystemS3Client` when
+    `S3_FILESYSTEM_ROOT` is set."""
+    if settings.get("S3_FILESYSTEM_ROOT"):
+        return FilesystemS3Client(root=settings.get("S3_FILESYSTEM_ROOT"))
+
+    return boto3.session.Session().client(
+        "s3",
+        aws_access_key_id=settings.get("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=settings.get("AWS_SECRET_ACCESS_KEY"),
+        region_name=settings.get("AWS_REGION"),
+        endpoint_url=settings.get("AWS_ENDPOINT_URL") or None,
+        config=Config(
+            max_pool_connections=max_pool_connections,
+            retries={"mode": "standard"},
+        ),
+    )
+
+
+def download_object(client, bucket: str, key: str) -> bytes | None:
+    """Bytes of an S3 object, None when it does not exist."""
+    buffer = io.BytesIO()
+    try:
+        client.download_fileobj(Bucket=bucket, Key=key, Fileobj=buffer)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+            return None
+        raise
+
+    return buffer.getvalue()
+
+
+class S3UploaderService(CrawlerScopedService):
+    """Upload images to S3 from a bounded thread pool, off the reactor.
+
+    A single boto3 client (thread safe, with a connection pool sized to the
+    upload concurrency) is shared by every upload of the crawler. Objects above
+    `multipart_threshold` bytes are sent as multipart uploads.
+    """
+
+    def __init__(
+        self,
+        stats,
+        metrics: MetricsService,
+        client,
+        bucket: str,
+        max_concurrency: int,
+        max_pending: int,
+        max_retries: int,
+        retry_backoff: float,
+        multipart_threshold: int,
+    ):
+        self.stats = stats
+        self.metrics = metrics
+        self.client = client
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            max_concurrency=S3_MULTIPART_CONCURRENCY,
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="s3-uploader",
+        )
+        self.semaphore = asyncio.Semaphore(max_pending)
+        self.queue_depth = 0
+        self.uploaded_bytes = 0
+        self.first_upload_at = None
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+        max_concurrency = settings.getint("S3_UPLOAD_MAX_CONCURRENCY")
+
+        return cls(
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            client=build_s3_client(
+                settings,
+                max_pool_connections=max_concurrency * S3_MULTIPART_CONCURRENCY,
+            ),
+            bucket=settings.get("AWS_BUCKET_NAME"),
+            max_concurrency=max_concurrency,
+            max_pending=settings.getint("S3_UPLOAD_MAX_PENDING"),
+            max_retries=settings.getint("S3_UPLOAD_MAX_RETRIES"),
+            retry_backoff=settings.getfloat("S3_UPLOAD_RETRY_BACKOFF"),
+            multipart_threshold=settings.getint("S3_MULTIPART_THRESHOLD"),
         )
 
-        s3_client.upload_fileobj(
-            Fileobj=buffer,
-            Bucket=os.getenv("AWS_BUCKET_NAME"),
+    async def upload(self, file_path: str, body: bytes):
+        """Upload encoded image bytes, retrying failed attempts with backoff."""
+        self.queue_depth += 1
+        self.stats.set_value("s3_uploader/queue_depth", self.queue_depth)
+        self.stats.max_value("s3_uploader/queue_depth/max", self.queue_depth)
+
+        try:
+            async with self.semaphore:
+                # Failed attempts and backoff sleeps are part of the upload
+                started_at = time.perf_counter()
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        await asyncio.wrap_future(
+                            self.executor.submit(self._upload, file_path, body)
+                        )
+                        break
+                    except (BotoCoreError, ClientError, OSError):
+                        if attempt == self.max_retries:
+                            seconds = time.perf_counter() - started_at
+                            self.metrics.observe("upload", seconds)
+                            self.stats.inc_value("s3_uploader/failed")
+                            self.stats.inc_value("s3_uploader/failed_seconds", seconds)
+                            raise
+
+                        self.stats.inc_value("s3_uploader/retries")
+                        await asyncio.sleep(self.retry_backoff * 2**attempt)
+        finally:
+            self.queue_depth -= 1
+            self.stats.set_value("s3_uploader/queue_depth", self.queue_depth)
+
+        seconds = time.perf_counter() - started_at
+        self.metrics.observe("upload", seconds)
+        self._record_upload(size=len(body), seconds=seconds)
+
+    def _upload(self, file_path: str, body: bytes):
+        self.client.upload_fileobj(
+            Fileobj=io.BytesIO(body),
+            Bucket=self.bucket,
             Key=file_path,
+            Config=self.transfer_config,
         )
 
+    async def download(self, file_path: str) -> bytes | None:
+        """Read an object back, None when it does not exist."""
+        return await asyncio.wrap_future(
+            self.executor.submit(download_object, self.client, self.bucket, file_path)
+        )
+
+    def _record_upload(self, size: int, seconds: float):
+        now = time.perf_counter()
+        if self.first_upload_at is None:
+            self.first_upload_at = now - seconds
+
+        self.uploaded_bytes += size
+
+        self.stats.inc_value("s3_uploader/count")
+        self.stats.inc_value("s3_uploader/bytes", size)
+        self.stats.inc_value("s3_uploader/seconds", seconds)
+        self.stats.set_value(
+            "s3_uploader/bytes_per_second",
+            self.uploaded_bytes / max(now - self.first_upload_at, 1e-6),
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class BrowserProfileService(CrawlerScopedService):
+    """Persistent browser profiles, so the disk cache survives across runs.
+
+    Each context of the page pool gets a profile slot of the
+    `BrowserProfileStore` on the scrapyd volume, if one is free, and is
+    launched as a persistent context on it. The browser disk cache of a slot
+    is capped at its share of the store budget; whole slots are evicted by
+    age and size when they are claimed.
+    """
+
+    def __init__(
+        self,
+        stats,
+        store: BrowserProfileStore,
+        browser_type: str,
+        launch_options: dict,
+    ):
+        self.stats = stats
+        self.store = store
+        self.browser_type = browser_type
+        self.launch_options = launch_options
 
-class CompressImageService:
     @classmethod
-    def compress(cls, image_bytes: bytes):
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
 
-        image = image.resize((854, 480), Image.Resampling.LANCZOS)
+        return cls(
+            stats=crawler.stats,
+            store=BrowserProfileStore(
+                root=settings.get("BROWSER_PROFILE_ROOT"),
+                slots=settings.getint("BROWSER_PROFILE_SLOTS"),
+                max_bytes=settings.getint("BROWSER_PROFILE_MAX_BYTES"),
+                max_age=settings.getfloat("BROWSER_PROFILE_MAX_AGE"),
+            ),
+            browser_type=settings.get("PLAYWRIGHT_BROWSER_TYPE"),
+            launch_options=settings.getdict("PLAYWRIGHT_LAUNCH_OPTIONS"),
+        )
 
-        image = image.quantize(
-            colors=128,
-            method=Image.Quantize.FASTOCTREE,
-            dither=Image.Dither.NONE,
+    def claim(self, context_kwargs: dict, count: int) -> list[dict]:
+        """Persistent context kwargs for up to `count` contexts."""
+        store = self.store
+        paths = store.claim(count)
+        evicted = store.evict()
+        store.touch()
+
+        self.stats.set_value("browser_profile/slots", len(paths))
+        self.stats.inc_value("browser_profile/no_slot", count - len(paths))
+        self.stats.inc_value("browser_profile/evicted/age", evicted["age"])
+        self.stats.inc_value("browser_profile/evicted/size", evicted["size"])
+        self.stats.inc_value("browser_profile/evicted_bytes", evicted["bytes"])
+        self.stats.set_value("browser_profile/bytes", store.size())
+
+        # Leave room for the rest of the profile next to the cache
+        cache_bytes = store.max_bytes // max(store.slots, 1) // 2
+        kwargs = {**self.launch_options, **context_kwargs}
+        if cache_bytes and self.browser_type == "firefox":
+            kwargs["firefox_user_prefs"] = {
+                **kwargs.get("firefox_user_prefs", {}),
+                "browser.cache.disk.enable": True,
+                "browser.cache.disk.smart_size.enabled": False,
+                "browser.cache.disk.capacity": cache_bytes // 1024,
+            }
+        elif cache_bytes:
+            kwargs["args"] = [
+                *kwargs.get("args", []),
+                f"--disk-cache-size={cache_bytes}",
+            ]
+
+        return [{**kwargs, "user_data_dir": path} for path in paths]
+
+    def close(self):
+        self.store.touch()
+
+
+class PlaywrightPagePoolService(CrawlerScopedService):
+    """Keep warm Playwright pages around and reuse them across requests.
+
+    Requests are spread round-robin over `contexts` browser contexts. Once a
+    page has been used, it goes back to the pool and the next request is
+    navigated on it, so the map scripts and tiles stay cached in its context.
+    Pages are closed after `max_uses` captures, after an error, or when more
+    than `max_idle` of them are waiting in the pool. Contexts are created with
+    `context_kwargs`, which is where the capture viewport is set, or with the
+    `persistent_kwargs` of their index when given (persistent profiles).
+    """
+
+    def __init__(
+        self,
+        stats,
+        contexts: int,
+        max_uses: int,
+        max_idle: int,
+        context_kwargs: dict | None = None,
+        persistent_kwargs: list[dict] = (),
+    ):
+        self.stats = stats
+        self.context_names = [f"capture-{index}" for index in range(contexts)]
+        self.context_kwargs = context_kwargs or {}
+        self.persistent_kwargs = dict(zip(self.context_names, persistent_kwargs))
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self.idle_pages = []
+        self.pages = {}
+        self.next_context = 0
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+        context_kwargs = {
+            "viewport": {
+                "width": settings.getint("CAPTURE_VIEWPORT_WIDTH"),
+                "height": settings.getint("CAPTURE_VIEWPORT_HEIGHT"),
+            },
+        }
+
+        if settings.get("CAPTURE_MODE") == "direct":
+            context_kwargs["device_scale_factor"] = settings.getfloat(
+                "CAPTURE_DIRECT_SCALE_FACTOR"
+            )
+
+        contexts = settings.getint("PLAYWRIGHT_POOL_CONTEXTS")
+        persistent_kwargs = []
+        if settings.getbool("BROWSER_PROFILE_ENABLED"):
+            persistent_kwargs = BrowserProfileService.from_crawler(crawler).claim(
+                context_kwargs, contexts
+            )
+
+        return cls(
+            stats=crawler.stats,
+            contexts=contexts,
+            max_uses=settings.getint("PLAYWRIGHT_POOL_PAGE_MAX_USES"),
+            max_idle=settings.getint("PLAYWRIGHT_POOL_MAX_IDLE_PAGES"),
+            context_kwargs=context_kwargs,
+            persistent_kwargs=persistent_kwargs,
         )
-        image = image.convert("RGB")
 
-        new_disk_size = image.size
+    def assign(self, request):
+        """Attach an idle page to a request, or pick a context for a new one."""
+        while self.idle_pages:
+            page = self.idle_pages.pop()
+            if not page.is_closed():
+                request.meta["playwright_page"] = page
+                request.meta["playwright_context"] = self.pages[page]["context"]
+                self.stats.inc_value("page_pool/reused")
+                return
 
-        return image, new_disk_size
+            self.pages.pop(page, None)
+
+        context_name = self.context_names[self.next_context % len(self.context_names)]
+        self.next_context += 1
+
+        request.meta["playwright_context"] = context_name
+        request.meta["playwright_context_kwargs"] = self.persistent_kwargs.get(
+            context_name, self.context_kwargs
+        )
+        self.stats.inc_value("page_pool/created")
+
+    async def release(
+        self, page, failed: bool = False, context_name: str | None = None
+    ):
+        """Return a page to the pool once a capture is done with it."""
+        state = self.pages.setdefault(page, {"context": context_name, "uses": 0})
+        state["uses"] += 1
+
+        if page.is_closed():
+            self.pages.pop(page, None)
+            return
+
+        if failed or state["uses"] >= self.max_uses:
+            self.stats.inc_value(
+                "page_pool/closed/failed" if failed else "page_pool/closed/recycled"
+            )
+            await self._close_page(page)
+            return
+
+        if len(self.idle_pages) >= self.max_idle:
+            self.stats.inc_value("page_pool/closed/idle")
+            await self._close_page(page)
+            return
+
+        self.idle_pages.append(page)
+        self.stats.max_value("page_pool/idle/max", len(self.idle_pages))
+
+    async def _close_page(self, page):
+        self.pages.pop(page, None)
+        with suppress(Exception):
+            await page.close()
+
+    def close(self):
+        # The pages themselves are closed with their browser contexts.
+        self.idle_pages.clear()
+        self.pages.clear()
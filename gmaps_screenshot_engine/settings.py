@@ -42,28 +42,111 @@ DOWNLOAD_DELAY = 1
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    "gmaps_screenshot_engine.middlewares.GmapsScreenshotEngineSpiderMiddleware": 543,
-# }
+SPIDER_MIDDLEWARES = {
+    "gmaps_screenshot_engine.middlewares.CaptureFailureSpiderMiddleware": 543,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    "gmaps_screenshot_engine.middlewares.GmapsScreenshotEngineDownloaderMiddleware": 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # Replaced by CaptureFailureDownloaderMiddleware, which knows about pages
+    "scrapy.downloadermiddlewares.retry.RetryMiddleware": None,
+    "gmaps_screenshot_engine.middlewares.MemoryBudgetDownloaderMiddleware": 530,
+    "gmaps_screenshot_engine.middlewares.CaptureFailureDownloaderMiddleware": 540,
+    "gmaps_screenshot_engine.middlewares.PlaywrightPagePoolMiddleware": 550,
+}
+
+# Capture failure classes that are retried; consent and captcha fail fast
+CAPTURE_RETRY_REASONS = [
+    "navigation_timeout",
+    "rate_limited",
+    "download_error",
+    "blank",
+    "degraded",
+]
+# Retries per target
+CAPTURE_RETRY_MAX_TIMES = os.getenv("CAPTURE_RETRY_MAX_TIMES", "2")
+# Seconds before the first retry, doubled on every further attempt
+CAPTURE_RETRY_BACKOFF = os.getenv("CAPTURE_RETRY_BACKOFF", "5")
+# Retries allowed per run: this fraction of the requests sent, plus the minimum
+CAPTURE_RETRY_BUDGET_RATIO = os.getenv("CAPTURE_RETRY_BUDGET_RATIO", "0.2")
+CAPTURE_RETRY_BUDGET_MIN = os.getenv("CAPTURE_RETRY_BUDGET_MIN", "10")
+# PNG screenshots smaller than this (bytes) are blank or uniform frames. A
+# uniform 1280x720 frame takes 2.7 to 4.3 KB, flat land with a road 4.6 KB
+CAPTURE_BLANK_MAX_BYTES = os.getenv("CAPTURE_BLANK_MAX_BYTES", "4096")
+# The same for direct JPEG screenshots, 0 to disable: JPEG sizes barely
+# depend on the content (a uniform frame takes more than a sparse map PNG)
+CAPTURE_BLANK_MAX_BYTES_JPEG = os.getenv("CAPTURE_BLANK_MAX_BYTES_JPEG", "0")
+# Response URLs of the cookie consent wall and of the captcha page
+CAPTURE_CONSENT_URL_PATTERNS = [r"consent\.google\."]
+CAPTURE_CAPTCHA_URL_PATTERNS = [r"google\.[a-z.]+/sorry/"]
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 EXTENSIONS = {
+    # Before PostgresStatsExtension, so the final percentiles are stored
+    "gmaps_screenshot_engine.extensions.MetricsExtension": 490,
     "gmaps_screenshot_engine.extensions.PostgresStatsExtension": 500,
+    "gmaps_screenshot_engine.extensions.AdaptiveConcurrencyExtension": 510,
 }
 
+# Seconds between the stats snapshots stored in scrapy_run_stats_snapshots
+# (0 = only store the summary row when the spider closes)
+STATS_SNAPSHOT_INTERVAL = os.getenv("STATS_SNAPSHOT_INTERVAL", "60")
+# Snapshots written per insert
+STATS_SNAPSHOT_BATCH_SIZE = os.getenv("STATS_SNAPSHOT_BATCH_SIZE", "5")
+# Set by the launcher on each shard: write the stats and latency histograms to
+# this JSON file instead of the scrapy_run_stats row, inserted once per job
+STATS_SHARD_OUTPUT = os.getenv("STATS_SHARD_OUTPUT", "")
+
+# Seconds between refreshes of the latency/{stage}/p50|p95|p99 stats
+METRICS_PUBLISH_INTERVAL = os.getenv("METRICS_PUBLISH_INTERVAL", "10")
+# Serve live metrics on http://METRICS_HOST:METRICS_PORT/metrics (0 = disabled)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT", "9410")
+
+# Adaptive concurrency: tune CONCURRENT_REQUESTS_PER_DOMAIN and DOWNLOAD_DELAY
+# (the starting values) from render latency, host load and memory, the image
+# processing queue and 429/consent/captcha responses
+ADAPTIVE_CONCURRENCY_ENABLED = os.getenv("ADAPTIVE_CONCURRENCY_ENABLED", "True")
+# Seconds between adjustments
+ADAPTIVE_CONCURRENCY_INTERVAL = os.getenv("ADAPTIVE_CONCURRENCY_INTERVAL", "10")
+# Bounds of the concurrency per downloader slot
+ADAPTIVE_CONCURRENCY_MIN = os.getenv("ADAPTIVE_CONCURRENCY_MIN", "1")
+ADAPTIVE_CONCURRENCY_MAX = os.getenv("ADAPTIVE_CONCURRENCY_MAX", "8")
+# Bounds of the download delay, in seconds
+ADAPTIVE_CONCURRENCY_MIN_DELAY = os.getenv("ADAPTIVE_CONCURRENCY_MIN_DELAY", "0")
+ADAPTIVE_CONCURRENCY_MAX_DELAY = os.getenv("ADAPTIVE_CONCURRENCY_MAX_DELAY", "30")
+# Back off when the mean page render latency exceeds this, in seconds
+ADAPTIVE_CONCURRENCY_TARGET_LATENCY = os.getenv(
+    "ADAPTIVE_CONCURRENCY_TARGET_LATENCY", "15"
+)
+# Back off when the 1 minute load average per CPU exceeds this
+ADAPTIVE_CONCURRENCY_MAX_LOAD = os.getenv("ADAPTIVE_CONCURRENCY_MAX_LOAD", "1.5")
+# Back off when less than this fraction of the host memory is available
+ADAPTIVE_CONCURRENCY_MIN_MEMORY_AVAILABLE = os.getenv(
+    "ADAPTIVE_CONCURRENCY_MIN_MEMORY_AVAILABLE", "0.15"
+)
+# Response URLs meaning Google is pushing back (consent wall, captcha)
+ADAPTIVE_CONCURRENCY_BLOCK_URL_PATTERNS = (
+    CAPTURE_CONSENT_URL_PATTERNS + CAPTURE_CAPTCHA_URL_PATTERNS
+)
+
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     # "gmaps_screenshot_engine.pipelines.GmapsScreenshotsPostgresExportPipeline": 300,
+    "gmaps_screenshot_engine.pipelines.JobCheckpointPipeline": 310,
 }
 
+# Record the targets completed by each job in job_checkpoints, so a run
+# restarted with `-a job_id=<id> -a resume=true` skips them
+JOB_CHECKPOINT_ENABLED = os.getenv("JOB_CHECKPOINT_ENABLED", "False")
+# Checkpoints written per insert
+JOB_CHECKPOINT_BATCH_SIZE = os.getenv("JOB_CHECKPOINT_BATCH_SIZE", "50")
+# Seconds between flushes of a partial batch of checkpoints
+JOB_CHECKPOINT_FLUSH_INTERVAL = os.getenv("JOB_CHECKPOINT_FLUSH_INTERVAL", "5")
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
@@ -92,16 +175,62 @@ FEED_EXPORT_ENCODING = "utf-8"
 # Filter was commented out because it is not useful for this project
 #
 # DUPEFILTER_CLASS = "scrapy_redis.dupefilter.RFPDupeFilter"
-# REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-# REDIS_PORT = os.getenv("REDIS_PORT", 6379)
 # REDIS_KEY = "%(spider)s:dupefilter"
 
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = os.getenv("REDIS_PORT", "6379")
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+
+# Distributed mode (-a distributed=true -a job_id=<shared id>): targets are
+# seeded once into a Redis queue and consumed by every process of the job
+# Seconds a leased target stays invisible before it is handed out again
+TARGET_QUEUE_LEASE_SECONDS = os.getenv("TARGET_QUEUE_LEASE_SECONDS", "300")
+# Attempts before a failing target is dropped from the queue
+TARGET_QUEUE_MAX_ATTEMPTS = os.getenv("TARGET_QUEUE_MAX_ATTEMPTS", "3")
+# Seconds the seeder lock survives without progress
+TARGET_QUEUE_SEEDER_LOCK_SECONDS = os.getenv("TARGET_QUEUE_SEEDER_LOCK_SECONDS", "60")
+# Seconds the queue keys of a job are kept
+TARGET_QUEUE_TTL_SECONDS = os.getenv("TARGET_QUEUE_TTL_SECONDS", str(24 * 60 * 60))
+# Seconds between polls while the queue is empty but the job is not finished
+TARGET_QUEUE_POLL_INTERVAL = os.getenv("TARGET_QUEUE_POLL_INTERVAL", "1")
+
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
-POSTGRES_PORT = os.getenv("POSTGRES_PORT", 5432)
+POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
 POSTGRES_USER = os.getenv("POSTGRES_USER", "admin")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "Admin123*")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "database")
 
+# Connections shared by the spider, pipelines and extensions of a crawl
+POSTGRES_POOL_MIN_SIZE = os.getenv("POSTGRES_POOL_MIN_SIZE", "1")
+POSTGRES_POOL_MAX_SIZE = os.getenv("POSTGRES_POOL_MAX_SIZE", "4")
+# Idle seconds after which a pooled connection is pinged before reuse
+POSTGRES_POOL_HEALTH_CHECK_INTERVAL = os.getenv(
+    "POSTGRES_POOL_HEALTH_CHECK_INTERVAL", "30"
+)
+
+# Rows buffered by the export pipeline before a multi-row insert
+POSTGRES_BATCH_SIZE = os.getenv("POSTGRES_BATCH_SIZE", "100")
+# Seconds between flushes of a partially filled batch
+POSTGRES_BATCH_FLUSH_INTERVAL = os.getenv("POSTGRES_BATCH_FLUSH_INTERVAL", "5")
+
+# Target locations read per round-trip of the server-side cursor
+TARGETS_FETCH_SIZE = os.getenv("TARGETS_FETCH_SIZE", "500")
+
+# Only enqueue targets whose latest screenshot is older than their
+# refresh_interval_minutes, most overdue first
+TARGETS_DUE_ONLY = os.getenv("TARGETS_DUE_ONLY", "False")
+# Refresh interval of targets without refresh_interval_minutes
+TARGETS_DEFAULT_REFRESH_MINUTES = os.getenv("TARGETS_DEFAULT_REFRESH_MINUTES", "15")
+# Seconds a target may be early and still be due, so a capture taken late in
+# the previous cycle is not skipped by the next one
+TARGETS_DUE_TOLERANCE_SECONDS = os.getenv("TARGETS_DUE_TOLERANCE_SECONDS", "60")
+# Maximum targets enqueued per run (0 = no limit)
+TARGETS_MAX_PER_RUN = os.getenv("TARGETS_MAX_PER_RUN", "0")
+
+# Skip the upload of screenshots whose content did not change since the last
+# capture of the same target; a reference row is inserted instead
+SCREENSHOT_DEDUP_ENABLED = os.getenv("SCREENSHOT_DEDUP_ENABLED", "False")
+
 GMAPS_BASE_URL = os.getenv("GMAPS_BASE_URL", "https://www.google.com")
 
 # playwright
@@ -120,12 +249,182 @@ PLAYWRIGHT_LAUNCH_OPTIONS = {
 
 PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = 30_000
 
+# capture
+
+# Viewport set when a browser context is created
+CAPTURE_VIEWPORT_WIDTH = os.getenv("CAPTURE_VIEWPORT_WIDTH", "1280")
+CAPTURE_VIEWPORT_HEIGHT = os.getenv("CAPTURE_VIEWPORT_HEIGHT", "720")
+# compress: PNG capture resized, quantized and encoded by the process pool
+# direct: render at the output resolution and let the browser encode the JPEG
+CAPTURE_MODE = os.getenv("CAPTURE_MODE", "compress")
+# Device scale factor of the contexts in direct mode (1280x720 -> 854x480)
+CAPTURE_DIRECT_SCALE_FACTOR = os.getenv("CAPTURE_DIRECT_SCALE_FACTOR", str(854 / 1280))
+# JPEG quality requested from the browser in direct mode
+CAPTURE_JPEG_QUALITY = os.getenv("CAPTURE_JPEG_QUALITY", "70")
+# Capture clustered targets (same zoom, nearby) from one larger viewport
+# rendered once, instead of one navigation per target. Local mode only
+TILE_BATCHING_ENABLED = os.getenv("TILE_BATCHING_ENABLED", "False")
+# Viewport rendered for a batch; targets within (batch - capture viewport)
+# pixels of each other at their zoom level share a batch
+TILE_BATCH_VIEWPORT_WIDTH = os.getenv("TILE_BATCH_VIEWPORT_WIDTH", "2560")
+TILE_BATCH_VIEWPORT_HEIGHT = os.getenv("TILE_BATCH_VIEWPORT_HEIGHT", "1440")
+# Maximum targets captured from one batch viewport
+TILE_BATCH_MAX_TARGETS = os.getenv("TILE_BATCH_MAX_TARGETS", "16")
+# Region to capture, e.g. {"x": 0, "y": 0, "width": 1280, "height": 720}
+# (empty = the whole viewport)
+CAPTURE_CLIP = {}
+# When the map is considered rendered: network_idle, canvas_stable or max_wait
+CAPTURE_READINESS = os.getenv("CAPTURE_READINESS", "network_idle")
+# Requests followed by the network_idle condition (regular expressions)
+CAPTURE_TILE_URL_PATTERNS = [
+    r"/maps/vt",
+    r"/kh/v=",
+    r"/maps/_/js/",
+    r"\.gstatic\.com/",
+]
+# Milliseconds without tile requests for network_idle to be met
+CAPTURE_IDLE_MS = os.getenv("CAPTURE_IDLE_MS", "500")
+# Milliseconds between readiness checks
+CAPTURE_POLL_MS = os.getenv("CAPTURE_POLL_MS", "100")
+# Upper bound on the readiness wait; the capture is taken anyway after it
+CAPTURE_MAX_WAIT_MS = os.getenv("CAPTURE_MAX_WAIT_MS", "5000")
+
+# Abort the requests of the Maps app that do not show on the map canvas
+REQUEST_BLOCKING_ENABLED = os.getenv("REQUEST_BLOCKING_ENABLED", "True")
+# Never blocked: map tiles, the scripts rendering them and the fonts of the
+# map labels (regular expressions)
+REQUEST_BLOCKING_ALLOW_URL_PATTERNS = [
+    r"/maps/vt",
+    r"/kh/v=",
+    r"/maps/_/js/",
+    r"maps\.gstatic\.com/",
+    r"fonts\.gstatic\.com/",
+]
+# Blocked URLs, by rule name (regular expressions)
+REQUEST_BLOCKING_URL_PATTERNS = {
+    "analytics": r"google-analytics\.com|googletagmanager\.com|doubleclick\.net",
+    "logging": r"/gen_204|/log\?|/maps/preview/log|play\.google\.com/log",
+    "suggestions": r"/complete/search|/maps/suggest|/s\?tbm=map",
+    "google_bar": r"ogs\.google\.com",
+}
+# Blocked Playwright resource types (side panel photos, icons...). Fonts are
+# kept: map labels falling back to another font would change the captures
+REQUEST_BLOCKING_RESOURCE_TYPES = ["image", "media", "manifest"]
+# Let one in N blocked requests of each rule through to estimate the bytes
+# saved (0 = block them all, saved bytes are not estimated)
+REQUEST_BLOCKING_SAMPLE_EVERY = os.getenv("REQUEST_BLOCKING_SAMPLE_EVERY", "50")
+
+# Launch the page pool contexts on persistent profiles kept on the scrapyd
+# volume, so the Maps scripts and tiles stay in the browser disk cache across runs
+BROWSER_PROFILE_ENABLED = os.getenv("BROWSER_PROFILE_ENABLED", "False")
+BROWSER_PROFILE_ROOT = os.getenv(
+    "BROWSER_PROFILE_ROOT", "/var/lib/scrapyd/browser-profiles"
+)
+# Profiles in the store, i.e. contexts that can use one at the same time
+# across jobs; contexts finding none free get a throwaway profile
+BROWSER_PROFILE_SLOTS = os.getenv("BROWSER_PROFILE_SLOTS", "8")
+# Size of the whole store; least recently used profiles are deleted beyond
+# it, and the disk cache of each profile is capped at half of its share
+BROWSER_PROFILE_MAX_BYTES = os.getenv("BROWSER_PROFILE_MAX_BYTES", str(2 * 1024**3))
+# Seconds after which an unused profile is deleted (0 = never)
+BROWSER_PROFILE_MAX_AGE = os.getenv("BROWSER_PROFILE_MAX_AGE", str(7 * 24 * 3600))
+
+# Browser contexts the page pool spreads new pages over
+PLAYWRIGHT_POOL_CONTEXTS = os.getenv("PLAYWRIGHT_POOL_CONTEXTS", "2")
+# Captures after which a pooled page is closed and replaced
+PLAYWRIGHT_POOL_PAGE_MAX_USES = os.getenv("PLAYWRIGHT_POOL_PAGE_MAX_USES", "50")
+# Warm pages kept waiting for the next request
+PLAYWRIGHT_POOL_MAX_IDLE_PAGES = os.getenv("PLAYWRIGHT_POOL_MAX_IDLE_PAGES", "8")
+
+# image processing
+
+# Worker processes used to compress and encode screenshots (0 = one per CPU)
+IMAGE_PROCESSING_MAX_WORKERS = os.getenv("IMAGE_PROCESSING_MAX_WORKERS", "0")
+# Screenshots handed to the pool at once (0 = twice the number of workers)
+IMAGE_PROCESSING_MAX_PENDING = os.getenv("IMAGE_PROCESSING_MAX_PENDING", "0")
+# Bytes that screenshots waiting for or in image processing may hold, counted
+# from their measured peak; new captures wait while it is exceeded (0 = no limit)
+IMAGE_MEMORY_BUDGET = os.getenv("IMAGE_MEMORY_BUDGET", str(256 * 1024 * 1024))
+
+# Delta storage: store the blocks of a capture that changed since the previous
+# capture of its target (plus a manifest) instead of the whole JPEG; rebuild
+# captures with `python -m gmaps_screenshot_engine.delta rebuild`
+DELTA_STORAGE_ENABLED = os.getenv("DELTA_STORAGE_ENABLED", "False")
+# Side of the blocks, in pixels (a multiple of 16)
+DELTA_BLOCK_SIZE = os.getenv("DELTA_BLOCK_SIZE", "64")
+# A block changed when one of its 8x8 luminance averages moved by more than
+# this. Unchanged maps stay within 1 level; lower it to catch changes of a
+# single glyph in small labels, at the cost of storing more noise
+DELTA_BLOCK_THRESHOLD = os.getenv("DELTA_BLOCK_THRESHOLD", "3")
+# Captures between full keyframes, bounding the objects read by a rebuild
+DELTA_KEYFRAME_INTERVAL = os.getenv("DELTA_KEYFRAME_INTERVAL", "24")
+# Store a keyframe instead when more than this fraction of the blocks changed
+DELTA_MAX_CHANGED_RATIO = os.getenv("DELTA_MAX_CHANGED_RATIO", "0.5")
+
+# Check every frame before it is encoded and uploaded: blank frames, frames
+# with too many unloaded (placeholder) map tiles and frames that look like a
+# known bad template are rejected and retried or dropped
+IMAGE_VALIDATION_ENABLED = os.getenv("IMAGE_VALIDATION_ENABLED", "False")
+# A frame whose luminance has a lower standard deviation is blank, when its
+# mean colour is also a placeholder or blank colour (flat maps are kept)
+IMAGE_VALIDATION_MIN_STDDEV = os.getenv("IMAGE_VALIDATION_MIN_STDDEV", "4")
+# RGB colours of map tiles that did not load
+IMAGE_VALIDATION_PLACEHOLDER_COLORS = [(229, 227, 223)]
+# RGB colours of pages that did not render at all
+IMAGE_VALIDATION_BLANK_COLORS = [(255, 255, 255), (0, 0, 0)]
+# Maximum distance to a placeholder or blank colour, per band. The land
+# colour of the map (232, 230, 226) is only 3 levels from the placeholder
+IMAGE_VALIDATION_PLACEHOLDER_TOLERANCE = os.getenv(
+    "IMAGE_VALIDATION_PLACEHOLDER_TOLERANCE", "2"
+)
+# A frame with this fraction of placeholder cells (16x9 grid) is degraded
+IMAGE_VALIDATION_MAX_PLACEHOLDER_FRACTION = os.getenv(
+    "IMAGE_VALIDATION_MAX_PLACEHOLDER_FRACTION", "0.25"
+)
+# Directory of known bad frames (consent dialog, error pages...) to reject
+IMAGE_VALIDATION_TEMPLATES_DIR = os.getenv("IMAGE_VALIDATION_TEMPLATES_DIR")
+# Maximum histogram distance (L1, 0 to 2) to a template to reject a frame
+IMAGE_VALIDATION_TEMPLATE_MAX_DISTANCE = os.getenv(
+    "IMAGE_VALIDATION_TEMPLATE_MAX_DISTANCE", "0.15"
+)
+
 # aws
 
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION")
 AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
+# Custom S3 endpoint, e.g. a local moto or MinIO server
+AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
+
+# s3 uploader
+
+# Uploads running at once on the shared client
+S3_UPLOAD_MAX_CONCURRENCY = os.getenv("S3_UPLOAD_MAX_CONCURRENCY", "8")
+# Uploads waiting or running before parse() waits for a free slot
+S3_UPLOAD_MAX_PENDING = os.getenv("S3_UPLOAD_MAX_PENDING", "32")
+S3_UPLOAD_MAX_RETRIES = os.getenv("S3_UPLOAD_MAX_RETRIES", "3")
+# Seconds before the first retry, doubled on each attempt
+S3_UPLOAD_RETRY_BACKOFF = os.getenv("S3_UPLOAD_RETRY_BACKOFF", "0.5")
+# Objects larger than this (bytes) are sent as multipart uploads
+S3_MULTIPART_THRESHOLD = os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024))
+# Store objects under this local directory instead of S3 (offline runs)
+S3_FILESYSTEM_ROOT = os.getenv("S3_FILESYSTEM_ROOT")
+
+# storage
+
+# Where screenshots are written: "s3", "local" (files under STORAGE_LOCAL_ROOT),
+# "content_addressed" (deduplicated objects and an index under
+# STORAGE_LOCAL_ROOT, shipped to S3 in batches) or a StorageBackend class path
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+STORAGE_LOCAL_ROOT = os.getenv("STORAGE_LOCAL_ROOT", "local/storage")
+# Local files written at once
+STORAGE_LOCAL_MAX_CONCURRENCY = os.getenv("STORAGE_LOCAL_MAX_CONCURRENCY", "4")
+# Seconds between two batches shipped from the content addressed store to S3
+# while crawling (0 = only with `python -m gmaps_screenshot_engine.storage sync`)
+STORAGE_SYNC_INTERVAL = os.getenv("STORAGE_SYNC_INTERVAL", "0")
+# Objects shipped per batch
+STORAGE_SYNC_BATCH_SIZE = os.getenv("STORAGE_SYNC_BATCH_SIZE", "200")
 
 FEEDS_FOLDER = os.getenv("FEEDS_FOLDER", "local/feeds")
 FEED_URI = f"s3://{AWS_BUCKET_NAME}/{FEEDS_FOLDER}/%(name)s/%(time)s.jl"
@@ -1,16 +1,28 @@
+import asyncio
 import uuid
 
 import scrapy
+from scrapy import signals
 
+from gmaps_screenshot_engine.batching import TileBatchPlanner
+from gmaps_screenshot_engine.capture import (
+    CaptureFailure,
+    CaptureRetryService,
+    CaptureService,
+)
+from gmaps_screenshot_engine.delta import DeltaStorageService
 from gmaps_screenshot_engine.items import ScreenshotItem
 from gmaps_screenshot_engine.models import TargetLocationModel
+from gmaps_screenshot_engine.queues import RedisTargetQueue
 from gmaps_screenshot_engine.services import (
-    CompressImageService,
     GMapsUrlService,
+    ImageProcessingService,
+    MetricsService,
+    PlaywrightPagePoolService,
     PostgresService,
-    S3SaverImageService,
     TargetLocationService,
 )
+from gmaps_screenshot_engine.storage import get_storage_backend
 
 
 class GmapsScreenshotSpider(scrapy.Spider):
@@ -20,26 +32,96 @@ class GmapsScreenshotSpider(scrapy.Spider):
     ]
     start_urls = ["https://google.com"]
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # The spider is built before the crawler stats, which the services keep
+        crawler.signals.connect(spider.setup_services, signal=signals.spider_opened)
+
+        return spider
+
+    def setup_services(self, spider):
+        crawler = self.crawler
+        self.image_processing_service = ImageProcessingService.from_crawler(crawler)
+        self.storage = get_storage_backend(crawler)
+        self.page_pool = PlaywrightPagePoolService.from_crawler(crawler)
+        self.capture_service = CaptureService.from_crawler(crawler)
+        self.retry_service = CaptureRetryService.from_crawler(crawler)
+        self.metrics = MetricsService.from_crawler(crawler)
+        self.delta_storage = (
+            DeltaStorageService.from_crawler(crawler)
+            if self.settings.getbool("DELTA_STORAGE_ENABLED")
+            else None
+        )
+
+    def __init__(
+        self,
+        *args,
+        job_id=None,
+        distributed=False,
+        resume=False,
+        shard=None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.job_id = job_id or str(uuid.uuid4())
+        self.distributed = str(distributed).lower() in ("1", "true", "yes")
+        self.resume = str(resume).lower() in ("1", "true", "yes")
+        self.target_queue = None
+        # "i/N": only capture the targets with id % N == i
+        self.shard_index, self.shard_count = 0, 1
+
+        if self.resume and not job_id:
+            raise ValueError("resume needs the job_id of the run to resume")
+
+        if shard:
+            try:
+                self.shard_index, self.shard_count = map(int, str(shard).split("/"))
+            except ValueError:
+                raise ValueError(f"shard must look like i/N, got {shard!r}") from None
+
+            if not 0 <= self.shard_index < self.shard_count:
+                raise ValueError(f"shard index out of range: {shard!r}")
+
+            if self.distributed:
+                raise ValueError("shard and distributed modes can not be combined")
+
     async def start(self):
         crawler = self.crawler
         settings = crawler.settings
 
-        job_id = str(uuid.uuid4())
+        job_id = self.job_id
 
         crawler.stats.set_value("job_id", job_id, spider=self)
 
+        if self.shard_count > 1:
+            shard = f"{self.shard_index}/{self.shard_count}"
+            crawler.stats.set_value("shard", shard, spider=self)
+            self.logger.info(f"🧩 Capturing shard {shard} of job {job_id}")
+
         target_location_service = TargetLocationService(
-            postgres_service=PostgresService(
-                host=settings.get("POSTGRES_HOST"),
-                port=settings.get("POSTGRES_PORT"),
-                user=settings.get("POSTGRES_USER"),
-                password=settings.get("POSTGRES_PASSWORD"),
-                database=settings.get("POSTGRES_DB"),
-            )
+            postgres_service=PostgresService.from_crawler(crawler),
+            fetch_size=settings.getint("TARGETS_FETCH_SIZE"),
+            include_last_capture=settings.getbool("SCREENSHOT_DEDUP_ENABLED")
+            or settings.getbool("DELTA_STORAGE_ENABLED"),
+            due_only=settings.getbool("TARGETS_DUE_ONLY"),
+            default_refresh_minutes=settings.getint("TARGETS_DEFAULT_REFRESH_MINUTES"),
+            due_tolerance_seconds=settings.getint("TARGETS_DUE_TOLERANCE_SECONDS"),
+            max_targets=settings.getint("TARGETS_MAX_PER_RUN"),
+            skip_completed_job_id=job_id if self.resume else None,
+            shard_index=self.shard_index,
+            shard_count=self.shard_count,
         )
 
-        urls = target_location_service.get_targets()
-        for url in urls:
+        if self.resume:
+            self.logger.info(f"⏯️ Resuming job {job_id}, skipping completed targets")
+
+        if self.distributed:
+            targets = self.iter_queued_targets(target_location_service)
+        else:
+            targets = self.iter_local_targets(target_location_service)
+
+        async for url, meta in targets:
             self.logger.info(
                 f" 🪂 Send to process {url.name} [{url.latitude}, {url.longitude}]"
             )
@@ -49,45 +131,247 @@ class GmapsScreenshotSpider(scrapy.Spider):
                     target_location=url,
                 ),
                 callback=self.parse,
+                errback=self.errback,
+                # A target requeued by the queue (nack or expired lease) can
+                # be leased again by this process: the queue deduplicates
+                dont_filter="target_queue_payload" in meta,
                 meta={
                     "playwright": True,
                     "playwright_include_page": True,
+                    "playwright_page_init_callback": self.capture_service.prepare_page,
                     "job_id": job_id,
+                    **meta,
                     **url.model_dump(),
                 },
             )
 
-    async def parse(self, response):
-        target_location = TargetLocationModel(**response.meta)
+    async def iter_local_targets(self, target_location_service):
+        """Read the target ids up front, then the targets page by page.
+
+        Every query runs in a thread with its own short transaction, so the
+        reactor never waits on the database and no connection is held
+        between pages.
+        """
+        if not self.settings.getbool("TILE_BATCHING_ENABLED"):
+            ids = await asyncio.to_thread(target_location_service.get_target_ids)
+            fetch_size = target_location_service.fetch_size
+
+            for start in range(0, len(ids), fetch_size):
+                targets = await asyncio.to_thread(
+                    target_location_service.get_targets_by_id,
+                    ids[start : start + fetch_size],
+                )
+                for target in targets:
+                    yield target, {}
+            return
+
+        async for target, meta in self.iter_batched_targets(target_location_service):
+            yield target, meta
+
+    async def iter_batched_targets(self, target_location_service):
+        """Send nearby targets as one request rendering a larger viewport.
+
+        Planning needs every target, so they are all read before the first
+        request is sent.
+        """
+        settings = self.settings
+        planner = TileBatchPlanner(
+            viewport_width=settings.getint("CAPTURE_VIEWPORT_WIDTH"),
+            viewport_height=settings.getint("CAPTURE_VIEWPORT_HEIGHT"),
+            batch_width=settings.getint("TILE_BATCH_VIEWPORT_WIDTH"),
+            batch_height=settings.getint("TILE_BATCH_VIEWPORT_HEIGHT"),
+            max_targets=settings.getint("TILE_BATCH_MAX_TARGETS"),
+        )
+        targets = await asyncio.to_thread(target_location_service.get_targets)
+        viewport = {
+            "width": planner.batch_width,
+            "height": planner.batch_height,
+        }
+
+        for batch in planner.plan(targets):
+            if not batch.regions:
+                yield batch.center, {}
+                continue
+
+            self.crawler.stats.inc_value("tile_batching/batches")
+            self.crawler.stats.inc_value("tile_batching/targets", len(batch.targets))
+            self.crawler.stats.inc_value(
+                "tile_batching/navigations_saved", len(batch.targets) - 1
+            )
+            yield (
+                batch.center,
+                {
+                    "capture_viewport": viewport,
+                    "tile_batch": [target.model_dump() for target in batch.targets],
+                    "tile_batch_regions": batch.regions,
+                },
+            )
+
+    async def iter_queued_targets(self, target_location_service):
+        """Lease targets from the Redis queue shared by every process of the job.
+
+        The process that wins the seeder election streams the active targets
+        into the queue first. The generator ends once the queue is drained and
+        no target is leased anymore.
+        """
+        self.target_queue = queue = RedisTargetQueue.from_settings(
+            self.settings, self.job_id
+        )
+        poll_interval = self.settings.getfloat("TARGET_QUEUE_POLL_INTERVAL")
+
+        while True:
+            target, payload = await asyncio.to_thread(queue.lease)
+            if target is not None:
+                self.crawler.stats.inc_value("target_queue/leased")
+                yield target, {"target_queue_payload": payload}
+                continue
 
+            if await asyncio.to_thread(queue.is_finished):
+                return
+
+            if await asyncio.to_thread(queue.try_become_seeder):
+                added = await asyncio.to_thread(
+                    queue.seed, target_location_service.iter_targets()
+                )
+                self.crawler.stats.inc_value("target_queue/seeded", added)
+                self.logger.info(f"🌱 Seeded {added} targets for job {self.job_id}")
+                continue
+
+            await asyncio.sleep(poll_interval)
+
+    async def parse(self, response):
         page = response.meta["playwright_page"]
         job_id = response.meta["job_id"]
 
-        await page.set_viewport_size(
-            {
-                "width": 1280,
-                "height": 720,
-            }
+        if "download_latency" in response.meta:
+            self.metrics.observe("navigation", response.meta["download_latency"])
+
+        if "tile_batch" in response.meta:
+            target_locations = [
+                TargetLocationModel(**target) for target in response.meta["tile_batch"]
+            ]
+            regions = response.meta["tile_batch_regions"]
+        else:
+            target_locations = [TargetLocationModel(**response.meta)]
+            regions = [None]
+
+        previous_lookup = None
+        if self.delta_storage is not None:
+            # Read the previous manifests while the page renders
+            previous_lookup = asyncio.ensure_future(
+                asyncio.gather(
+                    *(
+                        self.delta_storage.previous(target)
+                        for target in target_locations
+                    )
+                )
+            )
+
+        failed = True
+        try:
+            # One render, one screenshot per target region
+            captures = [
+                await self.capture_service.capture(page, region=region, wait=index == 0)
+                for index, region in enumerate(regions)
+            ]
+            failed = False
+        finally:
+            if failed and previous_lookup is not None:
+                previous_lookup.cancel()
+            await self.page_pool.release(
+                page,
+                failed=failed,
+                context_name=response.meta.get("playwright_context"),
+            )
+
+        previous_manifests = (
+            await previous_lookup
+            if previous_lookup is not None
+            else [None] * len(target_locations)
+        )
+
+        processed_images = await asyncio.gather(
+            *(
+                self.image_processing_service.process(
+                    image_bytes=capture.image_bytes,
+                    image_format=capture.image_format,
+                    delta=self.delta_storage.encoder(previous)
+                    if self.delta_storage is not None
+                    else None,
+                )
+                for capture, previous in zip(captures, previous_manifests)
+            )
         )
-        screenshot_bytes = await page.screenshot(
-            full_page=True,
-            type="png",
+        # The raw screenshots are not needed past processing, drop them before
+        # the uploads instead of holding them until the callback ends
+        wait_seconds = [capture.wait_seconds for capture in captures]
+        del captures
+
+        # Bad frames are retried or dropped before paying for uploads and rows
+        for processed_image in processed_images:
+            if processed_image.rejection:
+                raise CaptureFailure(
+                    processed_image.rejection,
+                    f"Frame rejected as {processed_image.rejection}",
+                )
+
+        items = await asyncio.gather(
+            *(
+                self.store(
+                    target_location, processed_image, job_id, capture_wait, previous
+                )
+                for target_location, processed_image, capture_wait, previous in zip(
+                    target_locations, processed_images, wait_seconds, previous_manifests
+                )
+            )
         )
 
+        if "target_queue_payload" in response.meta:
+            await asyncio.to_thread(
+                self.target_queue.ack, response.meta["target_queue_payload"]
+            )
+
+        for item in items:
+            yield item
+
+    async def store(
+        self,
+        target_location,
+        processed_image,
+        job_id,
+        capture_wait_seconds,
+        previous_manifest=None,
+    ) -> ScreenshotItem:
+        """Store the processed capture of one target.
+
+        With delta storage, the stored `file_path` is the manifest of the
+        capture (see `DeltaReader`).
+        """
         file_name = f"{target_location.id}__{target_location.name.lower().replace(' ', '-')}__{target_location.latitude}_{target_location.longitude}__{target_location.gmaps_zoom}z"
 
         file_path = f"{target_location.folder}/{job_id}/{file_name}.jpg"
 
-        compress_image, size = CompressImageService.compress(
-            image_bytes=screenshot_bytes,
-        )
-
-        await page.close()
+        body = processed_image.body
+        size = len(body)
+        reference_file_path = None
 
-        S3SaverImageService.save(
-            file_path=file_path,
-            image=compress_image,
-        )
+        if (
+            self.settings.getbool("SCREENSHOT_DEDUP_ENABLED")
+            and processed_image.content_hash == target_location.last_content_hash
+        ):
+            # Unchanged since the last capture: point at the stored object
+            reference_file_path = target_location.last_file_path
+            self.crawler.stats.inc_value("dedup/unchanged")
+            self.crawler.stats.inc_value("dedup/bytes_saved", len(body))
+        elif self.delta_storage is not None:
+            file_path, size = await self.delta_storage.store(
+                file_path, processed_image, previous_manifest
+            )
+        else:
+            await self.storage.store(
+                file_path=file_path,
+                body=body,
+            )
 
         self.logger.info(f" 🪂 Process {target_location.model_dump()}")
 
@@ -95,6 +379,35 @@ class GmapsScreenshotSpider(scrapy.Spider):
             target_location_id=target_location.id,
             parent_folder=target_location.folder,
             file_path=file_path,
-            size=0,
+            size=0 if reference_file_path else size,
             job_id=job_id,
+            content_hash=processed_image.content_hash,
+            reference_file_path=reference_file_path,
+            capture_wait_seconds=capture_wait_seconds,
         )
+
+    async def errback(self, failure):
+        page = failure.request.meta.get("playwright_page")
+        if page is not None:
+            await self.page_pool.release(
+                page,
+                failed=True,
+                context_name=failure.request.meta.get("playwright_context"),
+            )
+
+        if "target_queue_payload" in failure.request.meta:
+            payload = failure.request.meta["target_queue_payload"]
+            # Consent walls and captchas fail fast: other workers would only
+            # hit them again
+            if self.retry_service.retryable(
+                failure.request.meta.get("capture_failure_reason")
+            ):
+                requeued = await asyncio.to_thread(self.target_queue.nack, payload)
+            else:
+                await asyncio.to_thread(self.target_queue.drop, payload)
+                requeued = False
+            self.crawler.stats.inc_value(
+                "target_queue/requeued" if requeued else "target_queue/dropped"
+            )
+
+        self.logger.error(f"❌ Error capturing {failure.request.url}: {failure.value}")
@@ -0,0 +1,447 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import BinaryIO, Self
+
+from scrapy.crawler import Crawler
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import get_project_settings
+from twisted.internet import task, threads
+
+from gmaps_screenshot_engine.services import (
+    S3_MULTIPART_CONCURRENCY,
+    CrawlerScopedService,
+    MetricsService,
+    S3UploaderService,
+    build_s3_client,
+)
+
+logger = logging.getLogger(__name__)
+
+STORAGE_S3 = "s3"
+STORAGE_LOCAL = "local"
+STORAGE_CONTENT_ADDRESSED = "content_addressed"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    file_path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    synced_at REAL
+);
+CREATE INDEX IF NOT EXISTS objects_unsynced_idx
+    ON objects (stored_at) WHERE synced_at IS NULL;
+"""
+
+
+def write_atomic(path: str, body: bytes):
+    """Write a file so readers only ever see it complete.
+
+    The body goes to a temporary file of the same directory, renamed over
+    `path` once written.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(body)
+        os.replace(temporary_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(temporary_path)
+        raise
+
+
+def get_storage_backend(crawler: Crawler) -> "StorageBackend":
+    """Storage backend selected by `STORAGE_BACKEND`: one of the built-in names
+    or the import path of a `StorageBackend` subclass."""
+    backend = crawler.settings.get("STORAGE_BACKEND")
+    backend_class = STORAGE_BACKENDS.get(backend) or load_object(backend)
+
+    return backend_class.from_crawler(crawler)
+
+
+class StorageBackend(CrawlerScopedService):
+    """Where encoded screenshots are written.
+
+    `file_path` is the logical key of a screenshot, the one recorded in the
+    `gmaps_screenshots` table, whatever the backend does with it.
+    """
+
+    async def store(self, file_path: str, body: bytes):
+        raise NotImplementedError
+
+    async def fetch(self, file_path: str) -> bytes | None:
+        """Bytes stored under `file_path`, None when there are none."""
+        raise NotImplementedError
+
+
+class S3StorageBackend(StorageBackend):
+    """Upload every screenshot to S3 as it is captured."""
+
+    def __init__(self, uploader: S3UploaderService):
+        self.uploader = uploader
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        return cls(S3UploaderService.from_crawler(crawler))
+
+    async def store(self, file_path: str, body: bytes):
+        await self.uploader.upload(file_path=file_path, body=body)
+
+    async def fetch(self, file_path: str) -> bytes | None:
+        return await self.uploader.download(file_path)
+
+
+class LocalStorageBackend(StorageBackend):
+    """Write screenshots as files under `root`, at their `file_path`.
+
+    Writes are atomic and run on a small thread pool, off the reactor.
+    """
+
+    def __init__(self, stats, metrics: MetricsService, root: str, max_concurrency: int):
+        self.stats = stats
+        self.metrics = metrics
+        self.root = root
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="local-storage",
+        )
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+
+        return cls(
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            root=settings.get("STORAGE_LOCAL_ROOT"),
+            max_concurrency=settings.getint("STORAGE_LOCAL_MAX_CONCURRENCY"),
+        )
+
+    async def store(self, file_path: str, body: bytes):
+        with self.metrics.time("store"):
+            await asyncio.wrap_future(
+                self.executor.submit(self._write, file_path, body)
+            )
+
+        self.stats.inc_value("storage/count")
+        self.stats.inc_value("storage/bytes", len(body))
+
+    async def fetch(self, file_path: str) -> bytes | None:
+        return await asyncio.wrap_future(self.executor.submit(self._read, file_path))
+
+    def _write(self, file_path: str, body: bytes):
+        write_atomic(os.path.join(self.root, file_path), body)
+
+    def _read(self, file_path: str) -> bytes | None:
+        try:
+            with open(os.path.join(self.root, file_path), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class ContentAddressedStore:
+    """Deduplicated object store on local disk, shipped to S3 in batches.
+
+    Objects are named by the BLAKE2b digest of their bytes and sharded in two
+    directory levels (`objects/ab/cd/abcd...`), so identical screenshots are
+    kept once and no directory grows too large. An SQLite index maps every
+    `file_path` to its object and records whether it was synced to S3; it is
+    safe to share between processes writing to the same root.
+    """
+
+    digest_size = 20
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(root, "index.sqlite3"),
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(INDEX_SCHEMA)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest[2:4], digest)
+
+    def put(self, file_path: str, body: bytes) -> bool:
+        """Store `body` under `file_path`.
+
+        Returns:
+            bool: False when an identical object was already stored.
+        """
+        digest = hashlib.blake2b(body, digest_size=self.digest_size).hexdigest()
+        path = self.object_path(digest)
+        created = not os.path.exists(path)
+        if created:
+            write_atomic(path, body)
+
+        with self.lock:
+            self.connection.execute(
+                """
+                INSERT INTO objects (file_path, digest, size, stored_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (file_path) DO UPDATE SET
+                    digest = excluded.digest,
+                    size = excluded.size,
+                    stored_at = excluded.stored_at,
+                    synced_at = NULL
+                WHERE objects.digest != excluded.digest
+                """,
+                (file_path, digest, len(body), time.time()),
+            )
+
+        return created
+
+    def get(self, file_path: str) -> bytes | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT digest FROM objects WHERE file_path = ?", (file_path,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        with open(self.object_path(row[0]), "rb") as file:
+            return file.read()
+
+    def pending(self, limit: int) -> list[tuple[str, str, int]]:
+        """Oldest (file_path, digest, size) entries not synced yet."""
+        with self.lock:
+            return self.connection.execute(
+                """
+                SELECT file_path, digest, size FROM objects
+                WHERE synced_at IS NULL
+                ORDER BY stored_at
+                LIMIT ?
+                """,
+                (limit,),
+            ).fetchall()
+
+    def forget(self, file_path: str):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM objects WHERE file_path = ?", (file_path,)
+            )
+
+    def mark_synced(self, file_paths: list[str]):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE objects SET synced_at = ? WHERE file_path = ?",
+                [(now, file_path) for file_path in file_paths],
+            )
+
+    def open_verified(self, digest: str) -> BinaryIO | None:
+        """Open an object once its bytes, read through `mmap`, match its digest.
+
+        A corrupt object is deleted, so storing the same bytes again rewrites
+        it. Returns None for corrupt or missing objects.
+        """
+        path = self.object_path(digest)
+        try:
+            # Handed to the caller, who closes it
+            file = open(path, "rb")  # noqa: SIM115
+        except FileNotFoundError:
+            return None
+
+        if os.fstat(file.fileno()).st_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                actual = hashlib.blake2b(mapped, digest_size=self.digest_size)
+        else:
+            actual = hashlib.blake2b(b"", digest_size=self.digest_size)
+
+        if actual.hexdigest() != digest:
+            file.close()
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+            return None
+
+        return file
+
+    def sync(self, client, bucket: str, batch_size: int) -> tuple[int, int, int]:
+        """Upload a batch of unsynced objects to S3 at their `file_path`.
+
+        Verified objects are handed to the client as open files (the
+        filesystem client copies them with `sendfile`). Corrupt objects are
+        dropped from the index and reported; their targets are captured again
+        on the next cycle.
+
+        Returns:
+            tuple: Objects synced, bytes synced and corrupt objects.
+        """
+        synced, synced_bytes, corrupt = [], 0, 0
+
+        try:
+            for file_path, digest, size in self.pending(batch_size):
+                file = self.open_verified(digest)
+                if file is None:
+                    logger.error(f"❌ Corrupt object {digest} for {file_path}")
+                    self.forget(file_path)
+                    corrupt += 1
+                    continue
+
+                with file:
+                    client.upload_fileobj(Fileobj=file, Bucket=bucket, Key=file_path)
+
+                synced.append(file_path)
+                synced_bytes += size
+        finally:
+            # Objects uploaded before a failure are not shipped twice
+            self.mark_synced(synced)
+
+        return len(synced), synced_bytes, corrupt
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class ContentAddressedStorageBackend(LocalStorageBackend):
+    """Capture to a local `ContentAddressedStore`, ship to S3 asynchronously.
+
+    With `sync_interval` set, a batch of `sync_batch_size` objects is shipped
+    every `sync_interval` seconds while crawling; otherwise batches are shipped
+    by `python -m gmaps_screenshot_engine.storage sync`.
+    """
+
+    def __init__(
+        self,
+        stats,
+        metrics: MetricsService,
+        root: str,
+        max_concurrency: int,
+        client=None,
+        bucket: str | None = None,
+        sync_interval: float = 0,
+        sync_batch_size: int = 200,
+    ):
+        super().__init__(stats, metrics, root, max_concurrency)
+        self.store_index = ContentAddressedStore(root)
+        self.client = client
+        self.bucket = bucket
+        self.sync_batch_size = sync_batch_size
+        self.sync_loop = None
+
+        if sync_interval > 0 and client is not None:
+            self.sync_loop = task.LoopingCall(self.sync)
+            self.sync_loop.start(sync_interval, now=False)
+
+    @classmethod
+    def create(cls, crawler: Crawler) -> Self:
+        settings = crawler.settings
+        sync_interval = settings.getfloat("STORAGE_SYNC_INTERVAL")
+
+        return cls(
+            stats=crawler.stats,
+            metrics=MetricsService.from_crawler(crawler),
+            root=settings.get("STORAGE_LOCAL_ROOT"),
+            max_concurrency=settings.getint("STORAGE_LOCAL_MAX_CONCURRENCY"),
+            client=build_s3_client(
+                settings, max_pool_connections=S3_MULTIPART_CONCURRENCY
+            )
+            if sync_interval > 0
+            else None,
+            bucket=settings.get("AWS_BUCKET_NAME"),
+            sync_interval=sync_interval,
+            sync_batch_size=settings.getint("STORAGE_SYNC_BATCH_SIZE"),
+        )
+
+    def _write(self, file_path: str, body: bytes):
+        if not self.store_index.put(file_path, body):
+            self.stats.inc_value("storage/deduplicated")
+
+    def _read(self, file_path: str) -> bytes | None:
+        try:
+            return self.store_index.get(file_path)
+        except FileNotFoundError:
+            return None
+
+    def sync(self):
+        deferred = threads.deferToThread(
+            self.store_index.sync, self.client, self.bucket, self.sync_batch_size
+        )
+        deferred.addCallbacks(self._record_sync, self._sync_failed)
+
+        return deferred
+
+    def _record_sync(self, result: tuple[int, int, int]):
+        synced, synced_bytes, corrupt = result
+        self.stats.inc_value("storage/synced", synced)
+        self.stats.inc_value("storage/synced_bytes", synced_bytes)
+        if corrupt:
+            self.stats.inc_value("storage/corrupt", corrupt)
+
+    def _sync_failed(self, failure):
+        self.stats.inc_value("storage/sync_failed")
+        logger.warning(f"⚠️ Sync to S3 failed, retrying next batch: {failure.value}")
+
+    def close(self):
+        if self.sync_loop is not None and self.sync_loop.running:
+            self.sync_loop.stop()
+        super().close()
+        self.store_index.close()
+
+
+STORAGE_BACKENDS = {
+    STORAGE_S3: S3StorageBackend,
+    STORAGE_LOCAL: LocalStorageBackend,
+    STORAGE_CONTENT_ADDRESSED: ContentAddressedStorageBackend,
+}
+
+
+def main():
+    """Ship the content addressed store to S3 from the command line."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("command", choices=["sync"])
+    parser.add_argument("--root", default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument(
+        "--loop", type=float, default=0, help="Keep syncing every N seconds"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    settings = get_project_settings()
+    store = ContentAddressedStore(args.root or settings.get("STORAGE_LOCAL_ROOT"))
+    client = build_s3_client(settings, max_pool_connections=S3_MULTIPART_CONCURRENCY)
+    batch_size = args.batch_size or settings.getint("STORAGE_SYNC_BATCH_SIZE")
+
+    while True:
+        synced, synced_bytes, corrupt = store.sync(
+            client, settings.get("AWS_BUCKET_NAME"), batch_size
+        )
+        logger.info(f"📦 Synced {synced} objects ({synced_bytes} bytes)")
+        if corrupt:
+            logger.error(f"❌ {corrupt} corrupt objects dropped")
+
+        if synced < batch_size:
+            if not args.loop:
+                break
+            time.sleep(args.loop)
+
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+
+from gmaps_screenshot_engine.services import (
+    FilesystemS3Client,
+    MetricsService,
+    S3UploaderService,
+)
+
+BUCKET = "screenshots"
+ATTEMPT_SECONDS = 0.05
+
+
+class FlakyS3Client(FilesystemS3Client):
+    """Local stand-in failing its first `failures` uploads, slowly."""
+
+    def __init__(self, root: str, failures: int):
+        super().__init__(root)
+        self.failures = failures
+        self.attempts = 0
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            time.sleep(ATTEMPT_SECONDS)
+            raise OSError("connection reset")
+
+        super().upload_fileobj(Fileobj, Bucket, Key, Config)
+
+
+class S3UploaderServiceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.stats = MemoryStatsCollector(SimpleNamespace(settings=Settings()))
+        self.metrics = MetricsService(stats=self.stats)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def uploader(self, failures: int, max_retries: int) -> S3UploaderService:
+        self.client = FlakyS3Client(self.root.name, failures)
+        uploader = S3UploaderService(
+            stats=self.stats,
+            metrics=self.metrics,
+            client=self.client,
+            bucket=BUCKET,
+            max_concurrency=2,
+            max_pending=4,
+            max_retries=max_retries,
+            retry_backoff=ATTEMPT_SECONDS,
+            multipart_threshold=8 * 1024 * 1024,
+        )
+        self.addCleanup(uploader.close)
+
+        return uploader
+
+    def stored(self, file_path: str) -> bytes | None:
+        try:
+            with open(os.path.join(self.root.name, BUCKET, file_path), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    async def test_upload(self):
+        uploader = self.uploader(failures=0, max_retries=2)
+
+        await uploader.upload("folder/job/a.jpg", b"jpeg")
+
+        self.assertEqual(self.stored("folder/job/a.jpg"), b"jpeg")
+        self.assertEqual(await uploader.download("folder/job/a.jpg"), b"jpeg")
+        self.assertIsNone(await uploader.download("folder/job/missing.jpg"))
+        self.assertEqual(self.stats.get_value("s3_uploader/count"), 1)
+        self.assertEqual(self.stats.get_value("s3_uploader/bytes"), 4)
+        self.assertIsNone(self.stats.get_value("s3_uploader/retries"))
+        self.assertEqual(self.stats.get_value("s3_uploader/queue_depth"), 0)
+
+    async def test_retries_count_toward_the_upload_time(self):
+        uploader = self.uploader(failures=2, max_retries=2)
+
+        await uploader.upload("folder/job/a.jpg", b"jpeg")
+
+        self.assertEqual(self.client.attempts, 3)
+        self.assertEqual(self.stored("folder/job/a.jpg"), b"jpeg")
+        self.assertEqual(self.stats.get_value("s3_uploader/retries"), 2)
+        self.assertEqual(self.stats.get_value("s3_uploader/count"), 1)
+        self.assertIsNone(self.stats.get_value("s3_uploader/failed"))
+        # Two failed attempts and two backoff sleeps (1x then 2x the backoff)
+        self.assertGreaterEqual(
+            self.stats.get_value("s3_uploader/seconds"), 5 * ATTEMPT_SECONDS
+        )
+        self.assertEqual(self.metrics.histograms["upload"].count, 1)
+
+    async def test_failure_after_the_last_retry(self):
+        uploader = self.uploader(failures=3, max_retries=1)
+
+        with self.assertRaises(OSError):
+            await uploader.upload("folder/job/a.jpg", b"jpeg")
+
+        self.assertEqual(self.client.attempts, 2)
+        self.assertIsNone(self.stored("folder/job/a.jpg"))
+        self.assertEqual(self.stats.get_value("s3_uploader/retries"), 1)
+        self.assertEqual(self.stats.get_value("s3_uploader/failed"), 1)
+        self.assertIsNone(self.stats.get_value("s3_uploader/count"))
+        self.assertGreaterEqual(
+            self.stats.get_value("s3_uploader/failed_seconds"), 3 * ATTEMPT_SECONDS
+        )
+        self.assertEqual(self.metrics.histograms["upload"].count, 1)
+        self.assertEqual(self.stats.get_value("s3_uploader/queue_depth"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()